@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 29 17:32:10 2020
+
+@author: marcnol
+
+Benchmarks pyHiM.py on synthetic datasets of increasing size.
+
+Starting from a base scenario (the first value given for each dimension), one scenario
+is run for every other value of each dimension: number of ROIs, number of cycles,
+image size and number of z planes. For each scenario a dataset is generated with
+syntheticHiM_run.py, pyHiM.py is run on it and the following are collected:
+    - total elapsed time
+    - wall time per stage, from the HiM_profile.json written by pyHiM.py
+    - error of the global alignments against the known drifts, in px
+    - error of the median PWD matrix against the one of the known barcode positions, in um
+
+Results are saved in benchmark.json and benchmark.md in the output folder.
+
+In the command line, run as
+$ benchmarkHiM_run.py -F outputFolder --ROIs 1,2 --cycles 4,8 --size 256,512 --zPlanes 30,60 --parallel
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import sys
+import shutil
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+
+from fileManagement import saveJSON, loadJSON, writeString2File
+from syntheticHiM_run import createsSyntheticDataset
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def buildsScenarios(dimensions):
+    """
+    returns the base scenario followed by one scenario per non-base value of each dimension
+
+    Parameters
+    ----------
+    dimensions : dict
+        list of values for each dimension, the first one is used in the base scenario.
+
+    Returns
+    -------
+    scenarios : list of dict
+
+    """
+    base = {key: values[0] for key, values in dimensions.items()}
+    scenarios = [base]
+    for key, values in dimensions.items():
+        for value in values[1:]:
+            scenario = dict(base)
+            scenario[key] = value
+            scenarios.append(scenario)
+
+    return scenarios
+
+
+def getsScenarioName(scenario):
+    return "_".join(["{}{}".format(key, value) for key, value in scenario.items()])
+
+
+def calculatesShiftError(rootFolder, groundTruth):
+    """
+    returns the mean and max distance in px between the shifts found by alignImages and the known ones
+
+    """
+    dictShifts = loadJSON(rootFolder + os.sep + "alignImages" + os.sep + "alignImages.json")
+
+    errors = []
+    for ROI, dictShiftROI in groundTruth["dictShifts"].items():
+        for cycle, shift in dictShiftROI.items():
+            if ROI in dictShifts and cycle in dictShifts[ROI]:
+                errors.append(np.linalg.norm(np.array(dictShifts[ROI][cycle]) - np.array(shift)))
+
+    if len(errors) > 0:
+        return np.mean(errors), np.max(errors)
+    else:
+        return np.nan, np.nan
+
+
+def calculatesPWDerror(rootFolder, groundTruth, pixelSize=0.1):
+    """
+    returns the mean absolute difference in um between the median 2D PWD matrix built by pyHiM
+    and the one calculated from the known barcode positions
+
+    """
+    fileNameMatrix = rootFolder + os.sep + "buildsPWDmatrix" + os.sep + "buildsPWDmatrix_HiMscMatrix.npy"
+    fileNameBarcodes = rootFolder + os.sep + "buildsPWDmatrix" + os.sep + "buildsPWDmatrix_uniqueBarcodes.ecsv"
+    if not (os.path.exists(fileNameMatrix) and os.path.exists(fileNameBarcodes)):
+        return np.nan
+
+    SCmatrix = np.load(fileNameMatrix)
+    uniqueBarcodes = list(np.atleast_1d(np.loadtxt(fileNameBarcodes).astype(int)))
+
+    # ground truth matrix with the barcodes in the order used by pyHiM
+    traces = np.concatenate([np.array(x) for x in groundTruth["cells"].values()], axis=0)
+    index = [groundTruth["barcodes"].index(x) for x in uniqueBarcodes]
+    positions = traces[:, index, 1:] * pixelSize
+    distances = np.linalg.norm(positions[:, :, None, :] - positions[:, None, :, :], axis=3)
+    medianTrue = np.median(distances, axis=0)
+
+    medianFound = np.nanmedian(SCmatrix, axis=2)
+    mask = ~np.isnan(medianFound) & ~np.eye(len(uniqueBarcodes), dtype=bool)
+    if mask.sum() == 0:
+        return np.nan
+
+    return np.mean(np.abs(medianFound[mask] - medianTrue[mask]))
+
+
+def runsScenario(outputFolder, scenario, pyHiMarguments, keep=False):
+    """
+    generates the dataset of a scenario, runs pyHiM.py on it and collects the results
+
+    """
+    rootFolder = outputFolder + os.sep + getsScenarioName(scenario)
+    if os.path.exists(rootFolder):
+        shutil.rmtree(rootFolder)
+
+    groundTruth = createsSyntheticDataset(
+        rootFolder,
+        numberROIs=scenario["ROIs"],
+        numberCycles=scenario["cycles"],
+        imageSize=scenario["size"],
+        numberZplanes=scenario["zPlanes"],
+    )
+
+    pyHiMscript = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep + "pyHiM.py"
+    begin_time = datetime.now()
+    returnCode = subprocess.call([sys.executable, pyHiMscript, "-F", rootFolder] + pyHiMarguments)
+    elapsedTime = (datetime.now() - begin_time).total_seconds()
+
+    profile = loadJSON(rootFolder + os.sep + "HiM_profile.json")
+    stages = {stage: summary["wallTime"] for stage, summary in profile.get("stages", {}).items()}
+    meanShiftError, maxShiftError = calculatesShiftError(rootFolder, groundTruth)
+
+    result = {
+        "scenario": scenario,
+        "returnCode": returnCode,
+        "elapsedTime": elapsedTime,
+        "stages": stages,
+        "meanShiftError": meanShiftError,
+        "maxShiftError": maxShiftError,
+        "PWDerror": calculatesPWDerror(rootFolder, groundTruth),
+    }
+
+    if not keep:
+        shutil.rmtree(rootFolder)
+
+    return result
+
+
+def savesResults(outputFolder, results):
+    saveJSON(outputFolder + os.sep + "benchmark.json", results)
+
+    stages = sorted(set([stage for result in results for stage in result["stages"]]))
+    columns = ["scenario", "status", "elapsed (s)"] + ["{} (s)".format(x) for x in stages]
+    columns += ["shift error mean/max (px)", "PWD error (um)"]
+    table = [
+        "# pyHiM benchmark {}\n".format(datetime.now().strftime("%Y/%m/%d %H:%M:%S")),
+        "| " + " | ".join(columns) + " |",
+        "|" + "---|" * len(columns),
+    ]
+    for result in results:
+        row = [
+            getsScenarioName(result["scenario"]),
+            "ok" if result["returnCode"] == 0 else "failed",
+            "{:.1f}".format(result["elapsedTime"]),
+        ]
+        row += ["{:.1f}".format(result["stages"].get(x, np.nan)) for x in stages]
+        row += [
+            "{:.3f}/{:.3f}".format(result["meanShiftError"], result["maxShiftError"]),
+            "{:.3f}".format(result["PWDerror"]),
+        ]
+        table.append("| " + " | ".join(row) + " |")
+    writeString2File(outputFolder + os.sep + "benchmark.md", "\n".join(table), "w")
+    print("\n".join(table))
+
+
+def parsesList(string):
+    return [int(x) for x in string.split(",")]
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-F", "--rootFolder", help="Folder for datasets and results, default: .")
+    parser.add_argument("--ROIs", help="Comma separated numbers of ROIs, default: 1", default="1")
+    parser.add_argument("--cycles", help="Comma separated numbers of barcode cycles, default: 4,8", default="4,8")
+    parser.add_argument("--size", help="Comma separated image sizes, default: 256,512", default="256,512")
+    parser.add_argument("--zPlanes", help="Comma separated numbers of z planes, default: 30", default="30")
+    parser.add_argument("--parallel", help="Runs pyHiM.py in parallel mode", action="store_true")
+    parser.add_argument("--localAlignment", help="Runs pyHiM.py with localAlignment", action="store_true")
+    parser.add_argument("--refit", help="Runs pyHiM.py with refit", action="store_true")
+    parser.add_argument("--keep", help="Keeps the datasets and outputs of each scenario", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.rootFolder:
+        outputFolder = args.rootFolder
+    else:
+        outputFolder = os.getcwd()
+    if not os.path.exists(outputFolder):
+        os.makedirs(outputFolder)
+
+    pyHiMarguments = [
+        "--{}".format(x) for x in ["parallel", "localAlignment", "refit"] if getattr(args, x)
+    ]
+
+    dimensions = {
+        "ROIs": parsesList(args.ROIs),
+        "cycles": parsesList(args.cycles),
+        "size": parsesList(args.size),
+        "zPlanes": parsesList(args.zPlanes),
+    }
+
+    results = []
+    for scenario in buildsScenarios(dimensions):
+        print("\n>>> Running scenario: {}".format(getsScenarioName(scenario)))
+        results.append(runsScenario(outputFolder, scenario, pyHiMarguments, keep=args.keep))
+        savesResults(outputFolder, results)
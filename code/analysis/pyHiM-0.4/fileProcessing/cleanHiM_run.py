@@ -55,14 +55,22 @@ if __name__ == "__main__":
         filesLOGMD = glob.glob(rootFolder + os.sep + "HiM_analysis*.log", recursive=True)
         filesLOG = glob.glob(rootFolder + os.sep + "log*.txt", recursive=True)
         filesSession = glob.glob(rootFolder + os.sep + "Session*.json", recursive=True)
+        filesJournal = glob.glob(rootFolder + os.sep + "HiM_journal.jsonl", recursive=True)
+        filesManifest = glob.glob(rootFolder + os.sep + "HiM_manifest.json", recursive=True)
 
-        for f in filesMD + filesLOG + filesSession + filesLOGMD:
+        for f in filesMD + filesLOG + filesSession + filesLOGMD + filesJournal + filesManifest:
             try:
                 os.remove(f)
                 print("File deleted: {} ".format(f))
             except OSError as e:
                 print("Error: {} : {}".format(f, e.strerror))
 
+        # figures queued and not rendered, log lines of workers not merged, ROI shards
+        for folderName in ["HiM_figures", "HiM_logs", "HiM_shards"]:
+            if os.path.isdir(rootFolder + os.sep + folderName):
+                shutil.rmtree(rootFolder + os.sep + folderName)
+                print("{} removed".format(rootFolder + os.sep + folderName))
+
     # Removes directories produced during previous runs
     param = Parameters(rootFolder, fileParameters)
 
@@ -76,6 +84,7 @@ if __name__ == "__main__":
         folders2Remove.append(currentFolder + os.sep + param.param["segmentedObjects"]["folder"])
         folders2Remove.append(currentFolder + os.sep + "buildsPWDmatrix")
         folders2Remove.append(currentFolder + os.sep + param.param["projectsBarcodes"]["folder"])
+        folders2Remove.append(currentFolder + os.sep + "stageCache")
 
         for newFolder in folders2Remove:
             if os.path.isdir(newFolder):
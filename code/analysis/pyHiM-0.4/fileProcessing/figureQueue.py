@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 31 11:20:37 2020
+
+@author: marcnol
+
+Deferred rendering of the quality control figures of the pipeline.
+
+Instead of calling matplotlib while they run, stages call queuesFigure() with the plotting
+function and its arguments. The figure spec is pickled to <rootFolder>/HiM_figures, so that
+it can be written from dask workers, and the figures are rendered at the end of the run
+by rendersFigures() in a pool of processes.
+
+The amount of figures rendered is set by "render" in the "figures" section of the
+parameters file:
+    - "full": all figures, at full resolution (default)
+    - "summary": figures of level "summary" (matrices, block alignments) as they are. Figures
+      of level "full" built from images (overlays, differences, mosaics) are rendered from images
+      binned down to at most "summaryImageSize" px and saved at a lower resolution. Other
+      figures of level "full" (e.g. PWD histograms) are skipped.
+    - "none": no figures
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import glob
+import uuid
+import pickle
+import socket
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+figureFolderName = "HiM_figures"
+renderLevels = {"none": 0, "summary": 1, "full": 2}
+
+# resolution of figures rendered from binned images in "summary" mode. Default of matplotlib is 100
+summaryDPI = 25
+
+
+def getsRenderParameters(param):
+    """
+    returns the render level and the maximum image size of summary figures from the parameters file
+
+    """
+    renderLevel, summaryImageSize = "full", 512
+    if "figures" in param.param.keys():
+        if "render" in param.param["figures"].keys():
+            renderLevel = param.param["figures"]["render"]
+        if "summaryImageSize" in param.param["figures"].keys():
+            summaryImageSize = param.param["figures"]["summaryImageSize"]
+
+    if renderLevel not in renderLevels.keys():
+        print("Render level {} not recognized, using full".format(renderLevel))
+        renderLevel = "full"
+
+    return renderLevel, summaryImageSize
+
+
+def downscalesImage(image, maxSize):
+    """
+    bins a 2D image by averaging blocks of pixels so that its largest dimension is at most maxSize
+
+    """
+    factor = int(np.ceil(max(image.shape[:2]) / maxSize))
+    if factor <= 1:
+        return image
+
+    ny, nx = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    image = image[:ny, :nx]
+    return image.reshape(ny // factor, factor, nx // factor, factor, *image.shape[2:]).mean(axis=(1, 3))
+
+
+def queuesFigure(param, function, args, kwargs=None, level="full", images=()):
+    """
+    Queues a figure to be rendered at the end of the run, according to the render level
+
+    Parameters
+    ----------
+    param : Parameters Class
+    function : callable
+        module level plotting function that saves the figure, e.g. save2imagesRGB.
+    args : tuple
+        positional arguments of function.
+    kwargs : dict, optional
+        keyword arguments of function. The default is None.
+    level : string, optional
+        "summary" or "full": lowest render level at which the figure is rendered. The default is "full".
+    images : tuple, optional
+        indexes in args of the 2D images that can be binned down in "summary" mode. The default is ().
+
+    Returns
+    -------
+    queued : boolean
+        True if the figure will be rendered. Callers use it to decide whether to link it in the report.
+
+    """
+    renderLevel, summaryImageSize = getsRenderParameters(param)
+    args, dpi = list(args), None
+
+    if renderLevels[level] > renderLevels[renderLevel]:
+        if renderLevel != "summary" or len(images) == 0:
+            return False
+
+        # renders a lighter version of the figure
+        for index in images:
+            args[index] = downscalesImage(args[index], summaryImageSize)
+        dpi = summaryDPI
+
+    spec = {"function": function, "args": args, "kwargs": kwargs or {}, "dpi": dpi}
+
+    figureFolder = param.param["rootFolder"] + os.sep + figureFolderName
+    if not os.path.exists(figureFolder):
+        os.makedirs(figureFolder, exist_ok=True)
+
+    # time stamp first so that figures are rendered in the order they were queued
+    specFileName = figureFolder + os.sep + "{}_{}_{}_{}.pkl".format(
+        datetime.now().strftime("%Y%m%d%H%M%S%f"), socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+    )
+
+    # writes to a temporary file first so that the renderer never reads a partial spec
+    with open(specFileName + ".tmp", "wb") as f:
+        pickle.dump(spec, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(specFileName + ".tmp", specFileName)
+
+    return True
+
+
+def initializesRenderer():
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def rendersFigure(specFileName):
+    """
+    renders the figure of a spec file and removes it
+
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    with open(specFileName, "rb") as f:
+        spec = pickle.load(f)
+
+    rcParams = {} if spec["dpi"] is None else {"savefig.dpi": spec["dpi"]}
+    with matplotlib.rc_context(rcParams):
+        spec["function"](*spec["args"], **spec["kwargs"])
+    plt.close("all")
+
+    os.remove(specFileName)
+
+
+def rendersFigures(rootFolder, log1, numberProcesses=None):
+    """
+    Renders all the figures queued in rootFolder with a pool of processes
+
+    Parameters
+    ----------
+    rootFolder : string
+    log1 : log Class
+    numberProcesses : int, optional
+        The default is None, which uses up to 4 processes.
+
+    Returns
+    -------
+    numberFailed : int
+
+    """
+    specFileNames = sorted(glob.glob(rootFolder + os.sep + figureFolderName + os.sep + "*.pkl"))
+    if len(specFileNames) == 0:
+        return 0
+
+    # some figures add their links to the report when rendered
+    log1.flush()
+
+    if numberProcesses is None:
+        numberProcesses = min(4, multiprocessing.cpu_count())
+
+    log1.report("Rendering {} figures with {} processes".format(len(specFileNames), numberProcesses))
+    begin_time = datetime.now()
+
+    # spawn avoids forking a process that holds the threads of the dask client
+    numberFailed = 0
+    with ProcessPoolExecutor(
+        max_workers=numberProcesses, mp_context=multiprocessing.get_context("spawn"), initializer=initializesRenderer
+    ) as executor:
+        futures = {executor.submit(rendersFigure, x): x for x in specFileNames}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                numberFailed += 1
+                log1.report("Could not render figure {}: {}".format(os.path.basename(futures[future]), e), "Warning")
+
+    log1.report(
+        "Rendered {} figures in {}, {} failed".format(len(specFileNames), datetime.now() - begin_time, numberFailed)
+    )
+
+    return numberFailed
@@ -17,12 +17,18 @@ import glob
 import os
 from os import path
 import json
+import hashlib
+import functools
 import re
+import time
+import uuid
+import atexit
+import socket
+import threading
 from warnings import warn
 import multiprocessing
 import numpy as np
 
-from dask.distributed import Client, LocalCluster
 
 
 # =============================================================================
@@ -31,15 +37,45 @@ from dask.distributed import Client, LocalCluster
 
 
 class log:
+    """
+    Log of a run, written to a text file (.log) and a Markdown report (.md).
+
+    Lines are buffered and written in batches by flush(), which is called when the buffer
+    is full, at the end of every task decorated with profilesTask and at the end of every stage.
+    Copies of the log sent to dask workers do not write to the log files: each flush
+    writes its lines to a new shard file in <rootFolder>/HiM_logs. The process that created
+    the log merges the shards with its own lines, in time order, every time it flushes.
+
+    """
+
+    bufferSize = 200
+    shardFolderName = "HiM_logs"
+
     def __init__(self, rootFolder="./", fileNameRoot="HiM_analysis", parallel=False):
         now = datetime.now()
         dateTime = now.strftime("%Y%m%d_%H%M%S")
         self.fileName = rootFolder + os.sep + fileNameRoot + dateTime + ".log"
         self.fileNameMD = self.fileName.split(".")[0] + ".md"
         self.parallel=parallel
+        self.shardFolder = rootFolder + os.sep + self.shardFolderName
+        self.pid = self.bufferPid = os.getpid()
+        self.buffer = []
+        self.lock = threading.Lock()
         self.eraseFile()
         self.report("Starting to log to: {}".format(self.fileName))
-        
+        atexit.register(self.flush)
+
+    # buffered lines and the lock are not sent to workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["buffer"], state["lock"] = [], None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.bufferPid = os.getpid()
+
     def eraseFile(self):
         # with open(self.fileName, 'w') as file:
         #    file.write("")
@@ -53,7 +89,7 @@ class log:
     def save(self, text="", status="info"):
         # with open(self.fileName, 'a') as file:
         #    file.write(self.getFullString(text,status)+'\n')
-        writeString2File(self.fileName, self.getFullString(text, status), "a")
+        self.addsLine(self.fileName, self.getFullString(text, status))
 
     # thisfunction will output to cmd line and save in logfile
     def report(self, text, status="info"):
@@ -70,7 +106,70 @@ class log:
 
     def addSimpleText(self, title):
         print("{}".format(title))
-        writeString2File(self.fileName, title, "a")
+        self.addsLine(self.fileName, title)
+
+    # saves to Markdown report
+    def addMarkdown(self, text):
+        self.addsLine(self.fileNameMD, text)
+
+    def addsLine(self, fileName, text):
+        with self.lock:
+            self.ownsBuffer()
+            self.buffer.append((time.time(), fileName, text))
+            full = len(self.buffer) >= self.bufferSize
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        writes the buffered lines: to the log files in the process that created the log,
+        to a new shard file in any other process
+
+        """
+        with self.lock:
+            self.ownsBuffer()
+            records, self.buffer = self.buffer, []
+
+            if os.getpid() != self.pid:
+                if len(records) > 0:
+                    self.savesShard(records)
+            else:
+                self.writesRecords(records + self.readsShards())
+
+    def ownsBuffer(self):
+        # a forked process inherits the lines buffered by its parent, which writes them itself
+        if self.bufferPid != os.getpid():
+            self.buffer, self.bufferPid = [], os.getpid()
+
+    def savesShard(self, records):
+        if not os.path.exists(self.shardFolder):
+            os.makedirs(self.shardFolder, exist_ok=True)
+
+        shardFileName = self.shardFolder + os.sep + "{}_{}_{}.json".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+        # writes to a temporary file first so that partial shards are never merged
+        with open(shardFileName + ".tmp", "w") as f:
+            json.dump(records, f)
+        os.replace(shardFileName + ".tmp", shardFileName)
+
+    def readsShards(self):
+        records = []
+        for shardFileName in glob.glob(self.shardFolder + os.sep + "*.json"):
+            with open(shardFileName) as f:
+                records += [tuple(x) for x in json.load(f)]
+            os.remove(shardFileName)
+
+        return records
+
+    def writesRecords(self, records):
+        # one write per file, lines of all processes in time order
+        lines = {}
+        for _, fileName, text in sorted(records, key=lambda x: x[0]):
+            lines.setdefault(fileName, []).append(text)
+
+        for fileName, texts in lines.items():
+            writeString2File(fileName, "\n".join(texts), "a")
 
 
 class folders:
@@ -91,7 +190,7 @@ class folders:
         hfolders = [
             folder
             for folder in glob.glob(self.masterFolder + os.sep + "*")
-            if os.path.isdir(folder) and len(glob.glob(folder + os.sep + "*." + extension)) > 0
+            if os.path.isdir(folder) and containsFiles(folder, extension)
         ]
         # os.path.name(folder)[0]!='F']
         if len(hfolders) > 0:
@@ -100,7 +199,7 @@ class folders:
             self.listFolders = []
 
         # checks if there are files with the required extension in the root folder provided
-        if os.path.isdir(self.masterFolder) and len(glob.glob(self.masterFolder + os.sep + "*." + extension)) > 0:
+        if os.path.isdir(self.masterFolder) and containsFiles(self.masterFolder, extension):
             # self.listFolders=self.masterFolder
             self.listFolders.append(self.masterFolder)
 
@@ -128,12 +227,14 @@ class folders:
         self.outputFolders["segmentedObjects"] = filesFolder + os.sep + param.param["segmentedObjects"]["folder"]
         self.outputFolders["buildsPWDmatrix"] = filesFolder + os.sep + "buildsPWDmatrix"
         self.outputFolders["projectsBarcodes"] = filesFolder + os.sep + param.param["projectsBarcodes"]["folder"]
+        self.outputFolders["stageCache"] = filesFolder + os.sep + "stageCache"
 
         self.createSingleFolder(self.outputFolders["zProject"])
         self.createSingleFolder(self.outputFolders["alignImages"])
         self.createSingleFolder(self.outputFolders["segmentedObjects"])
         self.createSingleFolder(self.outputFolders["buildsPWDmatrix"])
         self.createSingleFolder(self.outputFolders["projectsBarcodes"])
+        self.createSingleFolder(self.outputFolders["stageCache"])
 
         # self.outputFiles['zProject']=self.outputFolders['zProject']+os.sep+param.param['zProject']['outputFile']
         self.outputFiles["alignImages"] = (
@@ -154,13 +255,181 @@ class folders:
             print("Folder created: {}".format(folder))
 
 
+class manifest:
+    """
+    Index of the images of a folder: name, size and modification time of every image and the
+    parts of its name decoded with fileNameRegExp (roi, cycle, channel...).
+
+    The index is saved as HiM_manifest.json next to the images and is rebuilt only when files
+    are added, removed or renamed in the folder (modification time of the folder), so that stages
+    do not list and parse the folder again. Files rewritten in place do not change the folder:
+    the size and modification time of the files returned by getsFiles() and getsLargestFile(),
+    which stages are about to read, are checked and their records updated. Use getsManifest()
+    to get the manifest of a folder, which keeps it in memory for the process.
+
+    """
+
+    fileName = "HiM_manifest.json"
+
+    def __init__(self, folder, regExp=None, extension="tif"):
+        self.folder = folder
+        self.extension = extension
+        self.fileName = folder + os.sep + manifest.fileName
+        self.folderMtime = os.stat(folder).st_mtime_ns
+        self.regExp = regExp
+        self.records = {}
+
+        if not self.loads():
+            self.builds()
+        self.indexes()
+
+    def loads(self):
+        if not path.exists(self.fileName):
+            return False
+
+        try:
+            data = loadJSON(self.fileName)
+        except ValueError:
+            return False
+
+        if data.get("folderMtime") != self.folderMtime or data.get("extension") != self.extension:
+            return False
+
+        self.records = data["records"]
+        if self.regExp is None:
+            self.regExp = data.get("regExp", "")
+        elif data.get("regExp") != self.regExp:
+            # same files, only the names need to be decoded again
+            self.decodes()
+            self.saves()
+
+        return True
+
+    def builds(self):
+        """
+        lists the folder once, with the size and modification time of each image
+
+        """
+        self.records = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.endswith("." + self.extension) and entry.is_file():
+                    stat = entry.stat()
+                    self.records[entry.name] = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+        self.decodes()
+        self.saves()
+
+    def decodes(self):
+        if self.regExp is None:
+            self.regExp = ""
+
+        for name, record in self.records.items():
+            fileParts = decodesFileName(self.regExp, name) if len(self.regExp) > 0 else None
+            for key in ["roi", "cycle", "channel"]:
+                record[key] = fileParts[key] if fileParts and key in fileParts else None
+
+    def saves(self):
+        try:
+            # creating the manifest changes the folder, rewriting it does not
+            if not path.exists(self.fileName):
+                open(self.fileName, "w").close()
+                self.folderMtime = os.stat(self.folder).st_mtime_ns
+
+            data = {"folderMtime": self.folderMtime, "extension": self.extension, "regExp": self.regExp, "records": self.records}
+            saveJSON(self.fileName, data)
+        except OSError:
+            # read-only data folder, the manifest is kept in memory
+            pass
+
+    def indexes(self):
+        """
+        builds the dictionaries used for lookups by (roi, cycle, channel) and by roi
+
+        """
+        self.byKey, self.byROI, self.ROIs = {}, {}, {}
+        for name in sorted(self.records):
+            record = self.records[name]
+            self.byKey.setdefault((record["roi"], record["cycle"], record["channel"]), []).append(name)
+            self.byROI.setdefault(record["roi"], []).append(name)
+            if record["roi"] is not None and record["roi"].isdigit():
+                self.ROIs[int(record["roi"])] = record["roi"]
+
+    def getsROI(self, ROI):
+        # ROIs in barcode tables are integers, in file names they are strings such as '001'
+        return self.ROIs.get(ROI) if isinstance(ROI, (int, np.integer)) else ROI
+
+    def checks(self, names=None):
+        """
+        updates the size and modification time of the records of names (default: all the
+        images) that changed since they were indexed. Images that disappeared are left to
+        getsManifest(), as removing a file changes the folder.
+
+        Returns
+        -------
+        changedNames : list
+
+        """
+        changedNames = []
+        for name in self.records if names is None else names:
+            try:
+                stat = os.stat(self.folder + os.sep + name)
+            except OSError:
+                continue
+
+            record = self.records[name]
+            if record["size"] != stat.st_size or record["mtime"] != stat.st_mtime:
+                record["size"], record["mtime"] = stat.st_size, stat.st_mtime
+                changedNames.append(name)
+
+        if len(changedNames) > 0:
+            print("Manifest of {}: {} files changed since indexed".format(self.folder, len(changedNames)))
+            self.saves()
+
+        return changedNames
+
+    def getsFiles(self, ROI=None, cycle=None, channel=None):
+        """
+        returns the full names of the images, sorted, optionally for a ROI, or for a ROI, cycle and channel
+
+        """
+        if ROI is None:
+            names = sorted(self.records)
+        elif cycle is None and channel is None:
+            names = self.byROI.get(self.getsROI(ROI), [])
+        else:
+            names = self.byKey.get((self.getsROI(ROI), cycle, channel), [])
+        self.checks(names)
+
+        return [self.folder + os.sep + x for x in names]
+
+    def getsCycles(self):
+        return sorted(set([x["cycle"] for x in self.records.values()]), key=str)
+
+    def getsLargestFile(self):
+        if len(self.records) == 0:
+            return None
+        self.checks()
+        return self.folder + os.sep + max(self.records, key=lambda x: self.records[x]["size"])
+
+
 class session:
-    def __init__(self, rootFolder, name="dummy"):
+    def __init__(self, rootFolder, name="dummy", resume=False):
         now = datetime.now()
         sessionRootName = now.strftime("%d%m%Y_%H%M%S")
         self.fileName = rootFolder + os.sep + "Session_" + sessionRootName + ".json"
+        self.journalFileName = rootFolder + os.sep + "HiM_journal.jsonl"
         self.name = name
         self.data = {}
+        self.completed = {}
+        # position in the journal of the first record not replayed
+        self.journalPosition = 0
+
+        if resume:
+            self.replaysJournal()
+        else:
+            # a new run starts a new journal
+            open(self.journalFileName, "w").close()
 
     # loads existing session
     def load(self):
@@ -173,12 +442,105 @@ class session:
         log.info("Saved json session file to {}".format(self.fileName))
 
     # add new task to session
-    def add(self, key, value):
+    def add(self, key, value, outputs=(), payload=None):
         if key not in self.data:
             self.data[key] = value
         else:
             self.data[key] = [self.data[key], value]
 
+        self.journals(value, key, outputs, payload)
+
+    def journals(self, stage, key, outputs=(), payload=None):
+        """
+        Appends a record of a completed task to the journal. The record is flushed to disk
+        before returning so that it survives a crash of the run.
+
+        Parameters
+        ----------
+        stage : string
+            name of the stage, e.g. "makesProjections".
+        key : string
+            file or folder processed.
+        outputs : list, optional
+            files produced, their checksums are recorded. A task without outputs, or whose
+            outputs are missing, is never replayed as completed. The default is ().
+        payload : optional
+            JSON serializable result of the task, e.g. the shift of an alignment. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        outputs = list(outputs)
+        record = {
+            "stage": stage,
+            "file": key,
+            "outputs": outputs,
+            "checksums": [fileChecksum(x) for x in outputs],
+            "payload": payload,
+            "time": datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
+        }
+
+        with open(self.journalFileName, "a") as fileHandle:
+            fileHandle.write(json.dumps(record) + "\n")
+            fileHandle.flush()
+            os.fsync(fileHandle.fileno())
+
+    def replaysJournal(self):
+        """
+        Reads the journal of a previous run and keeps the records of the tasks whose outputs
+        are still on disk and unchanged. Only the records added since the last call are read,
+        so that streaming mode can replay the tasks completed by each wave.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not path.exists(self.journalFileName):
+            print("No journal found to resume from: {}".format(self.journalFileName))
+            return
+
+        numberRecords, line = 0, "\n"
+        with open(self.journalFileName) as fileHandle:
+            fileHandle.seek(self.journalPosition)
+            for line in iter(fileHandle.readline, ""):
+                if line.endswith("\n"):
+                    self.journalPosition = fileHandle.tell()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last record of a run that was interrupted while writing
+                    continue
+                numberRecords += 1
+
+                # only tasks whose outputs were all written and are unchanged are completed
+                checksums = record["checksums"]
+                if (
+                    len(record["outputs"]) > 0
+                    and all([checksum[1] is not None for checksum in checksums])
+                    and all([fileChecksum(x) == checksum for x, checksum in zip(record["outputs"], checksums)])
+                ):
+                    self.completed[(record["stage"], record["file"])] = record
+                    self.data[record["file"]] = record["stage"]
+
+        # terminates a truncated last record so that new records start on their own line
+        if not line.endswith("\n"):
+            writeString2File(self.journalFileName, "", "a")
+
+        print("Journal replayed: {} records read, {} tasks completed".format(numberRecords, len(self.completed)))
+
+    def isCompleted(self, stage, key):
+        """
+        returns the journal record of a task completed in the run that is resumed, None otherwise
+
+        """
+        if (stage, key) in self.completed:
+            return self.completed[(stage, key)]
+        else:
+            return None
+
     def clearData(self):
         self.data = {}
 
@@ -219,6 +581,7 @@ class Parameters:
                 "zwindows": 10,
                 "windowSecurity": 2,
                 "zProjectOption": "sum",  # sum or MIP
+                "focalPlane": "file",  # automatic mode: file, or ROI to reuse the focal plane of the reference fiducial
             },
             "alignImages": { 
                 "folder": "alignImages",  # output folder
@@ -226,9 +589,15 @@ class Parameters:
                 "outputFile": "alignImages",
                 "referenceFiducial": "RT18",
                 "alignByBlock": True, # alignByBlock True will perform block alignment
-                "tolerance": 0.1, #Used in blockAlignment to determine the % of error tolerated
+                "toleranceRMS": 0.2, #Used in blockAlignment to determine the % of RMS error tolerated
                 "lower_threshold": 0.999, # lower threshold to adjust image intensity levels before xcorrelation
                 "higher_threshold": 0.9999999, # higher threshold to adjust image intensity levels before xcorrelation
+                "pyramidLevels": 0, # >0: global alignment on images binned by 2**pyramidLevels, refined on a full resolution crop
+                "pyramidCrop": 512, # size in px of the full resolution crop refining pyramid alignments
+                "driftTrajectory": False, # True: registers cycles near the shift predicted from the seed cycles of their ROI
+                "driftSeedStep": 4, # one cycle in driftSeedStep, in acquisition order, is registered without prediction
+                "driftCrop": 256, # size in px of the crop searched around predicted shifts
+                "driftTolerance": 5, # px: shifts farther from the prediction are searched again, and flagged as outliers
                 "localShiftTolerance": 1,
                 "bezel": 20,                
             },
@@ -260,12 +629,35 @@ class Parameters:
                 "3DGaussianfitWindow": 3,  # size of window to extract subVolume, px. 3 means subvolume will be 7x7.
                 "toleranceDrift":1, # tolerance used for block drift correction, in px
             },
+            "figures": {
+                "render": "full",  # none, summary, full
+                "summaryImageSize": 512,  # max size in px of images used for figures in summary mode
+            },
+            "cluster": {
+                "schedulerAddress": "",  # address of a running dask scheduler, e.g. tcp://10.0.0.1:8786. Empty: LocalCluster
+                "localScratch": "",  # folder with local copies of the TIFF files on each node. Empty: none
+            },
+            "io": {
+                "store": "tiff",  # tiff, zarr: reads 3D images from the store written by storeHiM_run.py
+                "chunkZ": 4,  # planes per chunk of the store
+                "chunkXY": 256,  # size in px of the xy tiles of the store
+                "compressionLevel": 3,  # zstd compression level of the store
+                "prefetchDepth": 2,  # files read ahead of the one processed, 0 to disable
+                "prefetchMemory": 2000,  # MB, maximum memory of the files read ahead
+                "intermediates": "npy",  # npy, hdf5: stores 2D intermediates in a container per ROI
+                "intermediatesFloat32": True,  # stores float intermediates of containers as float32
+                "intermediatesCompression": "gzip",  # gzip, lzf or "": lossless compression of containers
+                "spotTable": "ecsv",  # ecsv, binary: format of the tables of spots, binary appends the spots of each file
+                "spotTableECSV": True,  # binary format: also exports the tables of spots as ECSV
+            },
         }
         self.initializeStandardParameters()
         self.paramFile = rootFolder + os.sep + label
         self.loadParametersFile(self.paramFile)
         self.param["rootFolder"] = rootFolder
         self.fileParts={}
+        # in streaming mode, names of the files completely written by the microscope
+        self.filesReady = None
         
     def get_param(self, param=False):
         if not param:
@@ -297,6 +689,10 @@ class Parameters:
     # method returns label specific filenames from filename list
     def files2Process(self, filesFolder):
 
+        # in streaming mode, leaves out files that are still being acquired
+        if self.filesReady is not None:
+            filesFolder = [file for file in filesFolder if path.basename(file) in self.filesReady]
+
         # defines channel for DAPI, fiducials and barcodes
         channelDAPI = self.setsChannel("DAPI_channel", "ch00")
         channelbarcode = self.setsChannel("barcode_channel", "ch01")
@@ -383,41 +779,117 @@ class Parameters:
         '''
         # decodes regular expressions
         if 'fileNameRegExp' in self.param['acquisition'].keys():
-            fileParts=re.search(self.param['acquisition']['fileNameRegExp'],fileName)
+            fileParts=decodesFileName(self.param['acquisition']['fileNameRegExp'],fileName)
             return fileParts
         else:
             return {}
+
+    def getsRegExp(self):
+        if 'fileNameRegExp' in self.param['acquisition'].keys():
+            return self.param['acquisition']['fileNameRegExp']
+        else:
+            return ""
     
 class daskCluster:
-    def __init__(self, requestedNumberNodes,maximumLoad=0.6,memoryPerWorker = 2000):
+    """
+    Sizes the local dask cluster from the cores and memory available and, if given, from the
+    memory needed by the tasks of each stage (see estimatesTaskMemory).
+
+    Workers are processes with several threads each. Every worker advertises its memory
+    limit as the dask resource "memory" (in MB), and tasks submitted with getsTaskResources(stage)
+    reserve their estimated memory, so that a worker only runs together as many heavy tasks
+    (e.g. projections of 3D stacks) as fit in its memory, while light 2D tasks use all its threads.
+
+    """
+
+    # fraction of the available memory given to the workers
+    memoryFraction = 0.8
+
+    # worker memory thresholds, as fractions of its memory limit
+    memorySpill = {"target": 0.6, "spill": 0.7, "pause": 0.85, "terminate": 0.95}
+
+    def __init__(self, requestedNumberNodes,maximumLoad=0.6,memoryPerWorker = 2000, taskMemory=None, schedulerAddress=""):
         self.requestedNumberNodes = requestedNumberNodes
         # self.nThreads will be created after exetution of initializeCluster()
         self.maximumLoad = maximumLoad  # max number of workers that I can take
-        self.memoryPerWorker = memoryPerWorker# in Mb       
-        self.initializeCluster()
+        self.memoryPerWorker = memoryPerWorker# in Mb, minimum per worker
+        self.taskMemory = taskMemory if taskMemory is not None else {}  # in Mb, for each stage
+        self.schedulerAddress = schedulerAddress  # empty for a LocalCluster
+
+        # workers of an external scheduler are sized when they are started
+        if len(self.schedulerAddress) == 0:
+            self.initializeCluster()
 
     def initializeCluster(self):
         
-        numberCoresAvailable = multiprocessing.cpu_count()
+        numberCoresAvailable = int(np.max([1, multiprocessing.cpu_count()*self.maximumLoad]))
+        self.memoryAvailable = readsAvailableMemory()
 
-        # we want at least 2 GB per worker
-        _, _, free_m = map(int, os.popen("free -t -m").readlines()[-1].split()[1:])
- 
-        maxNumberThreads = int(np.min([numberCoresAvailable*self.maximumLoad, free_m / self.memoryPerWorker]))
-        
-        self.nThreads = int(np.min([maxNumberThreads, self.requestedNumberNodes]))
+        # each worker needs to fit at least the largest task
+        memoryNeeded = np.max([self.memoryPerWorker] + list(self.taskMemory.values()))
+        maxNumberWorkers = int(self.memoryAvailable*self.memoryFraction / memoryNeeded)
+
+        # number of worker processes
+        self.nThreads = int(np.max([1, np.min([numberCoresAvailable, maxNumberWorkers, self.requestedNumberNodes])]))
 
-        print("Cluster with {} workers started ({} requested)".format(self.nThreads,self.requestedNumberNodes))
+        # remaining cores are used as threads
+        self.threadsPerWorker = int(np.max([1, numberCoresAvailable // self.nThreads]))
+        self.memoryLimit = int(self.memoryAvailable*self.memoryFraction / self.nThreads)
+
+        print("Cluster with {} workers started ({} requested), {} threads and {} MB per worker".format(
+            self.nThreads,self.requestedNumberNodes,self.threadsPerWorker,self.memoryLimit))
+
+        if self.memoryLimit < memoryNeeded:
+            print("Warning: {} MB per worker, less than the {} MB estimated for the largest task".format(self.memoryLimit, memoryNeeded))
 
     def createDistributedClient(self):
+        import dask
+        from dask.distributed import Client, LocalCluster
+
+        dask.config.set({"distributed.worker.memory." + key: value for key, value in self.memorySpill.items()})
+
         self.cluster = LocalCluster(n_workers=self.nThreads,
-                                # processes=True,
-                                # threads_per_worker=1,
-                                # memory_limit='2GB',
+                                threads_per_worker=self.threadsPerWorker,
+                                memory_limit="{}MB".format(self.memoryLimit),
+                                resources={"memory": self.memoryLimit},
                                 # ip='tcp://localhost:8787',
                                 ) 
         self.client = Client(self.cluster)
-        
+
+        setsTaskResources(self.taskMemory, self.memoryLimit)
+
+    def connectsDistributedClient(self, localScratch=""):
+        """
+        Connects to a running scheduler instead of starting a LocalCluster, so that the tasks
+        are spread over the workers of several nodes. Workers need pyHiM in their PYTHONPATH and
+        rootFolder mounted at the same path as in the driver.
+
+        Tasks reserve memory only if all workers were started with a "memory" resource, e.g.
+        $ dask-worker tcp://scheduler:8786 --memory-limit 32GB --resources "memory=32000"
+
+        Parameters
+        ----------
+        localScratch : string, optional
+            folder where each node keeps local copies of the TIFF files of rootFolder. The default is ''.
+
+        """
+        from dask.distributed import Client
+
+        self.cluster = None
+        self.client = Client(self.schedulerAddress)
+
+        workers = self.client.scheduler_info()["workers"]
+        self.nThreads = len(workers)
+        print("Connected to scheduler {} with {} workers".format(self.schedulerAddress, self.nThreads))
+
+        workerMemory = [x.get("resources", {}).get("memory") for x in workers.values()]
+        if len(workerMemory) > 0 and None not in workerMemory:
+            setsTaskResources(self.taskMemory, np.min(workerMemory))
+        else:
+            setsTaskResources({}, 0)
+
+        locatesFiles(self.client, localScratch)
+
 
 # =============================================================================
 # FUNCTIONS
@@ -441,6 +913,35 @@ def loadJSON(fileName):
     return data
 
 
+def fileSignature(fileName):
+    if os.path.exists(fileName):
+        stat = os.stat(fileName)
+        return [os.path.basename(fileName), stat.st_size, stat.st_mtime_ns]
+
+    # intermediates stored in a ROI container
+    attributes = readsIntermediateAttributes(fileName) if fileName.endswith(".npy") else None
+    if attributes is not None:
+        return [os.path.basename(fileName), 0, attributes[0]]
+    else:
+        return [os.path.basename(fileName), -1, -1]
+
+
+def fileChecksum(fileName):
+    if os.path.exists(fileName):
+        sha1 = hashlib.sha1()
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        return [os.path.basename(fileName), sha1.hexdigest()]
+
+    # intermediates stored in a ROI container
+    attributes = readsIntermediateAttributes(fileName) if fileName.endswith(".npy") else None
+    if attributes is not None:
+        return [os.path.basename(fileName), attributes[1]]
+    else:
+        return [os.path.basename(fileName), None]
+
+
 def isnotebook():
     """
     This function detects if you are running on an ipython console or in the shell.
@@ -465,6 +966,78 @@ def isnotebook():
         return False  # Probably standard Python interpreter
 
 
+@functools.lru_cache(maxsize=None)
+def decodesFileName(regExp, fileName):
+    """
+    returns the parts of fileName decoded with regExp as a dict, None if it does not match.
+    Results are cached as every stage decodes the same names for every label.
+
+    """
+    fileParts = re.search(regExp, fileName)
+    if fileParts:
+        return fileParts.groupdict()
+    else:
+        return None
+
+
+def containsFiles(folder, extension="tif"):
+    """
+    returns True if folder contains a file with extension, stopping at the first one
+
+    """
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith("." + extension):
+                return True
+    return False
+
+
+# manifests already read by this process, by folder
+manifests = {}
+
+
+def getsManifest(folder, param=None, extension="tif"):
+    """
+    returns the manifest of the images of folder, reading or building it only if the
+    folder changed since it was last used in this process
+
+    Parameters
+    ----------
+    folder : string
+    param : Parameters Class, optional
+        used to decode file names with fileNameRegExp. The default is None.
+    extension : string, optional
+        The default is 'tif'.
+
+    Returns
+    -------
+    manifest Class
+
+    """
+    regExp = param.getsRegExp() if param is not None else None
+    key = (os.path.abspath(folder), extension)
+    folderManifest = manifests.get(key)
+
+    if folderManifest is None or folderManifest.folderMtime != os.stat(folder).st_mtime_ns:
+        folderManifest = manifest(folder, regExp=regExp, extension=extension)
+        manifests[key] = folderManifest
+    elif regExp is not None and folderManifest.regExp != regExp:
+        folderManifest.regExp = regExp
+        folderManifest.decodes()
+        folderManifest.indexes()
+        folderManifest.saves()
+
+    return folderManifest
+
+
+def listsImages(folder, param=None, extension="tif"):
+    """
+    returns the images of folder from its manifest, as glob.glob(folder + os.sep + "*.tif") would
+
+    """
+    return getsManifest(folder, param, extension).getsFiles()
+
+
 def RT2fileName(param, referenceBarcode):
     """
     Finds the files in a list that contain the ReferenceBarcode in their name
@@ -524,14 +1097,13 @@ def ROI2FiducialFileName(param, file, barcodeName):
     
     channelFiducial = param.param["acquisition"]["fiducialBarcode_channel"]
 
-    # looks for referenceFiducial file in folder
-    listFiles = glob.glob(rootFolder + os.sep + "*.tif")
+    # looks for referenceFiducial file in the files of this ROI
+    listFiles = getsManifest(rootFolder, param).getsFiles(ROI)
 
     candidates = [
         x
         for x in listFiles
         if (barcodeName+"_" in x)
-        and (ROI == param.decodesFileParts(os.path.basename(x))['roi'])
         and (channelFiducial in os.path.basename(x))
     ]
 
@@ -555,29 +1127,459 @@ def retrieveNumberUniqueBarcodesRootFolder(rootFolder, parameterFile, ext='tif')
         number of unique cycles.
 
     """
-    def unique(list1): 
-        ''' function to get unique values'''
-        # intilize a null list 
-        unique_list = [] 
-          
-        # traverse for all elements 
-        for x in list1: 
-            # check if exists in unique_list or not 
-            if x not in unique_list: 
-                unique_list.append(x) 
-    
-        return unique_list      
-            
-    allFilesinRootFolder=glob.glob(rootFolder+os.sep+"*"+ext)
-    
     param = Parameters(rootFolder, rootFolder+parameterFile)
-       
-    ROIs, RTs = [], []
-    for x in allFilesinRootFolder:
-        fileParts = param.decodesFileParts(x)
-        ROIs.append(fileParts["roi"])
-        RTs.append(fileParts["cycle"])
-    
-    numberUniqueCycles=len(unique(RTs))
+
+    numberUniqueCycles=len(getsManifest(rootFolder, param, ext).getsCycles())
         
-    return numberUniqueCycles
\ No newline at end of file
+    return numberUniqueCycles
+
+
+# =============================================================================
+# CLUSTER RESOURCES
+# =============================================================================
+
+# memory needed by a task of each stage, as a number of float64 arrays with the shape of
+# a 3D stack or of a 2D image. Stage names are those used by profilesTask.
+taskMemoryModel = {
+    "makesProjections": ("3D", 0.75),
+    "alignImages": ("2D", 20),
+    "registersImages": ("2D", 6),
+    "segmentMasks": ("2D", 20),
+    "projectsBarcodes": ("2D", 30),
+    "refitBarcodes3D": ("3D", 0.75),
+    "localDriftCorrection": ("2D", 20),
+    "buildsPWDmatrix": ("2D", 10),
+}
+
+# memory used by a worker process before running any task, in MB
+workerOverhead = 500
+
+# resources reserved by the tasks of each stage, set by daskCluster when the client is created
+taskResources = {}
+
+# addresses of the workers with a local copy of each file, by file name
+fileLocations = {}
+
+
+def readsAvailableMemory():
+    """
+    returns the memory available for new processes in MB, from /proc/meminfo
+
+    """
+    memInfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":")
+            memInfo[key] = int(value.split()[0])  # in kB
+
+    if "MemAvailable" in memInfo.keys():
+        return memInfo["MemAvailable"] / 1024
+    else:
+        # kernels older than 3.14
+        return (memInfo["MemFree"] + memInfo["Buffers"] + memInfo["Cached"]) / 1024
+
+
+def readsTIFFshape(fileName):
+    """
+    returns the shape and dtype of the image in a TIFF file, reading only its header
+
+    """
+    import tifffile
+
+    with tifffile.TiffFile(fileName) as tif:
+        series = tif.series[0]
+        return series.shape, series.dtype
+
+
+def estimatesTaskMemory(rootFolder, ext="tif"):
+    """
+    Estimates the memory needed by a task of each stage from the header of the largest image in rootFolder
+
+    Parameters
+    ----------
+    rootFolder : string
+    ext : string, optional
+        File extension. The default is 'tif'.
+
+    Returns
+    -------
+    taskMemory : dict
+        memory in MB for each stage of taskMemoryModel. Empty if no image was found.
+
+    """
+    fileName = getsManifest(rootFolder, extension=ext).getsLargestFile()
+    if fileName is None:
+        return {}
+
+    try:
+        shape, _ = readsTIFFshape(fileName)
+    except Exception as e:
+        print("Could not read TIFF header of {}: {}".format(fileName, e))
+        return {}
+
+    # a 2D file has the shape of its projection
+    shape3D = tuple(shape[-3:]) if len(shape) > 2 else (1,) + tuple(shape)
+    arrayMemory = {"3D": np.prod(shape3D) * 8 / 2 ** 20, "2D": np.prod(shape3D[1:]) * 8 / 2 ** 20}
+    print("Largest image: {} with shape {}".format(os.path.basename(fileName), shape))
+
+    return {
+        stage: int(workerOverhead + factor * arrayMemory[kind]) for stage, (kind, factor) in taskMemoryModel.items()
+    }
+
+
+def getsTaskResources(stage):
+    """
+    returns the resources to reserve for a task of a stage in client.submit, None if the cluster
+    was not created with resources
+
+    """
+    if stage in taskResources.keys():
+        return taskResources[stage]
+    else:
+        return None
+
+
+def setsTaskResources(taskMemory, workerMemory):
+    """
+    sets the memory reserved by the tasks of each stage, capped at the memory of a worker
+    so that no task waits forever
+
+    """
+    taskResources.clear()
+    for stage, memory in taskMemory.items():
+        taskResources[stage] = {"memory": int(np.min([memory, workerMemory]))}
+
+
+# =============================================================================
+# DATA LOCALITY
+# =============================================================================
+
+
+def getsClusterParameters(param):
+    """
+    returns the scheduler address and local scratch folder of the "cluster" section of the parameters file
+
+    """
+    schedulerAddress, localScratch = "", ""
+    if "cluster" in param.param.keys():
+        if "schedulerAddress" in param.param["cluster"].keys():
+            schedulerAddress = param.param["cluster"]["schedulerAddress"]
+        if "localScratch" in param.param["cluster"].keys():
+            localScratch = param.param["cluster"]["localScratch"]
+
+    return schedulerAddress, localScratch
+
+
+def listsLocalFiles(localScratch):
+    """
+    returns the TIFF files in the local scratch folder of the node running this function
+
+    """
+    return [os.path.basename(x) for x in glob.glob(localScratch + os.sep + "*.tif")]
+
+
+def locatesFiles(client, localScratch):
+    """
+    asks every worker which files it has in its local scratch folder and fills fileLocations
+
+    """
+    fileLocations.clear()
+    if len(localScratch) == 0:
+        return
+
+    for worker, fileNames in client.run(listsLocalFiles, localScratch).items():
+        for fileName in fileNames:
+            fileLocations.setdefault(fileName, []).append(worker)
+
+    print("Found local copies of {} files in {}".format(len(fileLocations), localScratch))
+
+
+def getsTaskPlacement(fileNames):
+    """
+    returns the keyword arguments of client.submit that send a task reading fileNames to the
+    workers holding most of them in their local scratch. Other workers can still run the task
+    if those are busy.
+
+    """
+    counts = {}
+    for fileName in fileNames:
+        for worker in fileLocations.get(os.path.basename(fileName), []):
+            counts[worker] = counts.get(worker, 0) + 1
+
+    if len(counts) == 0:
+        return {}
+
+    maxCount = max(counts.values())
+    return {"workers": sorted([x for x in counts if counts[x] == maxCount]), "allow_other_workers": True}
+
+
+def getsLocalFileName(fileName, param):
+    """
+    returns the copy of fileName in the local scratch folder of this node if it is complete,
+    fileName otherwise
+
+    """
+    _, localScratch = getsClusterParameters(param)
+    if len(localScratch) > 0:
+        localFileName = localScratch + os.sep + os.path.basename(fileName)
+        if os.path.exists(localFileName) and os.path.getsize(localFileName) == os.path.getsize(fileName):
+            return localFileName
+
+    return fileName
+
+
+# =============================================================================
+# ROI CONTAINERS
+# =============================================================================
+
+# 2D intermediates of the stages, named <root of the TIFF file><suffix>.npy
+intermediateSuffixes = ["_2d_registered", "_2d", "_rmsBlockMap", "_errorAlignmentBlockMap", "_Masks"]
+
+containerPrefix = "HiM_ROI"
+
+# names of the datasets of each container, with the modification time they were read at
+containerIndexes = {}
+
+# containers of each folder, with the modification time of the folder they were listed at
+containerListings = {}
+
+
+def getsContainerParameters(param):
+    """
+    returns the parameters of the "io" section of the parameters file used by ROI containers
+
+    """
+    containerParameters = {"intermediates": "npy", "intermediatesFloat32": True, "intermediatesCompression": "gzip"}
+    if hasattr(param, "param") and "io" in param.param.keys():
+        for key in containerParameters.keys():
+            if key in param.param["io"].keys():
+                containerParameters[key] = param.param["io"][key]
+
+    return containerParameters
+
+
+def splitsIntermediateName(fileName):
+    # folder and dataset name of an intermediate file, e.g. zProject/scan_..._ch00_2d.npy
+    name = os.path.basename(fileName)
+    if name.endswith(".npy"):
+        name = name[: -len(".npy")]
+    return os.path.dirname(fileName), name
+
+
+def getsContainerName(fileName, param):
+    """
+    returns the container of the ROI of an intermediate file, None if its ROI cannot be decoded
+    or param is not a Parameters instance
+
+    """
+    if not hasattr(param, "decodesFileParts"):
+        return None
+
+    folder, name = splitsIntermediateName(fileName)
+    for suffix in intermediateSuffixes:
+        if name.endswith(suffix):
+            fileParts = param.decodesFileParts(name[: -len(suffix)] + ".tif")
+            if fileParts and "roi" in fileParts:
+                return folder + os.sep + containerPrefix + fileParts["roi"] + ".h5"
+
+    return None
+
+
+class lockedContainer:
+    """
+    opens an HDF5 container holding a lock on <container>.lock: shared to read, exclusive to write,
+    so that processes of a cluster can write the intermediates of a ROI to the same container
+
+    """
+
+    def __init__(self, containerName, mode="r"):
+        self.containerName = containerName
+        self.mode = mode
+
+    def __enter__(self):
+        import fcntl
+        import h5py
+
+        self.lockFile = open(self.containerName + ".lock", "a")
+        fcntl.flock(self.lockFile, fcntl.LOCK_SH if self.mode == "r" else fcntl.LOCK_EX)
+        try:
+            # the lock above replaces the file locking of HDF5, unreliable on network file systems
+            self.container = h5py.File(self.containerName, self.mode, locking=False)
+        except TypeError:
+            self.container = h5py.File(self.containerName, self.mode)
+        return self.container
+
+    def __exit__(self, *args):
+        self.container.close()
+        self.lockFile.close()
+
+
+def readsContainerIndex(containerName):
+    """
+    returns the names of the datasets of a container, read again only if it was modified
+
+    """
+    mtime = os.stat(containerName).st_mtime_ns
+    if containerName not in containerIndexes or containerIndexes[containerName][0] != mtime:
+        with lockedContainer(containerName) as container:
+            containerIndexes[containerName] = (mtime, set(container.keys()))
+
+    return containerIndexes[containerName][1]
+
+
+def listsContainers(folder):
+    """
+    returns the containers of folder, listed again only if a file was added to or removed from it
+
+    """
+    if not os.path.isdir(folder):
+        return []
+
+    mtime = os.stat(folder).st_mtime_ns
+    if folder not in containerListings or containerListings[folder][0] != mtime:
+        containerListings[folder] = (mtime, sorted(glob.glob(folder + os.sep + containerPrefix + "*.h5")))
+
+    return containerListings[folder][1]
+
+
+def findsIntermediate(fileName, param=None):
+    """
+    returns the container holding the intermediate fileName, None if there is none
+
+    With param, only the container of the ROI decoded from fileName is searched (see
+    getsContainerName). Otherwise, or if the ROI cannot be decoded, all the containers of
+    its folder are.
+
+    """
+    folder, name = splitsIntermediateName(fileName)
+    containerName = getsContainerName(fileName, param)
+    if containerName is not None:
+        containerNames = [containerName] if os.path.exists(containerName) else []
+    else:
+        containerNames = listsContainers(folder)
+
+    for containerName in containerNames:
+        if name in readsContainerIndex(containerName):
+            return containerName
+
+    return None
+
+
+def existsIntermediate(fileName, param=None):
+    return os.path.exists(fileName) or findsIntermediate(fileName, param) is not None
+
+
+def savesIntermediate(data, fileName, param):
+    """
+    Saves an intermediate in the container of its ROI, if set by "intermediates" in the "io"
+    section of the parameters file
+
+    Parameters
+    ----------
+    data : npy array
+    fileName : string
+        name of the .npy file of the intermediate.
+    param : Parameters Class
+
+    Returns
+    -------
+    containerName : string
+        None if the intermediate has to be saved as a .npy file.
+
+    """
+    containerParameters = getsContainerParameters(param)
+    if containerParameters["intermediates"] != "hdf5":
+        return None
+
+    containerName = getsContainerName(fileName, param)
+    if containerName is None:
+        return None
+
+    data = np.asarray(data)
+    if containerParameters["intermediatesFloat32"] and data.dtype == np.float64:
+        data = data.astype(np.float32)
+    compression = containerParameters["intermediatesCompression"] or None
+
+    _, name = splitsIntermediateName(fileName)
+    with lockedContainer(containerName, "a") as container:
+        if name in container and (container[name].shape != data.shape or container[name].dtype != data.dtype):
+            del container[name]
+
+        if name in container:
+            container[name][...] = data
+        else:
+            container.create_dataset(name, data=data, compression=compression)
+
+        container[name].attrs["mtime_ns"] = time.time_ns()
+        container[name].attrs["checksum"] = hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()
+
+    # a .npy file of a previous run would hide the new intermediate
+    if os.path.exists(fileName):
+        os.remove(fileName)
+
+    return containerName
+
+
+def loadsIntermediate(fileName, param=None):
+    """
+    returns the intermediate fileName, from its .npy file or from the container of its ROI.
+    param, if given, is used to find the container from the ROI of fileName.
+
+    """
+    if os.path.exists(fileName):
+        return np.load(fileName)
+
+    containerName = findsIntermediate(fileName, param)
+    if containerName is None:
+        raise FileNotFoundError("Intermediate not found: {}".format(fileName))
+
+    _, name = splitsIntermediateName(fileName)
+    with lockedContainer(containerName) as container:
+        return container[name][...]
+
+
+def loadsIntermediates(fileNames):
+    """
+    returns a dict with the intermediates of fileNames, reading each container once
+
+    """
+    data, inContainers = {}, {}
+    for fileName in fileNames:
+        if os.path.exists(fileName):
+            data[fileName] = np.load(fileName)
+        else:
+            inContainers.setdefault(findsIntermediate(fileName), []).append(fileName)
+
+    if None in inContainers:
+        raise FileNotFoundError("Intermediates not found: {}".format(inContainers[None]))
+
+    for containerName, fileNamesContainer in inContainers.items():
+        with lockedContainer(containerName) as container:
+            for fileName in fileNamesContainer:
+                data[fileName] = container[splitsIntermediateName(fileName)[1]][...]
+
+    return data
+
+
+def listsIntermediates(folder, suffix):
+    """
+    returns the names of the .npy files of the intermediates of folder ending with suffix,
+    whether they are stored as .npy files or in containers
+
+    """
+    fileNames = set(glob.glob(folder + os.sep + "*" + suffix + ".npy"))
+    for containerName in listsContainers(folder):
+        fileNames.update([folder + os.sep + x + ".npy" for x in readsContainerIndex(containerName) if x.endswith(suffix)])
+
+    return sorted(fileNames)
+
+
+def readsIntermediateAttributes(fileName):
+    # write time and checksum of an intermediate stored in a container, None if there is none
+    containerName = findsIntermediate(fileName)
+    if containerName is None:
+        return None
+
+    with lockedContainer(containerName) as container:
+        attributes = container[splitsIntermediateName(fileName)[1]].attrs
+        return int(attributes["mtime_ns"]), str(attributes["checksum"])
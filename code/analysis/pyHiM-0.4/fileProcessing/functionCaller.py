@@ -8,20 +8,63 @@ Created on Tue Sep 22 15:26:00 2020
 
 
 import os
+import copy
+import time
 import argparse
+import importlib
 from datetime import datetime
 
-from dask.distributed import Client, LocalCluster, get_client, as_completed, fire_and_forget
-
 from fileProcessing.fileManagement import daskCluster, writeString2File, log, session, retrieveNumberUniqueBarcodesRootFolder
+from fileProcessing.fileManagement import estimatesTaskMemory, getsTaskResources, getsClusterParameters
+from fileProcessing.fileManagement import Parameters
+from fileProcessing.taskGraph import taskGraph
+from fileProcessing.profiling import initializesProfile
+from fileProcessing.streaming import folderWatcher
+
+# module and function implementing each stage. Stage modules pull in heavy libraries
+# (dask.distributed, photutils, astropy, OpenCV, scikit-learn...) so they are only
+# imported by loadsStage() when a stage actually runs, keeping the startup of the CLI fast.
+# Optional backends (StarDist/TensorFlow) are imported inside the method that uses them.
+stageFunctions = {
+    "makeProjections": ("imageProcessing.makeProjections", "makeProjections"),
+    "alignImages": ("imageProcessing.alignImages", "alignImages"),
+    "appliesRegistrations": ("imageProcessing.alignImages", "appliesRegistrations"),
+    "segmentMasks": ("imageProcessing.segmentMasks", "segmentMasks"),
+    "projectsBarcodes": ("imageProcessing.projectsBarcodes", "projectsBarcodes"),
+    "refitBarcodes": ("imageProcessing.refitBarcodes3D", "refitBarcodesClass"),
+    "localDriftCorrection": ("imageProcessing.localDriftCorrection", "localDriftCorrection"),
+    "processesPWDmatrices": ("matrixOperations.alignBarcodesMasks", "processesPWDmatrices"),
+}
+
+# stages run for each label, in the order they were run sequentially, together with the
+# stages they need to wait for. A label of None refers to the label of the stage itself.
+stageDependencies = {
+    "makeProjections": [],
+    "alignImages": [(None, "makeProjections")],
+    "appliesRegistrations": [(None, "makeProjections"), ("fiducial", "alignImages")],
+    "segmentMasks": [(None, "appliesRegistrations")],
+    "projectsBarcodes": [(None, "appliesRegistrations")],
+    "refitBarcodes": [(None, "segmentMasks")],
+    "localDriftCorrection": [(None, "segmentMasks"), ("fiducial", "alignImages")],
+    "processesPWDmatrices": [
+        (None, "localDriftCorrection"),
+        ("barcode", "segmentMasks"),
+        ("barcode", "refitBarcodes"),
+    ],
+}
+
+# stages run on the files released by each wave of streaming mode
+streamingStages = ["makeProjections", "alignImages", "appliesRegistrations", "segmentMasks"]
+
 
-from imageProcessing.alignImages import alignImages, appliesRegistrations
-from imageProcessing.makeProjections import makeProjections
-from imageProcessing.segmentMasks import segmentMasks
-from imageProcessing.localDriftCorrection import localDriftCorrection
-from imageProcessing.projectsBarcodes import projectsBarcodes
-from matrixOperations.alignBarcodesMasks import processesPWDmatrices
-from imageProcessing.refitBarcodes3D import refitBarcodesClass
+def loadsStage(stage):
+    """
+    imports the module of a stage and returns the function (or class) implementing it.
+    Modules are cached by importlib, so only the first call of a stage pays the import.
+
+    """
+    moduleName, functionName = stageFunctions[stage]
+    return getattr(importlib.import_module(moduleName), functionName)
 
 
 class HiMfunctionCaller:
@@ -40,7 +83,7 @@ class HiMfunctionCaller:
             {"label": "RNA", "parameterFile": "infoList_RNA.json"},
         ]
         
-        self.session1 = session(self.rootFolder, self.sessionName)
+        self.session1 = session(self.rootFolder, self.sessionName, resume=runParameters["resume"])
           
     def initialize(self):
 
@@ -60,6 +103,9 @@ class HiMfunctionCaller:
         writeString2File(
             self.log1.fileNameMD, "# Hi-M analysis {}".format(begin_time.strftime("%Y/%m/%d %H:%M:%S")), "w",
         )  # initialises MD file
+
+        # removes the task records of previous runs, unless resuming one
+        initializesProfile(self.rootFolder, resume=self.runParameters["resume"])
         
         
     def lauchDaskScheduler(self):
@@ -67,88 +113,196 @@ class HiMfunctionCaller:
             parametersFile = self.rootFolder + os.sep + self.labels2Process[0]["parameterFile"]
             numberUniqueCycles = retrieveNumberUniqueBarcodesRootFolder(self.rootFolder,parametersFile)
             print("Found {} unique cycles in rootFolder".format(numberUniqueCycles))
-            self.daskClusterInstance = daskCluster(numberUniqueCycles)
-            print("Go to http://localhost:8787/status for information on progress...")
-            
-            self.cluster = LocalCluster(n_workers=self.daskClusterInstance.nThreads,
-                                # processes=True,
-                                # threads_per_worker=1,
-                                # memory_limit='2GB',
-                                # ip='tcp://localhost:8787',
-                                ) 
-            self.client = Client(self.cluster)
-            
-    def makeProjections(self,param):
-        if not self.runParameters["parallel"]:
-            makeProjections(param, self.log1, self.session1)
-        else:
-            result = self.client.submit(makeProjections,param, self.log1, self.session1)
-            _ = self.client.gather(result)
+
+            # sizes workers from the memory needed by the largest images
+            taskMemory = estimatesTaskMemory(self.rootFolder)
+            self.log1.report("Estimated memory per task (MB): {}".format(taskMemory))
+
+            # the scheduler address given in the command line has priority over the parameters file
+            schedulerAddress, localScratch = getsClusterParameters(Parameters(self.rootFolder, self.labels2Process[0]["parameterFile"]))
+            if self.runParameters["scheduler"] is not None:
+                schedulerAddress = self.runParameters["scheduler"]
+
+            self.daskClusterInstance = daskCluster(numberUniqueCycles, taskMemory=taskMemory, schedulerAddress=schedulerAddress)
+
+            if len(schedulerAddress) > 0:
+                self.log1.report("Connecting to dask scheduler: {}".format(schedulerAddress))
+                self.daskClusterInstance.connectsDistributedClient(localScratch)
+            else:
+                print("Go to http://localhost:8787/status for information on progress...")
+                self.daskClusterInstance.createDistributedClient()
+
+            self.cluster, self.client = self.daskClusterInstance.cluster, self.daskClusterInstance.client
+
+    def buildsTaskGraph(self):
+        """
+        Builds the graph with the stages to run for every label. Stages only wait for the
+        stages they need, so that independent labels can be processed concurrently.
+
+        Returns
+        -------
+        graph : taskGraph Class
+
+        """
+        graph = taskGraph(self.log1, parallel=self.parallel)
+        labelsInGraph = []
+
+        for ilabel, param in self.loadsParameters():
+            label = self.getLabel(ilabel)
+            labelsInGraph.append(label)
+
+            for stage, dependencies in stageDependencies.items():
+                taskDependencies = [
+                    self.getTaskName(label if dependencyLabel is None else dependencyLabel, dependencyStage)
+                    for dependencyLabel, dependencyStage in dependencies
+                    if dependencyLabel is None or dependencyLabel in labelsInGraph
+                ]
+                # each task gets its own copy of param as stages change it while they run
+                graph.addTask(
+                    self.getTaskName(label, stage),
+                    self.runsStage,
+                    args=(stage, copy.deepcopy(param), ilabel),
+                    dependencies=taskDependencies,
+                )
+
+        self.log1.addSimpleText("**Analyzing labels: {}**".format(", ".join(labelsInGraph)))
+
+        return graph
+
+    def loadsParameters(self):
+        """
+        returns the (ilabel, Parameters) of the labels with a parameters file in rootFolder
+
+        """
+        params = []
+        for ilabel in range(len(self.labels2Process)):
+            parameterFile = self.rootFolder + os.sep + self.labels2Process[ilabel]["parameterFile"]
+            if not os.path.exists(parameterFile):
+                self.log1.report("No parameters file found for label {}: {}".format(self.getLabel(ilabel), parameterFile), "Warning")
+                continue
+
+            # sets parameters
+            param = Parameters(self.rootFolder, self.labels2Process[ilabel]["parameterFile"])
+            param.param["parallel"] = self.parallel
+            params.append((ilabel, param))
+
+        return params
+
+    def runsTaskGraph(self):
+        graph = self.buildsTaskGraph()
+        return graph.run()
+
+    def runsStreaming(self):
+        """
+        Streaming mode: analyses the images while the microscope is still acquiring.
+
+        Polls rootFolder and runs the streamingStages on the files released by the
+        folderWatcher as they arrive. Files completed in a wave are skipped by the next
+        waves using the journal. Once no file arrived for streamTimeout seconds (or on Ctrl-C),
+        runs the task graph of all stages on the complete folder, which only processes the
+        files and stages not done during acquisition.
+
+        """
+        params = self.loadsParameters()
+        fiducialParams = [param for ilabel, param in params if self.getLabel(ilabel) == "fiducial"]
+        if len(fiducialParams) == 0:
+            self.log1.report("Streaming mode needs a parameters file for the fiducial label", "Error")
+            return self.runsTaskGraph()
+
+        watcher = folderWatcher(self.rootFolder, fiducialParams[0])
+        pollInterval, streamTimeout = self.runParameters["pollInterval"], self.runParameters["streamTimeout"]
+        self.log1.report("Streaming mode: polling {} every {} s".format(self.rootFolder, pollInterval))
+
+        lastFileTime = time.time()
+        try:
+            while time.time() - lastFileTime < streamTimeout:
+                if len(watcher.pollsFolder()) > 0:
+                    lastFileTime = time.time()
+
+                newFiles = watcher.releasesFiles()
+                if len(newFiles) > 0:
+                    self.log1.report("Streaming mode: processing {} new files".format(len(newFiles)))
+                    self.runsWave(params, watcher.released)
+                else:
+                    time.sleep(pollInterval)
+        except KeyboardInterrupt:
+            self.log1.report("Streaming mode interrupted, processing the files in rootFolder")
+
+        self.log1.report("Streaming mode finished, running all stages")
+        return self.runsTaskGraph()
+
+    def runsWave(self, params, filesReady):
+        for stage in streamingStages:
+            for ilabel, param in params:
+                param = copy.deepcopy(param)
+                param.filesReady = filesReady
+                getattr(self, stage)(param, ilabel)
+
+        # files completed in this wave are skipped by the next ones
+        self.session1.replaysJournal()
+        self.log1.flush()
+
+    def getTaskName(self, label, stage):
+        return "{}:{}".format(label, stage)
+
+    def runsStage(self, stage, param, ilabel):
+        """
+        Runs a stage for a label. When a run is resumed, the stage skips the files whose
+        journal records show their outputs on disk and unchanged, and processes the others.
+
+        """
+        getattr(self, stage)(param, ilabel)
+
+        # writes the lines logged during the stage, including those of the workers
+        self.log1.flush()
+
+    # Stage functions run in this process. In parallel mode they build their own list
+    # of per-file (or per-ROI) tasks and submit them to the cluster through get_client(),
+    # so that no worker is kept busy as a coordinator waiting for other workers.
+
+    def makeProjections(self, param, ilabel=None):
+        loadsStage("makeProjections")(param, self.log1, self.session1)
         
     def alignImages(self, param, ilabel):
         if self.getLabel(ilabel) == "fiducial" and param.param["acquisition"]["label"] == "fiducial":
             self.log1.report("Making image registrations, ilabel: {}, label: {}".format(ilabel, self.getLabel(ilabel)), "info")
-            if not self.parallel:
-                alignImages(param, self.log1, self.session1)        
-            else:
-                 result = self.client.submit(alignImages,param, self.log1, self.session1)
-                 _ = self.client.gather(result)
+            loadsStage("alignImages")(param, self.log1, self.session1)        
 
     def appliesRegistrations(self, param, ilabel):
         if self.getLabel(ilabel) != "fiducial" and param.param["acquisition"]["label"] != "fiducial":
             self.log1.report("Applying image registrations, ilabel: {}, label: {}".format(ilabel, self.getLabel(ilabel)), "info")
-
-            if not self.parallel:
-                appliesRegistrations(param, self.log1, self.session1)
-            else:
-                result = self.client.submit(appliesRegistrations,param, self.log1, self.session1)
-                _ = self.client.gather(result)
+            loadsStage("appliesRegistrations")(param, self.log1, self.session1)
 
     def segmentMasks(self, param, ilabel):
         if (self.getLabel(ilabel)!= "fiducial" and \
             param.param["acquisition"]["label"] != "fiducial" and \
             self.getLabel(ilabel)!= "RNA" and \
             param.param["acquisition"]["label"] != "RNA"):
-            if not self.parallel:
-                segmentMasks(param, self.log1, self.session1)
-            else:
-                result = self.client.submit(segmentMasks,param, self.log1, self.session1)
-                _ = self.client.gather(result)
+            loadsStage("segmentMasks")(param, self.log1, self.session1)
 
     def projectsBarcodes(self, param, ilabel):
         if self.getLabel(ilabel)== "barcode":
-            if not self.parallel:
-                projectsBarcodes(param, self.log1, self.session1)
-            else:
-                result = self.client.submit(projectsBarcodes,param, self.log1, self.session1)
-                _ = self.client.gather(result)
-
+            loadsStage("projectsBarcodes")(param, self.log1, self.session1)
                                 
     def refitBarcodes(self, param, ilabel):
         if self.getLabel(ilabel) == "barcode" and self.runParameters["refit"]:
-            fittingSession = refitBarcodesClass(param, self.log1, self.session1,parallel=self.parallel)
-            if not self.parallel:
-                fittingSession.refitFolders()            
-            else:
-                result = self.client.submit(fittingSession.refitFolders)
-                _ = self.client.gather(result)
+            fittingSession = loadsStage("refitBarcodes")(param, self.log1, self.session1,parallel=self.parallel)
+            fittingSession.refitFolders()            
                 
     def localDriftCorrection(self, param, ilabel):
         if self.getLabel(ilabel) == "DAPI" and self.runParameters["localAlignment"]:
-
-            if not self.parallel:
-                errorCode, _, _ = localDriftCorrection(param, self.log1, self.session1)                
-            else:
-                result = self.client.submit(localDriftCorrection,param, self.log1, self.session1)
-                errorCode, _, _ = self.client.gather(result)
+            errorCode, _, _ = loadsStage("localDriftCorrection")(param, self.log1, self.session1)                
 
     def processesPWDmatrices(self, param, ilabel):
         if self.getLabel(ilabel) == "DAPI":
+            processesPWDmatrices = loadsStage("processesPWDmatrices")
             if not self.parallel:
                 processesPWDmatrices(param, self.log1, self.session1)
             else:
-                result = self.client.submit(processesPWDmatrices,param, self.log1, self.session1)
-                a = self.client.gather(result)
+                # does not fan out, runs as a single task in the cluster
+                result = self.client.submit(processesPWDmatrices,param, self.log1, self.session1,
+                                            resources=getsTaskResources("buildsPWDmatrix"))
+                _ = self.client.gather(result)
                 
     def getLabel(self, ilabel):
         return self.labels2Process[ilabel]["label"]
@@ -159,6 +313,11 @@ def HiM_parseArguments():
     parser.add_argument("--parallel", help="Runs in parallel mode", action="store_true")
     parser.add_argument("--localAlignment", help="Runs localAlignment function", action="store_true")
     parser.add_argument("--refit", help="Refits barcode spots using a Gaussian axial fitting function.", action="store_true")
+    parser.add_argument("--scheduler", help="Address of a running dask scheduler to use instead of a local cluster, e.g. tcp://10.0.0.1:8786. Implies --parallel")
+    parser.add_argument("--resume", help="Resumes an interrupted run using the journal in rootFolder", action="store_true")
+    parser.add_argument("--stream", help="Processes images while they are acquired, polling rootFolder", action="store_true")
+    parser.add_argument("--pollInterval", help="Streaming mode: time between polls of rootFolder in s. Default: 60", type=float, default=60)
+    parser.add_argument("--streamTimeout", help="Streaming mode: time without new files after which acquisition is considered finished, in s. Default: 3600", type=float, default=3600)
     
     args = parser.parse_args()
 
@@ -169,11 +328,13 @@ def HiM_parseArguments():
     else:
         runParameters["rootFolder"] = '.' # os.getcwd()
        
-    if args.parallel:
-        runParameters["parallel"] = args.parallel
+    if args.parallel or args.scheduler:
+        runParameters["parallel"] = True
     else:
         runParameters["parallel"] = False
 
+    runParameters["scheduler"] = args.scheduler
+
     if args.localAlignment:
         runParameters["localAlignment"] = args.localAlignment
     else:
@@ -184,4 +345,17 @@ def HiM_parseArguments():
     else:
         runParameters["refit"] = False
 
+    if args.resume:
+        runParameters["resume"] = args.resume
+    else:
+        runParameters["resume"] = False
+
+    if args.stream:
+        runParameters["stream"] = args.stream
+    else:
+        runParameters["stream"] = False
+
+    runParameters["pollInterval"] = args.pollInterval
+    runParameters["streamTimeout"] = args.streamTimeout
+
     return runParameters
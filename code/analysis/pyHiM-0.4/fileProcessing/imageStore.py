@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov  4 14:02:37 2020
+
+@author: marcnol
+
+Chunked, compressed store for the raw 3D stacks, with reads of z ranges and xy crops.
+
+TIFF files are decoded as a whole by skimage.io.imread, even when a stage only needs a
+few planes (manual z-projections) or small tiles (3D refits). storeHiM_run.py converts the
+TIFF files of a folder into zarr arrays in <folder>/HiM_store, chunked in z and in xy tiles
+and compressed losslessly with zstd. readsImage() then only decodes the chunks overlapping
+the z range and crop requested.
+
+The store is used if "store" is set to "zarr" in the "io" section of the parameters file and
+the store of the file is up to date. Otherwise readsImage() reads the TIFF file, decoding only
+the pages of the z range requested when the file has one page per plane.
+
+zarr is an optional dependency, only imported when the store is used.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import shutil
+import numpy as np
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+storeFolderName = "HiM_store"
+
+
+def getsIOParameters(param):
+    """
+    returns the parameters of the "io" section of the parameters file, with their defaults
+
+    """
+    ioParameters = {
+        "store": "tiff",
+        "chunkZ": 4,
+        "chunkXY": 256,
+        "compressionLevel": 3,
+        "prefetchDepth": 2,
+        "prefetchMemory": 2000,
+    }
+    if hasattr(param, "param") and "io" in param.param.keys():
+        for key in ioParameters.keys():
+            if key in param.param["io"].keys():
+                ioParameters[key] = param.param["io"][key]
+
+    return ioParameters
+
+
+def getsStoreName(fileName):
+    return os.path.dirname(fileName) + os.sep + storeFolderName + os.sep + os.path.basename(fileName).split(".")[0] + ".zarr"
+
+
+def createsArray(storeName, shape, chunks, dtype, compressionLevel):
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+
+        compressor = BloscCodec(cname="zstd", clevel=compressionLevel, shuffle="bitshuffle")
+        return zarr.create_array(
+            storeName, shape=shape, chunks=chunks, dtype=dtype, compressors=compressor, overwrite=True
+        )
+    else:
+        from numcodecs import Blosc
+
+        compressor = Blosc(cname="zstd", clevel=compressionLevel, shuffle=Blosc.BITSHUFFLE)
+        return zarr.open_array(storeName, mode="w", shape=shape, chunks=chunks, dtype=dtype, compressor=compressor)
+
+
+def convertsImage(fileName, ioParameters, overwrite=False):
+    """
+    Converts a TIFF file into a zarr array in the store of its folder, a slab of planes at a time
+
+    Parameters
+    ----------
+    fileName : string
+    ioParameters : dict
+        see getsIOParameters.
+    overwrite : boolean, optional
+        converts the file even if its store is up to date. The default is False.
+
+    Returns
+    -------
+    storeName : string
+
+    """
+    import tifffile
+
+    storeName = getsStoreName(fileName)
+    if not overwrite and opensStore(fileName) is not None:
+        return storeName
+
+    os.makedirs(os.path.dirname(storeName), exist_ok=True)
+    stat = os.stat(fileName)
+    chunkZ, chunkXY = ioParameters["chunkZ"], ioParameters["chunkXY"]
+
+    with tifffile.TiffFile(fileName) as tif:
+        series = tif.series[0]
+        shape = tuple([x for x in series.shape if x > 1])
+        pagesPerPlane = len(shape) == 3 and len(series.pages) == shape[0]
+
+        # writes to a temporary store so that readers never open a partial one
+        temporaryName = storeName + ".{}.tmp".format(os.getpid())
+        chunks = (min(chunkZ, shape[0]),) + tuple([min(chunkXY, x) for x in shape[1:]]) if len(shape) == 3 else shape
+        array = createsArray(temporaryName, shape, chunks, series.dtype, ioParameters["compressionLevel"])
+
+        if pagesPerPlane:
+            # keeps at most one slab of planes in memory
+            for z0 in range(0, shape[0], chunks[0]):
+                z1 = min(z0 + chunks[0], shape[0])
+                array[z0:z1] = np.stack([series.pages[z].asarray() for z in range(z0, z1)])
+        else:
+            array[...] = series.asarray().reshape(shape)
+
+    array.attrs["source"] = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if os.path.exists(storeName):
+        shutil.rmtree(storeName)
+    os.replace(temporaryName, storeName)
+
+    return storeName
+
+
+def opensStore(fileName):
+    """
+    returns the zarr array of fileName if its store exists and was converted from the current
+    version of the file, None otherwise
+
+    """
+    storeName = getsStoreName(fileName)
+    if not os.path.exists(storeName):
+        return None
+
+    import zarr
+
+    array = zarr.open_array(storeName, mode="r")
+    stat = os.stat(fileName)
+    if array.attrs.get("source") != {"size": stat.st_size, "mtime": stat.st_mtime}:
+        return None
+
+    return array
+
+
+def readsShape(fileName, param):
+    """
+    returns the shape of the image of fileName, without reading it
+
+    """
+    if getsIOParameters(param)["store"] == "zarr":
+        array = opensStore(fileName)
+        if array is not None:
+            return array.shape
+
+    import tifffile
+
+    with tifffile.TiffFile(fileName) as tif:
+        return tuple([x for x in tif.series[0].shape if x > 1])
+
+
+def readsImage(fileName, param, zRange=None, crop=None, localFileName=None):
+    """
+    Reads a 3D image, or the part of it given by zRange and crop
+
+    Parameters
+    ----------
+    fileName : string
+    param : Parameters Class
+    zRange : tuple, optional
+        (zmin, zmax) of the planes to read, zmax excluded. The default is None: all planes.
+    crop : tuple, optional
+        ((ymin, ymax), (xmin, xmax)) of the region to read. The default is None: full planes.
+    localFileName : string, optional
+        copy of fileName to read the TIFF from, e.g. in local scratch. The default is None: fileName.
+
+    Returns
+    -------
+    data : npy array
+    shape : tuple
+        shape of the full image.
+
+    """
+    if localFileName is None:
+        localFileName = fileName
+
+    array = opensStore(fileName) if getsIOParameters(param)["store"] == "zarr" else None
+
+    if array is None and zRange is None and crop is None:
+        # full image, read as before
+        from skimage import io
+
+        data = io.imread(localFileName).squeeze()
+        return data, data.shape
+    elif array is not None and len(array.shape) != 3:
+        return array[...], array.shape
+
+    if array is not None:
+        shape = array.shape
+    else:
+        import tifffile
+
+        tif = tifffile.TiffFile(localFileName)
+        series = tif.series[0]
+        shape = tuple([x for x in series.shape if x > 1])
+
+    zmin, zmax = (0, shape[0]) if zRange is None else (max(0, zRange[0]), min(shape[0], zRange[1]))
+    (ymin, ymax), (xmin, xmax) = ((0, shape[1]), (0, shape[2])) if crop is None else crop
+
+    if array is not None:
+        # only decodes the chunks overlapping the region
+        data = array[zmin:zmax, ymin:ymax, xmin:xmax]
+    else:
+        with tif:
+            if len(series.pages) == shape[0]:
+                # one page per plane: only decodes the pages in zRange
+                data = np.stack([series.pages[z].asarray()[ymin:ymax, xmin:xmax] for z in range(zmin, zmax)])
+            else:
+                data = series.asarray().reshape(shape)[zmin:zmax, ymin:ymax, xmin:xmax]
+
+    return data, shape
+
+
+def readsPlanes(fileName, param, zRange=None, localFileName=None):
+    """
+    Yields the planes of a 3D image one at a time, so that only a few planes are in memory
+
+    Planes are read from the store a chunk of planes at a time, from the pages of the TIFF file
+    one at a time, or from a memory map of the TIFF file when its planes are not in separate
+    pages. Other files are read as a whole.
+
+    Parameters
+    ----------
+    fileName : string
+    param : Parameters Class
+    zRange : tuple, optional
+        (zmin, zmax) of the planes to read, zmax excluded. The default is None: all planes.
+    localFileName : string, optional
+        copy of fileName to read the TIFF from. The default is None: fileName.
+
+    Yields
+    ------
+    z : int
+        index of the plane in the image.
+    plane : npy array
+
+    """
+    if localFileName is None:
+        localFileName = fileName
+
+    array = opensStore(fileName) if getsIOParameters(param)["store"] == "zarr" else None
+
+    if array is not None:
+        shape = array.shape
+        zmin, zmax = (0, shape[0]) if zRange is None else (max(0, zRange[0]), min(shape[0], zRange[1]))
+        chunkZ = array.chunks[0]
+        for z0 in range(zmin, zmax, chunkZ):
+            slab = array[z0 : min(z0 + chunkZ, zmax)]
+            for i in range(slab.shape[0]):
+                yield z0 + i, slab[i]
+        return
+
+    import tifffile
+
+    with tifffile.TiffFile(localFileName) as tif:
+        series = tif.series[0]
+        shape = tuple([x for x in series.shape if x > 1])
+        zmin, zmax = (0, shape[0]) if zRange is None else (max(0, zRange[0]), min(shape[0], zRange[1]))
+
+        if len(series.pages) == shape[0]:
+            for z in range(zmin, zmax):
+                yield z, series.pages[z].asarray()
+            return
+
+        try:
+            # uncompressed, contiguous planes: pages of the file are only read when accessed
+            data = tifffile.memmap(localFileName, mode="r").reshape(shape)
+        except ValueError:
+            data = series.asarray().reshape(shape)
+
+        for z in range(zmin, zmax):
+            yield z, np.array(data[z])
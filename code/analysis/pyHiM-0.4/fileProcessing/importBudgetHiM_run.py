@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 30 10:12:45 2020
+
+@author: marcnol
+
+Checks the time needed to start pyHiM.py against a budget.
+
+Stage modules and their heavy dependencies (dask.distributed, photutils, astropy,
+OpenCV, StarDist/TensorFlow) are imported only when a stage runs, so importing the
+CLI should stay fast. This script imports the CLI in a fresh interpreter with
+python -X importtime, reports the slowest modules and fails if:
+    - the total import time is above the budget
+    - any of the forbidden modules was imported at startup
+
+In the command line, run as
+$ importBudgetHiM_run.py --budget 0.5 --top 15
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import sys
+import argparse
+import subprocess
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+forbiddenModules = [
+    "dask.distributed",
+    "tensorflow",
+    "stardist",
+    "csbdeep",
+    "photutils",
+    "astropy",
+    "cv2",
+    "sklearn",
+]
+
+
+def measuresImportTime(moduleName="fileProcessing.functionCaller"):
+    """
+    imports moduleName in a new interpreter and returns the import times reported by -X importtime
+
+    Returns
+    -------
+    importTimes : list of tuples
+        (module, self time in s, cumulative time in s, nesting level), in import order.
+
+    """
+    pyHiMfolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(moduleName)],
+        cwd=pyHiMfolder,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+
+    importTimes = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        selfTime, cumulativeTime, module = line[len("import time:") :].split("|")
+        # nested imports are indented by two spaces per level
+        level = (len(module) - len(module.lstrip()) - 1) // 2
+        importTimes.append((module.strip(), int(selfTime) / 1e6, int(cumulativeTime) / 1e6, level))
+
+    return importTimes
+
+
+def checksImportBudget(importTimes, budget, top=10):
+    """
+    prints the slowest modules and returns the list of violations of the budget
+
+    """
+    # cumulative times of the top level imports add up to the total
+    totalTime = sum([x[2] for x in importTimes if x[3] == 0])
+    print("Total import time: {:.3f} s (budget: {:.3f} s)".format(totalTime, budget))
+
+    print("\nSlowest modules (cumulative time):")
+    for module, _, cumulativeTime, _ in sorted(importTimes, key=lambda x: x[2], reverse=True)[:top]:
+        print("{:>8.3f} s  {}".format(cumulativeTime, module))
+
+    violations = []
+    if totalTime > budget:
+        violations.append("total import time {:.3f} s above budget of {:.3f} s".format(totalTime, budget))
+
+    modules = set([x[0] for x in importTimes])
+    for forbiddenModule in forbiddenModules:
+        if forbiddenModule in modules:
+            violations.append("{} imported at startup".format(forbiddenModule))
+
+    return violations
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", help="Maximum import time in s, default: 0.5", type=float, default=0.5)
+    parser.add_argument("--top", help="Number of modules to report, default: 10", type=int, default=10)
+    parser.add_argument(
+        "--module", help="Module to import, default: fileProcessing.functionCaller", default="fileProcessing.functionCaller"
+    )
+
+    args = parser.parse_args()
+
+    violations = checksImportBudget(measuresImportTime(args.module), args.budget, top=args.top)
+
+    if len(violations) > 0:
+        print("\nImport budget FAILED:\n  " + "\n  ".join(violations))
+        sys.exit(1)
+    else:
+        print("\nImport budget OK")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Nov  5 09:12:50 2020
+
+@author: marcnol
+
+Read-ahead of the files of a loop, so that the next files are read from disk while the
+current one is processed.
+
+prefetcher reads the next "prefetchDepth" items of a list in a pool of threads and yields
+them in order. Reads are started only while the files being read or waiting to be processed
+add up to less than "prefetchMemory" MB, so that a few large stacks do not fill the memory.
+Both are set in the "io" section of the parameters file.
+
+Reads release the GIL while waiting for the disk (or NFS server) and while decoding
+compressed files, so threads are enough to overlap them with computation.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fileProcessing.imageStore import getsIOParameters
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+class prefetcher:
+    def __init__(self, items, loader, depth=2, memoryCap=2000, sizer=None):
+        """
+        Parameters
+        ----------
+        items : list
+            items to load, in the order they are processed, e.g. file names.
+        loader : callable
+            loader(item) returns the data of item.
+        depth : int, optional
+            number of items read ahead of the one processed. 0 reads items when they are
+            needed. The default is 2.
+        memoryCap : float, optional
+            maximum memory in MB of the items read ahead and of the one processed. One item
+            is always read, even if larger. The default is 2000.
+        sizer : callable, optional
+            sizer(item) returns the memory in bytes needed by item. The default is None: the
+            size of the file item, 0 if it is not a file.
+
+        """
+        self.items = list(items)
+        self.loader = loader
+        self.depth = max(0, int(depth))
+        self.memoryCap = memoryCap * 1e6
+        self.sizer = sizer if sizer is not None else getsFileSize
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        """
+        yields (item, data) in the order of items. Errors of loader are raised when their item is reached.
+
+        """
+        if self.depth == 0 or len(self.items) < 2:
+            for item in self.items:
+                yield item, self.loader(item)
+            return
+
+        pending = deque()  # (item, future, size) of the items read ahead
+        nextItem, memoryUsed = 0, 0
+
+        executor = ThreadPoolExecutor(max_workers=self.depth)
+        try:
+            for _ in range(len(self.items)):
+                # reads ahead within the depth and the memory cap
+                while nextItem < len(self.items) and len(pending) <= self.depth:
+                    size = self.sizer(self.items[nextItem])
+                    if len(pending) > 0 and memoryUsed + size > self.memoryCap:
+                        break
+                    pending.append((self.items[nextItem], executor.submit(self.loader, self.items[nextItem]), size))
+                    memoryUsed += size
+                    nextItem += 1
+
+                item, future, size = pending.popleft()
+                data = future.result()
+                del future
+                yield item, data
+
+                # the caller is done with item when it asks for the next one
+                del data
+                memoryUsed -= size
+        finally:
+            # the loop was left early: drops the reads not started
+            for _, future, _ in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def getsFileSize(item):
+    if isinstance(item, str) and os.path.isfile(item):
+        return os.path.getsize(item)
+    else:
+        return 0
+
+
+def prefetches(items, loader, param, sizer=None):
+    """
+    returns a prefetcher of items with the depth and memory cap of the "io" section of the parameters file
+
+    """
+    ioParameters = getsIOParameters(param)
+
+    return prefetcher(
+        items, loader, depth=ioParameters["prefetchDepth"], memoryCap=ioParameters["prefetchMemory"], sizer=sizer
+    )
+
+
+def warmsFile(fileName, blockSize=8 * 2 ** 20):
+    """
+    reads fileName by blocks and discards them, so that the next reads of the file are served
+    from the page cache of the system instead of the disk
+
+    """
+    if not isinstance(fileName, str) or not os.path.isfile(fileName):
+        return
+
+    with open(fileName, "rb", buffering=0) as f:
+        while f.read(blockSize):
+            pass
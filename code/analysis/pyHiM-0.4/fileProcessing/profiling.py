@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 28 09:51:40 2020
+
+@author: marcnol
+
+Instrumentation of the tasks of the pipeline.
+
+Functions decorated with profilesTask(stage) record for every call:
+    - wall time and CPU time of the thread running the task
+    - resident memory of the process sampled while the task ran: its peak and its
+      increase over the value at the start of the task. Other tasks running as threads
+      of the same worker contribute to it, as memory is not accounted per thread.
+    - bytes read from and written to storage by the thread running the task
+
+Records are appended to one file per process in <rootFolder>/HiM_profile, so that
+dask workers do not need to send them back. The log passed to the task is flushed when
+the task finishes. At the end of the run mergesProfiles()
+aggregates them per stage into HiM_profile.json and adds a summary table to the
+Markdown report. A resumed run keeps the records of the interrupted one.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import glob
+import json
+import time
+import socket
+import shutil
+import functools
+import threading
+from datetime import datetime
+
+from fileProcessing.fileManagement import folders, Parameters, log, saveJSON, writeString2File
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+profileFolderName = "HiM_profile"
+
+
+def readsIOcounters():
+    """
+    returns the bytes read and written to storage by the calling thread, from
+    /proc/thread-self/io. Falls back to the counters of the process if the kernel does
+    not provide them per thread.
+
+    """
+    counters = {"read_bytes": 0, "write_bytes": 0}
+    for fileName in ["/proc/thread-self/io", "/proc/self/task/{}/io".format(threading.get_native_id()), "/proc/self/io"]:
+        try:
+            with open(fileName) as f:
+                for line in f:
+                    key, value = line.split(":")
+                    if key in counters:
+                        counters[key] = int(value)
+            break
+        except (OSError, ValueError):
+            continue
+
+    return counters
+
+
+def readsRSS():
+    """
+    returns the resident memory of this process in bytes, from /proc/self/statm
+
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class memorySampler:
+    """
+    samples the resident memory of the process in a background thread while a task runs
+
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.startRSS = readsRSS()
+        self.peakRSS = self.startRSS
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.samples, daemon=True)
+        self.thread.start()
+
+    def samples(self):
+        while not self.stopEvent.wait(self.interval):
+            self.peakRSS = max(self.peakRSS, readsRSS())
+
+    def stops(self):
+        self.stopEvent.set()
+        self.thread.join()
+        self.peakRSS = max(self.peakRSS, readsRSS())
+
+        return self.peakRSS, self.peakRSS - self.startRSS
+
+
+def findsRootFolder(args, kwargs):
+    """
+    finds the rootFolder of the run in the arguments of a task: either a folders or
+    Parameters instance, or an object holding them as dataFolder or param (for methods)
+
+    """
+    for arg in list(args) + list(kwargs.values()):
+        if isinstance(arg, folders):
+            return arg.masterFolder
+        elif isinstance(arg, Parameters):
+            return arg.param["rootFolder"]
+        elif isinstance(getattr(arg, "dataFolder", None), folders):
+            return arg.dataFolder.masterFolder
+        elif isinstance(getattr(arg, "param", None), Parameters):
+            return arg.param.param["rootFolder"]
+
+    return None
+
+
+def findsLog(args, kwargs):
+    """
+    finds the log in the arguments of a task, or held as log1 by an object (for methods)
+
+    """
+    for arg in list(args) + list(kwargs.values()):
+        if isinstance(arg, log):
+            return arg
+        elif isinstance(getattr(arg, "log1", None), log):
+            return arg.log1
+
+    return None
+
+
+def profilesTask(stage):
+    """
+    Decorator that records the resources used by each call of a task of a stage
+
+    Parameters
+    ----------
+    stage : string
+        name under which the records of the task are aggregated.
+
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rootFolder = findsRootFolder(args, kwargs)
+            if rootFolder is None:
+                return function(*args, **kwargs)
+
+            item = [x for x in args if isinstance(x, str)]
+            status = "failed"
+            IObefore, startTime = readsIOcounters(), datetime.now()
+            sampler = memorySampler()
+            wallBefore, cpuBefore = time.perf_counter(), time.thread_time()
+            try:
+                result = function(*args, **kwargs)
+                status = "done"
+            finally:
+                wallTime, cpuTime = time.perf_counter() - wallBefore, time.thread_time() - cpuBefore
+                IOafter = readsIOcounters()
+                peakRSS, increaseRSS = sampler.stops()
+                record = {
+                    "stage": stage,
+                    "item": os.path.basename(item[0]) if len(item) > 0 else "",
+                    "status": status,
+                    "start": startTime.strftime("%Y/%m/%d %H:%M:%S"),
+                    "wallTime": wallTime,
+                    "cpuTime": cpuTime,
+                    "peakRSS_MB": peakRSS / 2 ** 20,
+                    "increaseRSS_MB": increaseRSS / 2 ** 20,
+                    "bytesRead": IOafter["read_bytes"] - IObefore["read_bytes"],
+                    "bytesWritten": IOafter["write_bytes"] - IObefore["write_bytes"],
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                }
+                savesRecord(rootFolder, record)
+
+                # writes the lines logged by the task in one go
+                log1 = findsLog(args, kwargs)
+                if log1 is not None:
+                    log1.flush()
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def savesRecord(rootFolder, record):
+    profileFolder = rootFolder + os.sep + profileFolderName
+    if not os.path.exists(profileFolder):
+        os.makedirs(profileFolder, exist_ok=True)
+
+    shardFileName = profileFolder + os.sep + "{}_{}.jsonl".format(record["host"], record["pid"])
+    writeString2File(shardFileName, json.dumps(record), "a")
+
+
+def initializesProfile(rootFolder, resume=False):
+    """
+    removes the records of a previous run, unless the run is resumed
+
+    """
+    if resume:
+        return
+
+    profileFolder = rootFolder + os.sep + profileFolderName
+    if os.path.exists(profileFolder):
+        shutil.rmtree(profileFolder)
+
+    profileFileName = rootFolder + os.sep + "HiM_profile.json"
+    if os.path.exists(profileFileName):
+        os.remove(profileFileName)
+
+
+def mergesProfiles(rootFolder, log1):
+    """
+    Aggregates the records of all processes per stage, saves them to HiM_profile.json
+    and adds a summary table to the Markdown report. Records already in
+    HiM_profile.json (e.g. from the run a resumed run continues) are kept.
+
+    Parameters
+    ----------
+    rootFolder : string
+    log1 : log Class
+
+    Returns
+    -------
+    profile : dict
+        with the list of records ("tasks") and the summary per stage ("stages").
+
+    """
+    profileFileName = rootFolder + os.sep + "HiM_profile.json"
+    records = []
+    if os.path.exists(profileFileName):
+        with open(profileFileName) as f:
+            records += json.load(f).get("tasks", [])
+
+    for shardFileName in sorted(glob.glob(rootFolder + os.sep + profileFolderName + os.sep + "*.jsonl")):
+        with open(shardFileName) as f:
+            records += [json.loads(line) for line in f if len(line.strip()) > 0]
+
+    # records of shards that were already merged appear twice
+    uniqueRecords = {}
+    for record in records:
+        uniqueRecords.setdefault(json.dumps(record, sort_keys=True), record)
+    records = list(uniqueRecords.values())
+
+    stages = {}
+    for record in records:
+        if record["stage"] not in stages:
+            stages[record["stage"]] = {
+                "tasks": 0,
+                "failed": 0,
+                "wallTime": 0.0,
+                "maxWallTime": 0.0,
+                "cpuTime": 0.0,
+                "peakRSS_MB": 0.0,
+                "increaseRSS_MB": 0.0,
+                "bytesRead": 0,
+                "bytesWritten": 0,
+            }
+        summary = stages[record["stage"]]
+        summary["tasks"] += 1
+        summary["failed"] += int(record["status"] != "done")
+        summary["wallTime"] += record["wallTime"]
+        summary["maxWallTime"] = max(summary["maxWallTime"], record["wallTime"])
+        summary["cpuTime"] += record["cpuTime"]
+        summary["peakRSS_MB"] = max(summary["peakRSS_MB"], record["peakRSS_MB"])
+        summary["increaseRSS_MB"] = max(summary["increaseRSS_MB"], record.get("increaseRSS_MB", 0.0))
+        summary["bytesRead"] += record["bytesRead"]
+        summary["bytesWritten"] += record["bytesWritten"]
+
+    profile = {"tasks": records, "stages": stages}
+    saveJSON(profileFileName, profile)
+    log1.info("Saved profile of {} tasks to {}".format(len(records), profileFileName))
+
+    if len(stages) > 0:
+        table = [
+            "## Profile\n",
+            "| stage | tasks | failed | wall time (s) | mean (s) | max (s) | CPU time (s) | peak RSS (MB) | RSS increase (MB) | read (MB) | written (MB) |",
+            "|---|---|---|---|---|---|---|---|---|---|---|",
+        ]
+        for stage, summary in stages.items():
+            table.append(
+                "| {} | {} | {} | {:.1f} | {:.2f} | {:.2f} | {:.1f} | {:.0f} | {:.0f} | {:.1f} | {:.1f} |".format(
+                    stage,
+                    summary["tasks"],
+                    summary["failed"],
+                    summary["wallTime"],
+                    summary["wallTime"] / summary["tasks"],
+                    summary["maxWallTime"],
+                    summary["cpuTime"],
+                    summary["peakRSS_MB"],
+                    summary["increaseRSS_MB"],
+                    summary["bytesRead"] / 2 ** 20,
+                    summary["bytesWritten"] / 2 ** 20,
+                )
+            )
+        log1.addMarkdown("\n".join(table) + "\n")
+
+    return profile
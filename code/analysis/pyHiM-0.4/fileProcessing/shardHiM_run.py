@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Nov  3 10:26:41 2020
+
+@author: marcnol
+
+Runs the pipeline on each ROI of a rootFolder as an independent shard and merges the results.
+
+Every stage of pyHiM only needs the files of one ROI, except buildsPWDmatrix that collates the
+ROIs at the end. Shards are folders <rootFolder>/HiM_shards/ROI<roi> with links to the TIFF files
+of one ROI and copies of the parameter files, so that pyHiM.py can run on each of them as a
+separate process or cluster job. The merge step then writes into the output folders of rootFolder:
+    - the barcode and DAPI tables of segmentedObjects
+    - the shifts and alignment tables of alignImages, and the local alignment table
+    - the single cell PWD matrices of buildsPWDmatrix (2D and 3D), with the union of the barcodes
+      of all shards, the Nmatrix and the tables of every ROI, and their figures, linked in the
+      Markdown report HiM_merge<date>.md of rootFolder
+
+Masks, projections and the other figures stay in the shard folders.
+
+With --parallel, the shards run at the same time share one dask cluster sized for the whole
+machine, instead of each starting its own. --scheduler uses a running scheduler instead.
+
+In the command line, run as
+$ shardHiM_run.py -F rootFolder --jobs 4 --parallel
+
+or, to submit the shards as jobs:
+$ shardHiM_run.py -F rootFolder --split
+$ pyHiM.py -F rootFolder/HiM_shards/ROI001 (one job per shard)
+$ shardHiM_run.py -F rootFolder --merge
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import sys
+import glob
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+from astropy.table import vstack
+
+from fileManagement import Parameters, folders, log, daskCluster, saveJSON, loadJSON, writeString2File
+from fileManagement import getsManifest, estimatesTaskMemory, getsClusterParameters
+from spotTable import existsSpotTable, loadsSpotTable, savesSpotTable
+from figureQueue import queuesFigure, rendersFigures
+from matrixOperations.alignBarcodesMasks import plotsAllmatrices
+from matrixOperations.HIMmatrixOperations import plotDistanceHistograms
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+shardFolderName = "HiM_shards"
+
+parameterFiles = ["infoList_fiducial.json", "infoList_barcode.json", "infoList_DAPI.json", "infoList_RNA.json"]
+
+
+def loadsFirstParameters(rootFolder):
+    """
+    returns the Parameters of the first label with a parameters file in rootFolder
+
+    """
+    for parameterFile in parameterFiles:
+        if os.path.exists(rootFolder + os.sep + parameterFile):
+            return Parameters(rootFolder, parameterFile)
+
+    raise SystemExit("No parameters file found in {}".format(rootFolder))
+
+
+def getsShardFolder(rootFolder, ROI):
+    return rootFolder + os.sep + shardFolderName + os.sep + "ROI" + ROI
+
+
+def createsShards(rootFolder, ROIs=None):
+    """
+    Creates a shard folder for each ROI with links to its TIFF files and copies of the parameter files
+
+    Parameters
+    ----------
+    rootFolder : string
+    ROIs : list, optional
+        ROIs to shard, e.g. ['001', '003']. The default is None, which shards all the ROIs.
+
+    Returns
+    -------
+    shardFolders : dict
+        shard folder of each ROI.
+
+    """
+    param = loadsFirstParameters(rootFolder)
+
+    filesROI = {}
+    for fileName in sorted(glob.glob(rootFolder + os.sep + "*.tif")):
+        fileParts = param.decodesFileParts(os.path.basename(fileName))
+        if fileParts and (ROIs is None or fileParts["roi"] in ROIs):
+            filesROI.setdefault(fileParts["roi"], []).append(fileName)
+
+    shardFolders = {}
+    for ROI, fileNames in filesROI.items():
+        shardFolder = getsShardFolder(rootFolder, ROI)
+        if not os.path.exists(shardFolder):
+            os.makedirs(shardFolder)
+
+        for fileName in fileNames:
+            link = shardFolder + os.sep + os.path.basename(fileName)
+            if not os.path.lexists(link):
+                os.symlink(os.path.abspath(fileName), link)
+
+        for parameterFile in parameterFiles:
+            if os.path.exists(rootFolder + os.sep + parameterFile):
+                shutil.copy(rootFolder + os.sep + parameterFile, shardFolder)
+
+        shardFolders[ROI] = shardFolder
+        print("Shard for ROI {}: {} files in {}".format(ROI, len(fileNames), shardFolder))
+
+    return shardFolders
+
+
+def runsShard(shardFolder, pyHiMarguments):
+    """
+    runs pyHiM.py on a shard folder and returns its return code
+
+    """
+    pyHiMscript = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep + "pyHiM.py"
+    with open(shardFolder + os.sep + "HiM_shard.log", "w") as f:
+        return subprocess.call([sys.executable, pyHiMscript, "-F", shardFolder] + pyHiMarguments, stdout=f, stderr=subprocess.STDOUT)
+
+
+def startsSharedCluster(rootFolder, numberJobs):
+    """
+    Starts a local dask cluster for the shards that run at the same time. It is sized as
+    pyHiM.py sizes its own, for the cycles of numberJobs shards, so that the shards share
+    the cores and memory of the machine instead of each taking all of them.
+
+    Returns
+    -------
+    daskClusterInstance : daskCluster Class
+
+    """
+    param = loadsFirstParameters(rootFolder)
+    numberUniqueCycles = len(getsManifest(rootFolder, param).getsCycles())
+    daskClusterInstance = daskCluster(numberUniqueCycles * numberJobs, taskMemory=estimatesTaskMemory(rootFolder))
+    daskClusterInstance.createDistributedClient()
+    print("Shards share the dask scheduler {}".format(daskClusterInstance.cluster.scheduler_address))
+
+    return daskClusterInstance
+
+
+def runsShards(shardFolders, pyHiMarguments, numberJobs=1):
+    """
+    Runs pyHiM.py on the shards, numberJobs at a time
+
+    Returns
+    -------
+    failedROIs : list
+        ROIs for which pyHiM.py did not finish normally.
+
+    """
+    print("Running {} shards, {} at a time".format(len(shardFolders), numberJobs))
+
+    with ThreadPoolExecutor(max_workers=numberJobs) as executor:
+        returnCodes = dict(zip(shardFolders, executor.map(lambda x: runsShard(x, pyHiMarguments), shardFolders.values())))
+
+    for ROI, returnCode in returnCodes.items():
+        print("ROI {}: {}".format(ROI, "ok" if returnCode == 0 else "failed, see {}".format(shardFolders[ROI] + os.sep + "HiM_shard.log")))
+
+    return [ROI for ROI, returnCode in returnCodes.items() if returnCode != 0]
+
+
+def getsOutputFiles(folder, param):
+    """
+    returns the output folders and files of the stages in folder, creating the folders
+
+    """
+    dataFolder = folders(folder)
+    dataFolder.createsFolders(folder, param)
+    return dataFolder
+
+
+def mergesTables(fileNames, outputFileName, param=None):
+    """
+    concatenates the tables in fileNames that exist and writes them to outputFileName. Tables
+    of spots are written in the format set in param, other tables (param None) as ECSV.
+
+    """
+    tables = [loadsSpotTable(x) for x in fileNames if existsSpotTable(x)]
+    if len(tables) > 0:
+        if param is not None:
+            savesSpotTable(vstack(tables), outputFileName, param)
+        else:
+            vstack(tables).write(outputFileName, format="ascii.ecsv", overwrite=True)
+        print("Merged {} tables into {}".format(len(tables), outputFileName))
+
+
+def mergesPWDmatrices(shardOutputFileNames, outputFileName, param, logNameMD, localizationDimension=2):
+    """
+    Merges the single cell PWD matrices of the shards and queues their figures, as buildsPWDmatrix does
+
+    The barcodes of the merged matrix are the union of those of the shards. The distances
+    between barcodes missing in a shard are NaN for its cells.
+
+    Parameters
+    ----------
+    shardOutputFileNames : list
+        outputFileName used by buildsPWDmatrix in each shard, in the order of the ROIs.
+    outputFileName : string
+        outputFileName of buildsPWDmatrix in rootFolder.
+    param : Parameters Class
+        parameters of rootFolder.
+    logNameMD : string
+        Markdown report where the figures are linked.
+    localizationDimension : int, optional
+        2 or 3, dimension of the barcode localizations. The default is 2.
+
+    Returns
+    -------
+    numberCells : int
+
+    """
+    SCmatrices, barcodes, order = [], [], 0
+    for shardOutputFileName in shardOutputFileNames:
+        if not os.path.exists(shardOutputFileName + "_HiMscMatrix.npy"):
+            continue
+        SCmatrices.append(np.load(shardOutputFileName + "_HiMscMatrix.npy"))
+        barcodes.append(list(np.atleast_1d(np.loadtxt(shardOutputFileName + "_uniqueBarcodes.ecsv").astype(int))))
+
+        # tables of each ROI, renumbered in processing order
+        for fileName in sorted(glob.glob(shardOutputFileName + "_order:*_ROI:*.ecsv")):
+            ROI = fileName.split("_ROI:")[-1]
+            shutil.copy(fileName, outputFileName + "_order:" + str(order) + "_ROI:" + ROI)
+            order += 1
+
+    if len(SCmatrices) == 0:
+        return 0
+
+    uniqueBarcodes = sorted(set([x for shardBarcodes in barcodes for x in shardBarcodes]))
+    numberCells = sum([x.shape[2] for x in SCmatrices])
+    SCmatrixCollated = np.full((len(uniqueBarcodes), len(uniqueBarcodes), numberCells), np.nan)
+
+    firstCell = 0
+    for SCmatrix, shardBarcodes in zip(SCmatrices, barcodes):
+        index = [uniqueBarcodes.index(x) for x in shardBarcodes]
+        cells = np.arange(firstCell, firstCell + SCmatrix.shape[2])
+        SCmatrixCollated[np.ix_(index, index, cells)] = SCmatrix
+        firstCell += SCmatrix.shape[2]
+
+    # number of PWD distances for each barcode combination, as in calculatesNmatrix
+    Nmatrix = np.sum(~np.isnan(SCmatrixCollated), axis=2)
+
+    np.save(outputFileName + "_HiMscMatrix.npy", SCmatrixCollated)
+    np.savetxt(outputFileName + "_uniqueBarcodes.ecsv", uniqueBarcodes, delimiter=" ", fmt="%d")
+    np.save(outputFileName + "_Nmatrix.npy", Nmatrix)
+    print("Merged {} cells from {} shards into {}".format(numberCells, len(SCmatrices), outputFileName))
+
+    if "pixelSizeXY" in param.param["acquisition"].keys():
+        pixelSize = param.param["acquisition"]["pixelSizeXY"]
+    else:
+        pixelSize = 0.1
+
+    queuesFigure(
+        param,
+        plotsAllmatrices,
+        (SCmatrixCollated, Nmatrix, uniqueBarcodes, pixelSize, order, outputFileName, logNameMD, localizationDimension),
+        level="summary",
+    )
+    queuesFigure(
+        param,
+        plotDistanceHistograms,
+        (SCmatrixCollated, pixelSize, outputFileName, logNameMD),
+        kwargs={"mode": "KDE", "kernelWidth": 0.25, "optimizeKernelWidth": False},
+        level="full",
+    )
+
+    return numberCells
+
+
+def mergesShards(rootFolder, shardFolders):
+    """
+    Merges the outputs of the shards into the output folders of rootFolder
+
+    Parameters
+    ----------
+    rootFolder : string
+    shardFolders : dict
+        shard folder of each ROI.
+
+    Returns
+    -------
+    None.
+
+    """
+    param = loadsFirstParameters(rootFolder)
+    dataFolder = getsOutputFiles(rootFolder, param)
+    shards = [getsOutputFiles(shardFolders[ROI], param) for ROI in sorted(shardFolders)]
+
+    log1 = log(rootFolder=rootFolder, fileNameRoot="HiM_merge")
+    writeString2File(
+        log1.fileNameMD, "# Hi-M analysis, merge of {} shards {}".format(len(shards), datetime.now().strftime("%Y/%m/%d %H:%M:%S")), "w",
+    )
+
+    # segmentedObjects
+    for label in ["barcode", "DAPI", "RNA"]:
+        mergesTables(
+            [x.outputFiles["segmentedObjects"] + "_" + label + ".dat" for x in shards],
+            dataFolder.outputFiles["segmentedObjects"] + "_" + label + ".dat",
+            param,
+        )
+
+    # alignImages
+    dictShifts = {}
+    for shard in shards:
+        fileName = os.path.splitext(shard.outputFiles["dictShifts"])[0] + ".json"
+        if os.path.exists(fileName):
+            dictShifts.update(loadJSON(fileName))
+    if len(dictShifts) > 0:
+        saveJSON(os.path.splitext(dataFolder.outputFiles["dictShifts"])[0] + ".json", dictShifts)
+
+    lines = []
+    for shard in shards:
+        if os.path.exists(shard.outputFiles["alignImages"]):
+            with open(shard.outputFiles["alignImages"]) as f:
+                lines += [x.rstrip("\n") for x in f if len(x.strip()) > 0]
+    if len(lines) > 0:
+        writeString2File(dataFolder.outputFiles["alignImages"], "\n".join(lines), "w")
+
+    for ending in [".table", "_localAlignment.dat"]:
+        mergesTables(
+            [x.outputFiles["alignImages"].split(".")[0] + ending for x in shards],
+            dataFolder.outputFiles["alignImages"].split(".")[0] + ending,
+        )
+
+    # buildsPWDmatrix
+    log1.addMarkdown("## buildsPWDmatrix\n")
+    fileNameBarcodeCoordinates = dataFolder.outputFiles["segmentedObjects"] + "_barcode.dat"
+    if existsSpotTable(fileNameBarcodeCoordinates) and "zcentroidGauss" in loadsSpotTable(fileNameBarcodeCoordinates).keys():
+        localizationDimension3D = 3
+    else:
+        localizationDimension3D = 2
+
+    for ending, localizationDimension in zip(["", "_3D"], [2, localizationDimension3D]):
+        mergesPWDmatrices(
+            [x.outputFiles["buildsPWDmatrix"] + ending for x in shards],
+            dataFolder.outputFiles["buildsPWDmatrix"] + ending,
+            param,
+            log1.fileNameMD,
+            localizationDimension,
+        )
+
+    rendersFigures(rootFolder, log1)
+    log1.flush()
+
+
+def parsesROIs(string, rootFolder):
+    """
+    returns the ROIs of the comma separated list string as they are written in the names of
+    the files of rootFolder (see fileNameRegExp) and of its shard folders. ROIs made of digits
+    are compared as numbers, so that 1 selects ROI 001.
+
+    """
+    param = loadsFirstParameters(rootFolder)
+    fileParts = [param.decodesFileParts(os.path.basename(x)) for x in glob.glob(rootFolder + os.sep + "*.tif")]
+    ROIsFound = set([x["roi"] for x in fileParts if x])
+    ROIsFound.update([os.path.basename(x)[3:] for x in glob.glob(rootFolder + os.sep + shardFolderName + os.sep + "ROI*")])
+
+    def isSameROI(ROI, requestedROI):
+        if ROI.isdigit() and requestedROI.isdigit():
+            return int(ROI) == int(requestedROI)
+        return ROI == requestedROI
+
+    requestedROIs = [x.strip() for x in string.split(",")]
+    return sorted([ROI for ROI in ROIsFound if any([isSameROI(ROI, x) for x in requestedROIs])])
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-F", "--rootFolder", help="Folder with images, default: .")
+    parser.add_argument("--ROI", help="Comma separated ROIs to process, default: all")
+    parser.add_argument("--split", help="Only creates the shard folders", action="store_true")
+    parser.add_argument("--merge", help="Only merges the results of the shard folders", action="store_true")
+    parser.add_argument("--jobs", help="Number of shards run at a time, default: 1", type=int, default=1)
+    parser.add_argument("--parallel", help="Runs pyHiM.py in parallel mode", action="store_true")
+    parser.add_argument("--localAlignment", help="Runs pyHiM.py with localAlignment", action="store_true")
+    parser.add_argument("--refit", help="Runs pyHiM.py with refit", action="store_true")
+    parser.add_argument("--resume", help="Resumes interrupted shards", action="store_true")
+    parser.add_argument("--scheduler", help="Address of a dask scheduler shared by all shards")
+
+    args = parser.parse_args()
+
+    # absolute, as output file names are split at the first dot
+    if args.rootFolder:
+        rootFolder = os.path.abspath(args.rootFolder)
+    else:
+        rootFolder = os.getcwd()
+
+    ROIs = parsesROIs(args.ROI, rootFolder) if args.ROI else None
+    begin_time = datetime.now()
+
+    if args.merge:
+        # merges the shards already present
+        shardFolders = {
+            os.path.basename(x)[3:]: x for x in sorted(glob.glob(rootFolder + os.sep + shardFolderName + os.sep + "ROI*"))
+        }
+        if ROIs is not None:
+            shardFolders = {ROI: x for ROI, x in shardFolders.items() if ROI in ROIs}
+    else:
+        shardFolders = createsShards(rootFolder, ROIs)
+
+    if args.split:
+        print("\nRun pyHiM.py on each shard, then merge with shardHiM_run.py -F {} --merge".format(rootFolder))
+        for shardFolder in shardFolders.values():
+            print("pyHiM.py -F {}".format(shardFolder))
+        sys.exit(0)
+
+    failedROIs = []
+    if not args.merge:
+        pyHiMarguments = ["--{}".format(x) for x in ["parallel", "localAlignment", "refit", "resume"] if getattr(args, x)]
+
+        # shards running at the same time share one local cluster, unless a scheduler is given
+        daskClusterInstance = None
+        schedulerAddress = args.scheduler if args.scheduler else getsClusterParameters(loadsFirstParameters(rootFolder))[0]
+        if args.parallel and args.jobs > 1 and len(schedulerAddress) == 0:
+            daskClusterInstance = startsSharedCluster(rootFolder, min(args.jobs, len(shardFolders)))
+            schedulerAddress = daskClusterInstance.cluster.scheduler_address
+        if args.scheduler or daskClusterInstance is not None:
+            pyHiMarguments += ["--scheduler", schedulerAddress]
+
+        failedROIs = runsShards(shardFolders, pyHiMarguments, numberJobs=args.jobs)
+
+        if daskClusterInstance is not None:
+            daskClusterInstance.client.close()
+            daskClusterInstance.cluster.close()
+
+    mergesShards(rootFolder, shardFolders)
+
+    if len(failedROIs) > 0:
+        print("Merged with failed shards: {}. Rerun them with --ROI and --resume".format(",".join(failedROIs)))
+    print("Elapsed time: {}".format(datetime.now() - begin_time))
+
+    sys.exit(1 if len(failedROIs) > 0 else 0)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Nov  6 10:31:08 2020
+
+@author: marcnol
+
+Binary columnar format for the tables of spots (segmentedObjects_barcode.dat and the like).
+
+A table <name>.dat is stored as a folder <name>.spots with:
+    - schema.json: names and types of the columns, in order
+    - chunk_<n>.npz: one array per column for the rows of the n-th append
+
+Appending rows writes a new chunk, without reading or rewriting the rows already stored, so
+that segmentMasks can save the spots of each file as they are found. Reading only loads the
+arrays of the columns asked for.
+
+The columns are those of the ECSV tables, e.g.:
+    Buid, ROI #, CellID #, Barcode #, id, xcentroid, ycentroid, sharpness, roundness1,
+    roundness2, npix, sky, peak, flux, mag
+and, after refitBarcodes3D, zcentroidGauss, zcentroidMoment, sigmaGaussFit, residualGaussFit, 3DfitKeep
+
+The format is used if "spotTable" is set to "binary" in the "io" section of the parameters
+file. The ECSV table is then only written if "spotTableECSV" is True, as an export for other tools.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import re
+import glob
+import json
+import shutil
+import zipfile
+import numpy as np
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+class spotTable:
+    def __init__(self, fileName):
+        """
+        Parameters
+        ----------
+        fileName : string
+            name of the table, with or without extension, e.g. segmentedObjects_barcode.dat.
+
+        """
+        self.folder = os.path.splitext(fileName)[0] + ".spots"
+        self.schemaFileName = self.folder + os.sep + "schema.json"
+
+    def exists(self):
+        return os.path.exists(self.schemaFileName)
+
+    def readsSchema(self):
+        with open(self.schemaFileName) as f:
+            return json.load(f)
+
+    def listsChunks(self):
+        chunks = glob.glob(self.folder + os.sep + "chunk_*.npz")
+        return sorted(chunks, key=lambda x: int(re.search(r"chunk_([0-9]+)\.npz$", x).group(1)))
+
+    def __len__(self):
+        return sum([self.readsSchema()["rows"].get(os.path.basename(x), 0) for x in self.listsChunks()]) if self.exists() else 0
+
+    def writesChunk(self, folder, index, columns):
+        # writes to a temporary file first so that readers never see a partial chunk
+        chunkFileName = folder + os.sep + "chunk_{}.npz".format(index)
+        with zipfile.ZipFile(chunkFileName + ".tmp", "w", zipfile.ZIP_STORED, allowZip64=True) as chunk:
+            for i, column in enumerate(columns.values()):
+                # fixed time stamps, so that the same rows give the same file and checksum
+                info = zipfile.ZipInfo("c{}.npy".format(i), date_time=(1980, 1, 1, 0, 0, 0))
+                with chunk.open(info, "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, column, allow_pickle=False)
+        os.replace(chunkFileName + ".tmp", chunkFileName)
+        return os.path.basename(chunkFileName)
+
+    def writesSchema(self, folder, schema):
+        with open(folder + os.sep + "schema.json.tmp", "w") as f:
+            json.dump(schema, f, indent=1)
+        os.replace(folder + os.sep + "schema.json.tmp", folder + os.sep + "schema.json")
+
+    def appends(self, table):
+        """
+        Appends the rows of an astropy Table, with the same columns as the rows already stored
+
+        """
+        columns = getsColumns(table)
+        if len(columns) == 0:
+            return
+
+        if not self.exists():
+            os.makedirs(self.folder, exist_ok=True)
+            schema = {"columns": [[x, y.dtype.str] for x, y in columns.items()], "rows": {}}
+        else:
+            schema = self.readsSchema()
+            if [x[0] for x in schema["columns"]] != list(columns.keys()):
+                raise ValueError(
+                    "Columns {} do not match those of {}: {}".format(
+                        list(columns.keys()), self.folder, [x[0] for x in schema["columns"]]
+                    )
+                )
+
+        chunks = self.listsChunks()
+        index = int(re.search(r"chunk_([0-9]+)\.npz$", chunks[-1]).group(1)) + 1 if len(chunks) > 0 else 0
+        chunkName = self.writesChunk(self.folder, index, columns)
+
+        schema["rows"][chunkName] = len(table)
+        self.writesSchema(self.folder, schema)
+
+    def writes(self, table):
+        """
+        Replaces the table by an astropy Table
+
+        """
+        temporaryFolder = self.folder + ".tmp"
+        if os.path.exists(temporaryFolder):
+            shutil.rmtree(temporaryFolder)
+        os.makedirs(temporaryFolder)
+
+        columns = getsColumns(table)
+        schema = {"columns": [[x, y.dtype.str] for x, y in columns.items()], "rows": {}}
+        if len(table) > 0:
+            schema["rows"][self.writesChunk(temporaryFolder, 0, columns)] = len(table)
+        self.writesSchema(temporaryFolder, schema)
+
+        self.removes()
+        os.replace(temporaryFolder, self.folder)
+
+    def removes(self):
+        if os.path.exists(self.folder):
+            # renames first so that the folder disappears at once for readers
+            removedFolder = self.folder + ".removed"
+            if os.path.exists(removedFolder):
+                shutil.rmtree(removedFolder)
+            os.replace(self.folder, removedFolder)
+            shutil.rmtree(removedFolder)
+
+    def readsColumns(self, columns=None):
+        """
+        returns a dict with the arrays of columns, all columns if None. Only the arrays of
+        columns are read from the chunks.
+
+        """
+        schema = self.readsSchema()
+        names = [x[0] for x in schema["columns"]]
+        if columns is None:
+            columns = names
+
+        missing = [x for x in columns if x not in names]
+        if len(missing) > 0:
+            raise KeyError("Columns {} not in {}".format(missing, self.folder))
+
+        keys = {x: "c{}".format(names.index(x)) for x in columns}
+        arrays = {x: [] for x in columns}
+        for chunkFileName in self.listsChunks():
+            # chunks written after the schema was read are left out
+            if os.path.basename(chunkFileName) not in schema["rows"]:
+                continue
+            with np.load(chunkFileName, allow_pickle=False) as chunk:
+                for x in columns:
+                    arrays[x].append(chunk[keys[x]])
+
+        dtypes = dict(schema["columns"])
+        return {
+            x: np.concatenate(arrays[x]) if len(arrays[x]) > 0 else np.zeros(0, dtype=dtypes[x]) for x in columns
+        }
+
+    def reads(self, columns=None):
+        """
+        returns the table as an astropy Table, with only columns if given
+
+        """
+        from astropy.table import Table
+
+        arrays = self.readsColumns(columns)
+        return Table(list(arrays.values()), names=list(arrays.keys()))
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def getsColumns(table):
+    # arrays of the columns of an astropy Table, strings for object columns such as Buid
+    columns = {}
+    for name in table.colnames:
+        column = np.asarray(table[name])
+        if column.dtype.kind == "O":
+            column = column.astype(str)
+        columns[name] = column
+    return columns
+
+
+def getsSpotTableParameters(param):
+    """
+    returns the format of the tables of spots and whether an ECSV export is written
+
+    """
+    spotTableFormat, exportsECSV = "ecsv", True
+    if hasattr(param, "param") and "io" in param.param.keys():
+        if "spotTable" in param.param["io"].keys():
+            spotTableFormat = param.param["io"]["spotTable"]
+        if "spotTableECSV" in param.param["io"].keys():
+            exportsECSV = param.param["io"]["spotTableECSV"]
+
+    return spotTableFormat, exportsECSV
+
+
+def listsSpotTableFiles(fileName):
+    """
+    returns the files holding the table of spots fileName, e.g. to build the key of a stage cache
+
+    """
+    binaryTable = spotTable(fileName)
+    if binaryTable.exists():
+        return [binaryTable.schemaFileName] + binaryTable.listsChunks()
+    else:
+        return [fileName]
+
+
+def existsSpotTable(fileName):
+    return spotTable(fileName).exists() or os.path.exists(fileName)
+
+
+def loadsSpotTable(fileName, columns=None):
+    """
+    Reads the table of spots fileName, from its binary folder if there is one, from the ECSV
+    file otherwise
+
+    Parameters
+    ----------
+    fileName : string
+        name of the ECSV table, e.g. segmentedObjects_barcode.dat.
+    columns : list, optional
+        columns to read. The default is None: all columns.
+
+    Returns
+    -------
+    table : astropy Table
+
+    """
+    binaryTable = spotTable(fileName)
+    if binaryTable.exists():
+        return binaryTable.reads(columns)
+
+    from astropy.table import Table
+
+    table = Table.read(fileName, format="ascii.ecsv")
+    return table if columns is None else table[columns]
+
+
+def savesSpotTable(table, fileName, param):
+    """
+    Writes the table of spots fileName in the format set in the parameters file
+
+    """
+    spotTableFormat, exportsECSV = getsSpotTableParameters(param)
+    if spotTableFormat == "binary":
+        spotTable(fileName).writes(table)
+        if exportsECSV:
+            table.write(fileName, format="ascii.ecsv", overwrite=True)
+        elif os.path.exists(fileName):
+            # an ECSV table of a previous run would be out of date
+            os.remove(fileName)
+    else:
+        table.write(fileName, format="ascii.ecsv", overwrite=True)
+        spotTable(fileName).removes()
+
+
+def copiesSpotTable(fileName, newFileName):
+    """
+    copies the table of spots fileName, in all the formats it is stored in
+
+    """
+    if spotTable(fileName).exists():
+        newTable = spotTable(newFileName)
+        newTable.removes()
+        shutil.copytree(spotTable(fileName).folder, newTable.folder)
+    if os.path.exists(fileName):
+        shutil.copyfile(fileName, newFileName)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 27 18:40:12 2020
+
+@author: marcnol
+
+Persistent cache of the outputs of the stages of the pipeline.
+
+Each processed item (e.g. a TIFF file for zProject) gets an entry in the cache folder with a
+key built from:
+    - the signature (name, size, modification time) of its input files
+    - the subsection of Parameters.param that the stage uses
+    - the version of the code of the stage (hash of the source files of its module and of the
+      pyHiM modules it imports, directly or not)
+
+If the key of an entry matches and its outputs are still on disk, the stage can skip the item.
+Stages use the cache when their "operation" is set to "skip" in the parameters file.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import ast
+import json
+import hashlib
+import inspect
+
+from fileProcessing.fileManagement import saveJSON, loadJSON, fileSignature, fileChecksum, existsIntermediate
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+class stageCache:
+    def __init__(self, cacheFolder):
+        self.cacheFolder = cacheFolder
+
+    def getEntryFileName(self, stage, item):
+        return self.cacheFolder + os.sep + stage + os.sep + os.path.basename(item) + ".json"
+
+    def getKey(self, function, inputFiles, parameters, checksum=False):
+        """
+        Builds the key of an item
+
+        Parameters
+        ----------
+        function : callable
+            stage function that produces the outputs.
+        inputFiles : list
+            files read to produce the outputs.
+        parameters : dict
+            parameters used to produce the outputs.
+        checksum : boolean, optional
+            uses the contents of the input files instead of their size and modification time.
+            Needed for inputs that are rewritten with the same contents at every run. The default is False.
+
+        Returns
+        -------
+        key : string
+
+        """
+        if checksum:
+            inputs = [fileChecksum(x) for x in inputFiles]
+        else:
+            inputs = [fileSignature(x) for x in inputFiles]
+
+        keyData = {
+            "inputs": inputs,
+            "parameters": parameters,
+            "code": codeVersion(function),
+        }
+        return hashlib.sha1(json.dumps(keyData, sort_keys=True, default=str).encode()).hexdigest()
+
+    def load(self, stage, item, key):
+        """
+        Returns the entry of an item if its key matches and all its outputs exist, None otherwise
+
+        """
+        entry = loadJSON(self.getEntryFileName(stage, item))
+
+        if len(entry) == 0 or entry["key"] != key:
+            return None
+
+        if not all([existsIntermediate(x) for x in entry["outputs"]]):
+            return None
+
+        return entry
+
+    def save(self, stage, item, key, outputs, result=None):
+        """
+        Records the outputs of an item
+
+        Parameters
+        ----------
+        stage : string
+        item : string
+            name of the item processed, typically the input file.
+        key : string
+            key returned by getKey.
+        outputs : list
+            files produced.
+        result : optional
+            JSON serializable result returned by the stage for this item. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        fileName = self.getEntryFileName(stage, item)
+        if not os.path.exists(os.path.dirname(fileName)):
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+
+        entry = {"key": key, "outputs": outputs, "result": result}
+
+        # writes to a temporary file first so that an interrupted write never leaves a valid-looking entry
+        saveJSON(fileName + ".tmp", entry)
+        os.replace(fileName + ".tmp", fileName)
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+_codeVersions = {}
+
+# root of the pyHiM modules, e.g. imageProcessing/imageProcessing.py
+packageFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def findsImportedModules(sourceFile):
+    """
+    returns the source files of the pyHiM modules imported by sourceFile, as package imports
+    (from imageProcessing.imageProcessing import ...) or as script imports from its own folder
+    (from fileManagement import ...)
+
+    """
+    with open(sourceFile, "rb") as f:
+        tree = ast.parse(f.read(), filename=sourceFile)
+
+    moduleNames = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            moduleNames += [x.name for x in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+            moduleNames.append(node.module)
+            # from package import module
+            moduleNames += [node.module + "." + x.name for x in node.names]
+
+    sourceFiles = []
+    for moduleName in moduleNames:
+        for folder in [packageFolder, os.path.dirname(sourceFile)]:
+            candidate = folder + os.sep + moduleName.replace(".", os.sep) + ".py"
+            if os.path.exists(candidate):
+                sourceFiles.append(os.path.abspath(candidate))
+                break
+
+    return sourceFiles
+
+
+def codeVersion(function):
+    """
+    returns the hash of the source file where function is defined and of the pyHiM modules
+    it imports, directly or through other pyHiM modules, so that a change in e.g. the
+    algorithms of imageProcessing.py invalidates the entries of the stages that use them
+
+    """
+    # looks through decorators such as profilesTask
+    sourceFile = os.path.abspath(inspect.getsourcefile(inspect.unwrap(function)))
+    if sourceFile not in _codeVersions:
+        sourceFiles, pending = set(), [sourceFile]
+        while len(pending) > 0:
+            fileName = pending.pop()
+            if fileName not in sourceFiles:
+                sourceFiles.add(fileName)
+                pending += findsImportedModules(fileName)
+
+        sha1 = hashlib.sha1()
+        for fileName in sorted(sourceFiles):
+            with open(fileName, "rb") as f:
+                sha1.update(os.path.relpath(fileName, packageFolder).encode())
+                sha1.update(f.read())
+        _codeVersions[sourceFile] = sha1.hexdigest()
+
+    return _codeVersions[sourceFile]
+
+
+def selectsParameters(section, exclude=()):
+    """
+    returns the entries of a section of Parameters.param that affect the outputs of a stage
+
+    Parameters
+    ----------
+    section : dict
+        e.g. param.param["zProject"].
+    exclude : list, optional
+        keys that do not change the outputs. The default is ().
+
+    Returns
+    -------
+    dict
+
+    """
+    return {key: value for key, value in section.items() if key not in exclude}
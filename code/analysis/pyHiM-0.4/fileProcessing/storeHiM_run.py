@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov  4 15:40:12 2020
+
+@author: marcnol
+
+Converts the TIFF files of a rootFolder into the chunked, compressed image store.
+
+Files are written to <rootFolder>/HiM_store as zarr arrays, chunked with "chunkZ" planes and
+"chunkXY" px tiles and compressed with zstd at "compressionLevel", as set in the "io" section of
+the parameters file. Files already converted and unchanged since are skipped.
+
+The stages read from the store once "store" is set to "zarr" in the "io" section.
+
+In the command line, run as
+$ storeHiM_run.py -F rootFolder --jobs 4
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from fileManagement import Parameters, listsImages
+from imageStore import convertsImage, getsIOParameters, storeFolderName
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+parameterFiles = ["infoList_fiducial.json", "infoList_barcode.json", "infoList_DAPI.json", "infoList_RNA.json"]
+
+
+def getsFolderSize(folder):
+    size = 0
+    for path, _, fileNames in os.walk(folder):
+        size += sum([os.path.getsize(path + os.sep + x) for x in fileNames])
+    return size
+
+
+def convertsFolder(rootFolder, ioParameters, fileNames, numberProcesses=1, overwrite=False):
+    """
+    Converts fileNames into the store of rootFolder
+
+    Parameters
+    ----------
+    rootFolder : string
+    ioParameters : dict
+        see getsIOParameters.
+    fileNames : list
+        TIFF files to convert.
+    numberProcesses : int, optional
+        The default is 1.
+    overwrite : boolean, optional
+        converts files even if their store is up to date. The default is False.
+
+    Returns
+    -------
+    numberFailed : int
+
+    """
+    begin_time = datetime.now()
+    numberFailed = 0
+
+    with ProcessPoolExecutor(max_workers=numberProcesses) as executor:
+        futures = {executor.submit(convertsImage, x, ioParameters, overwrite): x for x in fileNames}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print("Converted {}".format(os.path.basename(futures[future])))
+            except Exception as e:
+                numberFailed += 1
+                print("Could not convert {}: {}".format(os.path.basename(futures[future]), e))
+
+    tiffSize = sum([os.path.getsize(x) for x in fileNames])
+    storeSize = getsFolderSize(rootFolder + os.sep + storeFolderName)
+    print(
+        "Converted {} files in {}, {} failed. TIFF: {:.1f} MB, store: {:.1f} MB ({:.2f})".format(
+            len(fileNames),
+            datetime.now() - begin_time,
+            numberFailed,
+            tiffSize / 1e6,
+            storeSize / 1e6,
+            storeSize / max(tiffSize, 1),
+        )
+    )
+
+    return numberFailed
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-F", "--rootFolder", help="Folder with images, default: .", default=".")
+    parser.add_argument("--jobs", help="Number of files converted in parallel, default: 1", type=int, default=1)
+    parser.add_argument("--overwrite", help="Converts files even if their store is up to date", action="store_true")
+
+    args = parser.parse_args()
+    rootFolder = os.path.abspath(args.rootFolder)
+
+    param = None
+    for parameterFile in parameterFiles:
+        if os.path.exists(rootFolder + os.sep + parameterFile):
+            param = Parameters(rootFolder, parameterFile)
+            break
+
+    if param is None:
+        raise SystemExit("No parameters file found in {}".format(rootFolder))
+
+    ioParameters = getsIOParameters(param)
+    print("Store parameters: {}".format(ioParameters))
+    if ioParameters["store"] != "zarr":
+        print('Stages will read the store once "store" is set to "zarr" in the "io" section of the parameters file')
+
+    numberFailed = convertsFolder(
+        rootFolder, ioParameters, listsImages(rootFolder, param), numberProcesses=args.jobs, overwrite=args.overwrite
+    )
+    if numberFailed > 0:
+        raise SystemExit(1)
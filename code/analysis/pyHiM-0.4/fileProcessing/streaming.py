@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov  2 09:45:18 2020
+
+@author: marcnol
+
+Watches a rootFolder while the microscope is still acquiring, to analyse the images as they arrive.
+
+A file is considered completely written when its size and modification time did not change
+between two polls of the folder. Files are then released to the stages by (ROI, cycle):
+    - the cycle of the reference fiducial of a ROI is released once its fiducial image is written
+    - any other cycle of that ROI is released once its own fiducial image is written, so that its
+      shift can be calculated before its other channels are registered
+
+Files of a (ROI, cycle) written after their cycle was released are released when they are complete.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import glob
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+class folderWatcher:
+    def __init__(self, rootFolder, param):
+        """
+        Parameters
+        ----------
+        rootFolder : string
+            folder where the microscope writes the images.
+        param : Parameters Class
+            parameters of the fiducial label, used to decode the file names and to find
+            the reference fiducial and the fiducial channels.
+
+        """
+        self.rootFolder = rootFolder
+        self.param = param
+        self.referenceFiducial = param.param["alignImages"]["referenceFiducial"]
+        self.fiducialChannels = {
+            "barcode": param.setsChannel("fiducialBarcode_channel", "ch00"),
+            "DAPI": param.setsChannel("fiducialDAPI_channel", "ch01"),
+        }
+
+        self.signatures = {}  # (size, modification time) of each file at the last poll
+        self.complete = {}  # (ROI, cycle) of each complete file
+        self.released = set()  # names of the files released to the stages
+
+    def pollsFolder(self):
+        """
+        finds the files completely written since the last poll
+
+        Returns
+        -------
+        newFiles : list
+            names of the files that became complete.
+
+        """
+        newFiles = []
+        for fileName in glob.glob(self.rootFolder + os.sep + "*.tif"):
+            name = os.path.basename(fileName)
+            if name in self.complete:
+                continue
+
+            try:
+                signature = (os.path.getsize(fileName), os.path.getmtime(fileName))
+            except OSError:
+                # removed or renamed by the acquisition software
+                continue
+
+            if self.signatures.get(name) == signature:
+                fileParts = self.param.decodesFileParts(name)
+                if fileParts:
+                    self.complete[name] = (fileParts["roi"], fileParts["cycle"], fileParts["channel"])
+                    newFiles.append(name)
+            self.signatures[name] = signature
+
+        return newFiles
+
+    def getsFiducialChannel(self, cycle):
+        return self.fiducialChannels["DAPI"] if "DAPI" in cycle else self.fiducialChannels["barcode"]
+
+    def releasesFiles(self):
+        """
+        releases the complete files whose (ROI, cycle) can be processed
+
+        Returns
+        -------
+        newFiles : list
+            names of the files released by this call.
+
+        """
+        # (ROI, cycle) with a complete fiducial image
+        fiducials = set(
+            [(roi, cycle) for roi, cycle, channel in self.complete.values() if channel == self.getsFiducialChannel(cycle)]
+        )
+
+        newFiles = []
+        for name, (roi, cycle, _) in self.complete.items():
+            if name in self.released:
+                continue
+
+            if (roi, self.referenceFiducial) in fiducials and (roi, cycle) in fiducials:
+                newFiles.append(name)
+
+        self.released.update(newFiles)
+
+        return newFiles
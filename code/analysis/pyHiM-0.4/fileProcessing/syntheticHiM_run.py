@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 29 14:05:22 2020
+
+@author: marcnol
+
+Generates a synthetic Hi-M dataset with known ground truth.
+
+For every ROI it writes:
+    - one DAPI cycle: nuclei in ch00 and fiducial beads in ch01
+    - one cycle per barcode (RT10, RT11, ...): fiducial beads in ch00 and
+      diffraction-limited barcode spots in ch01
+
+Each cell carries a chromatin trace: one 3D position per barcode, inside its nucleus.
+Each cycle is displaced by a known drift (dy, dx) with respect to the first barcode
+cycle, used as reference fiducial. Files are named to match the default fileNameRegExp:
+    scan_001_RT10_001_ROI_converted_decon_ch00.tif
+
+The infoList_<label>.json parameter files are written in the folder, and the ground truth
+in groundTruth.json:
+    - "dictShifts": shifts that register each cycle to the reference, in the format of
+      the alignImages dictionary ({"ROI:001": {"RT11": [dy, dx]}})
+    - "barcodes": list of barcode numbers
+    - "cells": for each ROI and cell, the reference-frame position (z, y, x) in px of each barcode
+
+In the command line, run as
+$ syntheticHiM_run.py -F outputFolder --ROIs 2 --cycles 8
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import argparse
+import numpy as np
+from skimage import io
+from scipy.ndimage import gaussian_filter
+
+from fileManagement import Parameters, saveJSON
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def addsGaussianSpots(stack, positions, amplitude, sigma):
+    """
+    adds 3D gaussian spots to stack at sub-pixel positions
+
+    Parameters
+    ----------
+    stack : npy array (z, y, x), float
+    positions : npy array (N, 3)
+        z, y, x positions of the spots in px.
+    amplitude : float
+    sigma : tuple
+        sigma in z and in xy, in px.
+
+    Returns
+    -------
+    None.
+
+    """
+    sigmaZ, sigmaXY = sigma
+    window = np.ceil(3 * np.array([sigmaZ, sigmaXY, sigmaXY])).astype(int)
+
+    for position in positions:
+        center = np.round(position).astype(int)
+        lower = np.maximum(center - window, 0)
+        upper = np.minimum(center + window + 1, stack.shape)
+        if np.any(upper <= lower):
+            continue
+
+        z, y, x = np.ogrid[lower[0] : upper[0], lower[1] : upper[1], lower[2] : upper[2]]
+        stack[lower[0] : upper[0], lower[1] : upper[1], lower[2] : upper[2]] += amplitude * np.exp(
+            -((z - position[0]) ** 2) / (2 * sigmaZ ** 2)
+            - ((y - position[1]) ** 2 + (x - position[2]) ** 2) / (2 * sigmaXY ** 2)
+        )
+
+
+def makesNuclei(shape, centers, radius, amplitude, drift):
+    """
+    returns a stack with nuclei as blurred discs, centered in the focal plane
+
+    """
+    nz, ny, nx = shape
+    y, x = np.ogrid[0:ny, 0:nx]
+    image2D = np.zeros((ny, nx))
+    for center in centers:
+        image2D[(y - center[1] - drift[0]) ** 2 + (x - center[2] - drift[1]) ** 2 <= radius ** 2] = amplitude
+    image2D = gaussian_filter(image2D, 1.5)
+
+    profileZ = np.exp(-((np.arange(nz) - nz / 2) ** 2) / (2 * (nz / 6) ** 2))
+
+    return profileZ[:, None, None] * image2D[None, :, :]
+
+
+def savesStack(fileName, stack, background, rng):
+    """
+    adds background and Poisson noise and saves stack as a 16-bit TIFF
+
+    """
+    stack = rng.poisson(stack + background).astype(np.float64)
+    io.imsave(fileName, np.clip(stack, 0, 65535).astype(np.uint16), check_contrast=False)
+
+
+def getsFileName(rootFolder, cycle, ROI, channel):
+    return rootFolder + os.sep + "scan_001_{}_{:03d}_ROI_converted_decon_{}.tif".format(cycle, ROI, channel)
+
+
+def writesParameterFiles(rootFolder, referenceFiducial, numberZplanes, nucleusRadius):
+    """
+    writes the infoList_<label>.json files used by pyHiM.py
+
+    """
+    for label in ["fiducial", "barcode", "DAPI"]:
+        param = Parameters(rootFolder, "infoList_{}.json".format(label))
+        param.param["acquisition"]["label"] = label
+        param.param["alignImages"]["referenceFiducial"] = referenceFiducial
+        param.param["zProject"]["zmax"] = numberZplanes
+        param.param["segmentedObjects"]["area_max"] = int(4 * np.pi * nucleusRadius ** 2)
+        param.param.pop("rootFolder")
+        saveJSON(param.paramFile, param.param)
+
+
+def createsSyntheticDataset(
+    rootFolder,
+    numberROIs=1,
+    numberCycles=8,
+    imageSize=512,
+    numberZplanes=60,
+    numberCells=20,
+    numberFiducials=100,
+    nucleusRadius=12,
+    maxDrift=10.0,
+    seed=0,
+):
+    """
+    Writes a synthetic Hi-M dataset and its ground truth to rootFolder
+
+    Parameters
+    ----------
+    rootFolder : string
+        output folder, created if it does not exist.
+    numberROIs : int, optional
+        The default is 1.
+    numberCycles : int, optional
+        number of barcode cycles. The default is 8.
+    imageSize : int, optional
+        size in x and y, in px. The default is 512.
+    numberZplanes : int, optional
+        The default is 60.
+    numberCells : int, optional
+        nuclei per ROI. The default is 20.
+    numberFiducials : int, optional
+        fiducial beads per ROI. The default is 100.
+    nucleusRadius : int, optional
+        in px. The default is 12.
+    maxDrift : float, optional
+        maximum drift of a cycle in x and y, in px. The default is 10.0.
+    seed : int, optional
+        seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    groundTruth : dict
+
+    """
+    if not os.path.exists(rootFolder):
+        os.makedirs(rootFolder)
+
+    rng = np.random.default_rng(seed)
+    shape = (numberZplanes, imageSize, imageSize)
+    margin = nucleusRadius + maxDrift + 4
+    barcodes = list(range(10, 10 + numberCycles))
+    cycles = ["RT{}".format(x) for x in barcodes] + ["DAPI"]
+    referenceFiducial = cycles[0]
+
+    groundTruth = {"dictShifts": {}, "barcodes": barcodes, "cells": {}, "referenceFiducial": referenceFiducial}
+
+    for ROI in range(1, numberROIs + 1):
+
+        # nuclei, with one position per barcode inside each nucleus (reference frame, z y x, px)
+        nucleiCenters = np.column_stack(
+            [
+                np.full(numberCells, numberZplanes / 2),
+                rng.uniform(margin, imageSize - margin, numberCells),
+                rng.uniform(margin, imageSize - margin, numberCells),
+            ]
+        )
+        traces = []
+        for center in nucleiCenters:
+            # random walk centered on the nucleus and kept inside it
+            walk = np.cumsum(rng.normal(0, [0.8, 1.5, 1.5], (numberCycles, 3)), axis=0)
+            trace = center + walk - walk.mean(axis=0)
+            inPlane = trace[:, 1:] - center[1:]
+            norm = np.maximum(np.linalg.norm(inPlane, axis=1) / (0.8 * nucleusRadius), 1)
+            trace[:, 1:] = center[1:] + inPlane / norm[:, None]
+            traces.append(trace)
+        traces = np.array(traces)
+
+        fiducials = np.column_stack(
+            [
+                rng.uniform(numberZplanes / 4, 3 * numberZplanes / 4, numberFiducials),
+                rng.uniform(maxDrift, imageSize - maxDrift, numberFiducials),
+                rng.uniform(maxDrift, imageSize - maxDrift, numberFiducials),
+            ]
+        )
+
+        dictShiftROI = {}
+        for icycle, cycle in enumerate(cycles):
+            drift = np.zeros(2) if cycle == referenceFiducial else rng.uniform(-maxDrift, maxDrift, 2)
+            if cycle != referenceFiducial:
+                # shift that brings this cycle back onto the reference
+                dictShiftROI[cycle] = (-drift).tolist()
+            offset = np.array([0, drift[0], drift[1]])
+
+            # fiducial channel
+            stack = np.zeros(shape)
+            addsGaussianSpots(stack, fiducials + offset, 2000, (2.0, 1.5))
+            channel = "ch01" if cycle == "DAPI" else "ch00"
+            savesStack(getsFileName(rootFolder, cycle, ROI, channel), stack, 100, rng)
+
+            # signal channel
+            if cycle == "DAPI":
+                stack = makesNuclei(shape, nucleiCenters, nucleusRadius, 500, drift)
+                savesStack(getsFileName(rootFolder, cycle, ROI, "ch00"), stack, 100, rng)
+            else:
+                stack = np.zeros(shape)
+                addsGaussianSpots(stack, traces[:, icycle, :] + offset, 800, (2.0, 1.3))
+                savesStack(getsFileName(rootFolder, cycle, ROI, "ch01"), stack, 100, rng)
+
+            print("ROI {}: cycle {} written".format(ROI, cycle))
+
+        groundTruth["dictShifts"]["ROI:{:03d}".format(ROI)] = dictShiftROI
+        groundTruth["cells"]["ROI:{:03d}".format(ROI)] = traces.tolist()
+
+    writesParameterFiles(rootFolder, referenceFiducial, numberZplanes, nucleusRadius)
+    saveJSON(rootFolder + os.sep + "groundTruth.json", groundTruth)
+
+    return groundTruth
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-F", "--rootFolder", help="Output folder, default: .")
+    parser.add_argument("--ROIs", help="Number of ROIs, default: 1", type=int, default=1)
+    parser.add_argument("--cycles", help="Number of barcode cycles, default: 8", type=int, default=8)
+    parser.add_argument("--size", help="Image size in x and y, default: 512", type=int, default=512)
+    parser.add_argument("--zPlanes", help="Number of z planes, default: 60", type=int, default=60)
+    parser.add_argument("--cells", help="Number of nuclei per ROI, default: 20", type=int, default=20)
+    parser.add_argument("--maxDrift", help="Maximum drift between cycles in px, default: 10", type=float, default=10.0)
+    parser.add_argument("--seed", help="Random seed, default: 0", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.rootFolder:
+        rootFolder = args.rootFolder
+    else:
+        rootFolder = os.getcwd()
+
+    createsSyntheticDataset(
+        rootFolder,
+        numberROIs=args.ROIs,
+        numberCycles=args.cycles,
+        imageSize=args.size,
+        numberZplanes=args.zPlanes,
+        numberCells=args.cells,
+        maxDrift=args.maxDrift,
+        seed=args.seed,
+    )
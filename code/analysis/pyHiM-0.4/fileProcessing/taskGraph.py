@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 26 10:12:31 2020
+
+@author: marcnol
+
+Dependency graph executor for the stages of the Hi-M pipeline.
+
+Each task of the graph is a function call that declares the tasks it depends on.
+In sequential mode tasks are run one after the other in dependency order. In parallel
+mode every task whose dependencies are complete is launched in its own thread, so that
+independent work from different labels (e.g. projecting barcodes and DAPI while fiducials
+are being aligned) keeps the cluster busy.
+
+"""
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+class taskGraph:
+    def __init__(self, log1, parallel=False, maxConcurrentTasks=None):
+        self.log1 = log1
+        self.parallel = parallel
+        self.maxConcurrentTasks = maxConcurrentTasks
+        self.tasks = {}
+        self.results = {}
+
+    def addTask(self, name, function, args=(), dependencies=()):
+        """
+        adds a task to the graph
+
+        Parameters
+        ----------
+        name : string
+            unique name of the task.
+        function : callable
+            function run by the task.
+        args : tuple, optional
+            arguments passed to function. The default is ().
+        dependencies : list, optional
+            names of the tasks that need to finish before this one starts. The default is ().
+
+        Returns
+        -------
+        None.
+
+        """
+        if name in self.tasks:
+            raise ValueError("Task already in graph: {}".format(name))
+
+        self.tasks[name] = {
+            "function": function,
+            "args": tuple(args),
+            "dependencies": list(dependencies),
+        }
+
+    def sortsTasks(self):
+        """
+        Sorts tasks in topological order. Among tasks that are ready, the order
+        in which they were added to the graph is kept.
+
+        Returns
+        -------
+        order : list
+            task names in execution order.
+
+        """
+        for name, task in self.tasks.items():
+            for dependency in task["dependencies"]:
+                if dependency not in self.tasks:
+                    raise ValueError("Task {} depends on unknown task {}".format(name, dependency))
+
+        order, done = [], set()
+        while len(order) < len(self.tasks):
+            ready = [
+                name
+                for name, task in self.tasks.items()
+                if name not in done and all([x in done for x in task["dependencies"]])
+            ]
+            if len(ready) == 0:
+                raise ValueError("Circular dependency between tasks: {}".format(
+                    [x for x in self.tasks if x not in done]))
+            order += ready
+            done.update(ready)
+
+        return order
+
+    def runsTask(self, name):
+        task = self.tasks[name]
+        begin_time = datetime.now()
+        self.log1.info("Starting task: {}".format(name))
+
+        result = task["function"](*task["args"])
+
+        self.log1.info("Task {} finished in {}".format(name, datetime.now() - begin_time))
+        return result
+
+    def run(self):
+        """
+        Runs all the tasks of the graph
+
+        Returns
+        -------
+        dict with the results of each task
+
+        """
+        order = self.sortsTasks()
+
+        if not self.parallel:
+            for name in order:
+                self.results[name] = self.runsTask(name)
+        else:
+            # launches every task with all its dependencies done
+            pending, running = list(order), {}
+            with ThreadPoolExecutor(max_workers=self.maxConcurrentTasks) as executor:
+                while len(pending) > 0 or len(running) > 0:
+                    ready = [
+                        name
+                        for name in pending
+                        if all([x in self.results for x in self.tasks[name]["dependencies"]])
+                    ]
+                    for name in ready:
+                        pending.remove(name)
+                        running[executor.submit(self.runsTask, name)] = name
+
+                    finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        # re-raises exceptions from the task thread
+                        self.results[name] = future.result()
+
+        return self.results
@@ -19,11 +19,12 @@ image cross correlation
 
 import numpy as np
 import matplotlib.pyplot as plt
-import os, glob
-from dask.distributed import Client, get_client
+import os
+import re
+from numpy import linalg as LA
+from dask.distributed import Client, get_client, as_completed
 
 from skimage.registration._phase_cross_correlation import _upsampled_dft
-from skimage.exposure import match_histograms
 
 from astropy.stats import SigmaClip
 from photutils import Background2D, MedianBackground
@@ -36,12 +37,19 @@ from imageProcessing.imageProcessing import (
     align2ImagesCrossCorrelation,
     alignImagesByBlocks,
     plottingBlockALignmentResults,
+    preparesCrossCorrelationReference,
+    preparesBlockReference,
+    preparesHistogramTemplate,
+    matchesHistogram,
     applyCorrection,    
 )
 
 from fileProcessing.fileManagement import (
-    folders, writeString2File, saveJSON, loadJSON, RT2fileName,
+    folders, writeString2File, saveJSON, loadJSON, RT2fileName, getsTaskResources, listsImages, existsIntermediate,
     )
+from fileProcessing.stageCache import stageCache, selectsParameters
+from fileProcessing.profiling import profilesTask
+from fileProcessing.figureQueue import queuesFigure
 
 from astropy.table import Table
 from scipy.ndimage import shift as shiftImage
@@ -49,6 +57,147 @@ from scipy.ndimage import shift as shiftImage
 # to remove in a future version
 import warnings
 warnings.filterwarnings("ignore")
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+class alignmentReference:
+    def __init__(self, imReference, param, dataFolder):
+        """
+        Reference fiducial of an ROI, prepared once for all the cycles aligned against it:
+        normalized and background subtracted image, and its FFTs for the alignment mode of
+        param (contrast adjusted image for global alignments, blocks and histogram for block
+        alignments)
+
+        Parameters
+        ----------
+        imReference : Image Class
+            reference fiducial, with its 2D projection loaded.
+        param : Parameters Class
+        dataFolder : folders Class
+
+        """
+        self.fileName = imReference.fileName
+        self.fileName2D = imReference.getImageFileName(dataFolder.outputFolders["zProject"], "_2d") + ".npy"
+
+        alignmentParameters = getsAlignmentParameters(param)
+        self.alignByBlock = alignmentParameters["alignByBlock"]
+
+        # normalizes image and removes inhomogeneous background
+        image = imReference.data_2D / imReference.data_2D.max()
+        self.image = removesInhomogeneousBackground(image, param)
+
+        if not self.alignByBlock:
+            self.crossCorrelation = preparesCrossCorrelationReference(
+                self.image,
+                lower_threshold=alignmentParameters["lower_threshold"],
+                higher_threshold=alignmentParameters["higher_threshold"],
+                spectrum=alignmentParameters["pyramidLevels"] == 0,
+            )
+        else:
+            self.image = np.float32(self.image)
+            self.histogram = preparesHistogramTemplate(self.image)
+            self.blocks = preparesBlockReference(self.image, alignmentParameters["blockSize"])
+
+
+class driftTrajectory:
+    def __init__(self, fileNameReference, fileNames, param):
+        """
+        Drift of the cycles of an ROI along their acquisition order, as decoded from the file
+        names. The reference cycle has no shift. Every "driftSeedStep"-th cycle, and the last
+        one, are seeds registered without a guess. The shifts of the other cycles are predicted
+        by linear interpolation of the shifts known on both sides of them in the acquisition
+        order, leaving out the cycles that depart from the trajectory.
+
+        Parameters
+        ----------
+        fileNameReference : string
+            reference fiducial of the ROI.
+        fileNames : list
+            fiducials of the other cycles of the ROI.
+        param : Parameters Class
+
+        """
+        alignmentParameters = getsAlignmentParameters(param)
+        step = max(1, int(alignmentParameters["driftSeedStep"]))
+        self.tolerance = alignmentParameters["driftTolerance"]
+
+        fileNames = sorted([fileNameReference] + list(fileNames), key=lambda x: getsAcquisitionOrder(x, param))
+        self.positions = {x: i for i, x in enumerate(fileNames)}
+        self.shifts = {fileNameReference: np.zeros(2)}
+        self.fileNameReference = fileNameReference
+
+        cycles = [x for x in fileNames if x != fileNameReference]
+        self.seeds = [x for i, x in enumerate(cycles) if i % step == step - 1 or i == len(cycles) - 1]
+
+    def adds(self, fileName, shift):
+        self.shifts[fileName] = np.array(shift, dtype=float)
+
+    def predicts(self, fileName, exclude=[]):
+        """
+        returns the shift of fileName interpolated linearly from the known shifts of the
+        cycles acquired before and after it, extrapolated from the two closest ones at the ends.
+        The shifts of the cycles in exclude are not used.
+
+        """
+        known = sorted(
+            [x for x in self.shifts.keys() if x not in exclude and x != fileName], key=lambda x: self.positions[x]
+        )
+        positions = np.array([self.positions[x] for x in known])
+        position = self.positions[fileName]
+
+        if len(known) == 1:
+            return self.shifts[known[0]].tolist()
+
+        # index of the first of the two cycles the shift is interpolated from
+        i = int(np.clip(np.searchsorted(positions, position) - 1, 0, len(known) - 2))
+        weight = (position - positions[i]) / (positions[i + 1] - positions[i])
+        shift = (1 - weight) * self.shifts[known[i]] + weight * self.shifts[known[i + 1]]
+
+        return shift.tolist()
+
+    def findsOutliers(self):
+        """
+        returns the cycles whose shift departs by more than "driftTolerance" px from the
+        trajectory of the other ones, removing the worst one at a time so that an outlier does
+        not drag its neighbours, and the distance of each cycle to the trajectory without outliers
+
+        """
+        outliers = []
+        while True:
+            deviations = {
+                x: float(LA.norm(self.shifts[x] - np.array(self.predicts(x, exclude=outliers))))
+                for x in self.shifts.keys()
+                if x != self.fileNameReference
+            }
+            candidates = [x for x in deviations.keys() if x not in outliers]
+
+            # a trajectory needs the reference and two cycles
+            if len(candidates) < 2:
+                break
+            worst = max(candidates, key=lambda x: deviations[x])
+            if deviations[worst] <= self.tolerance:
+                break
+            outliers.append(worst)
+
+        return outliers, deviations
+
+    def summarizes(self):
+        outliers, deviations = self.findsOutliers()
+        return {
+            os.path.basename(x): {
+                "position": self.positions[x],
+                "shift": self.shifts[x].tolist(),
+                "seed": x in self.seeds,
+                "deviation": deviations.get(x, 0.0),
+                "outlier": x in outliers,
+            }
+            for x in sorted(self.shifts.keys(), key=lambda x: self.positions[x])
+        }
+
+
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
@@ -68,9 +217,7 @@ def displaysEqualizationHistograms(I_histogram, lower_threshold, outputFileName,
     ax1.vlines(lower_threshold["Im1"], 0, I_histogram["Im1"][0][0].max(), colors="r")
     ax2.vlines(lower_threshold["Im2"], 0, I_histogram["Im2"][0][0].max(), colors="r")
     plt.savefig(outputFileName + "_intensityHist.png")
-    writeString2File(
-        log1.fileNameMD, "{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName + "_intensityHist.png"), "a",
-    )
+    log1.addMarkdown("{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName + "_intensityHist.png"))
 
     if not verbose:
         plt.close(fig)
@@ -117,16 +264,111 @@ def removesInhomogeneousBackground(im,param):
     return im1_bkg_substracted
 
 
-def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbose):
+# parameters files already warned about the deprecated "tolerance" key
+warnedParameterFiles = set()
+
+
+def getsAlignmentParameters(param):
+    """
+    returns the parameters of alignImages used to align fiducials, with their defaults
+
+    """
+    alignmentParameters = {
+        "lower_threshold": 0.999,
+        "higher_threshold": 0.9999999,
+        "alignByBlock": False,
+        "toleranceRMS": 0.2,
+        "pyramidLevels": 0,
+        "pyramidCrop": 512,
+        "driftTrajectory": False,
+        "driftSeedStep": 4,
+        "driftCrop": 256,
+        "driftTolerance": 5,
+    }
+    for key in alignmentParameters.keys():
+        if key in param.param["alignImages"].keys():
+            alignmentParameters[key] = param.param["alignImages"][key]
+
+    # "tolerance" of older parameters files applied to the sum of absolute differences over
+    # the full image, which separates blocks about half as much as the RMS difference
+    if "tolerance" in param.param["alignImages"].keys() and "toleranceRMS" not in param.param["alignImages"].keys():
+        alignmentParameters["toleranceRMS"] = 2 * param.param["alignImages"]["tolerance"]
+        if param.paramFile not in warnedParameterFiles:
+            warnedParameterFiles.add(param.paramFile)
+            print(
+                "Warning: alignImages tolerance in {} is deprecated, using toleranceRMS = {}. Set toleranceRMS instead".format(
+                    param.paramFile, alignmentParameters["toleranceRMS"]
+                )
+            )
+
+    alignmentParameters["upsample_factor"] = 100
+    alignmentParameters["blockSize"] = (256, 256)
+
+    return alignmentParameters
+
+
+def getsAcquisitionOrder(fileName, param):
+    """
+    returns a key sorting files in acquisition order: run number, then number of the cycle,
+    as decoded from the file name
+
+    """
+    fileParts = param.decodesFileParts(os.path.basename(fileName))
+    if fileParts is None:
+        fileParts = {}
+
+    runNumber = re.findall(r"[0-9]+", str(fileParts.get("runNumber", "")))
+    cycle = re.findall(r"[0-9]+", str(fileParts.get("cycle", "")))
+
+    return (int(runNumber[0]) if len(runNumber) > 0 else -1, int(cycle[0]) if len(cycle) > 0 else -1)
+
+
+def getsRegisteredFileName(fileName, dataFolder):
+    return dataFolder.outputFolders["alignImages"] + os.sep + os.path.basename(fileName).split(".")[0] + "_2d_registered.npy"
+
+
+def getsAlignmentPayload(shift, tableEntry):
+    """
+    returns the results of align2Files in a JSON serializable form
+
+    """
+    return {"shift": [float(x) for x in shift], "tableEntry": tableEntry[:2] + [float(x) for x in tableEntry[2:]]}
+
+
+def preparesAlignmentReference(fileNameReference, param, log1, dataFolder):
+    """
+    loads the reference fiducial of an ROI, saves its registered 2D image and prepares it for
+    the alignments of the cycles of the ROI
+
+    Returns
+    -------
+    reference : alignmentReference Class
+
+    """
+    imReference = Image(param,log1)
+    imReference.loadImage2D(fileNameReference, log1, dataFolder.outputFolders["zProject"])
+    log1.report("Loading reference Image {}".format(fileNameReference))
+
+    # saves reference 2D image of fiducial
+    if not existsIntermediate(imReference.getImageFileName(dataFolder.outputFolders["alignImages"], tag="_2d_registered") + ".npy", param):
+        imReference.saveImage2D(
+            log1, dataFolder.outputFolders["alignImages"], tag="_2d_registered",
+        )
+
+    return alignmentReference(imReference, param, dataFolder)
+
+
+@profilesTask("alignImages")
+def align2Files(fileName, reference, param, log1, session1, dataFolder, verbose, guess=None):
     """
-    Uses preloaded ImReference Object and aligns it against filename
+    Uses the prepared reference of the ROI and aligns it against filename
 
     Parameters
     ----------
     fileName : npy 2D array
         file of image to be aligned
-    imReference : Image Class
-        Object type <Image> with image reference
+    reference : alignmentReference Class
+        reference fiducial of the ROI, prepared once for all its cycles
     param : Parameters Class
         Running parameters
     log1 : Log Class
@@ -137,6 +379,9 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
         DESCRIPTION.
     verbose : boolean
         True for display images
+    guess : list, optional
+        shift predicted by the drift trajectory of the ROI, near which the shift is searched.
+        The default is None: searches the full images.
 
     Returns are returned as arguments!
     -------
@@ -146,42 +391,52 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
         results zipped in Table Class form
 
     """
-    fileName1 = imReference.fileName
+    fileName1 = reference.fileName
     fileName2 = fileName
 
     outputFileName = dataFolder.outputFolders["alignImages"] + os.sep + os.path.basename(fileName2).split(".")[0]
 
+    # checks if this file was already aligned against the same reference with the same parameters
+    cache = stageCache(dataFolder.outputFolders["stageCache"])
+    cacheParameters = {
+        "alignImages": selectsParameters(
+            param.param["alignImages"], exclude=["folder", "operation", "outputFile", "localShiftTolerance", "bezel"]
+        ),
+        "background_sigma": param.param["segmentedObjects"]["background_sigma"],
+    }
+    if guess is not None:
+        # the shift is searched near the guess, in whole px
+        cacheParameters["guess"] = [int(round(x)) for x in guess]
+    key = cache.getKey(
+        align2Files,
+        [
+            reference.fileName2D,
+            dataFolder.outputFolders["zProject"] + os.sep + os.path.basename(fileName2).split(".")[0] + "_2d.npy",
+        ],
+        cacheParameters,
+    )
+    if param.param["alignImages"]["operation"] != "overwrite":
+        entry = cache.load("alignImages", fileName2, key)
+        if entry is not None:
+            log1.report("File already aligned: {}".format(os.path.basename(fileName2)))
+            shift, tableEntry = np.asarray(entry["result"]["shift"]), entry["result"]["tableEntry"]
+            writeString2File(dataFolder.outputFiles["alignImages"], "{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}".format(*tableEntry), "a")
+            return shift, tableEntry
+
     # loads image
     Im2 = Image(param,log1)
     Im2.loadImage2D(fileName2, log1, dataFolder.outputFolders["zProject"])
     
-    # Normalises images
-    image1_uncorrected = imReference.data_2D / imReference.data_2D.max()
+    # Normalises image and removes inhomogeneous background, the reference was prepared once for the ROI
+    image1_uncorrected = reference.image.copy()
     image2_uncorrected = Im2.data_2D / Im2.data_2D.max()
-
-    # removes inhomogeneous background
-    image1_uncorrected = removesInhomogeneousBackground(image1_uncorrected,param)
     image2_uncorrected = removesInhomogeneousBackground(image2_uncorrected,param)
-    
-    if "lower_threshold" in param.param["alignImages"].keys():
-        lower_threshold = param.param["alignImages"]["lower_threshold"]
-    else:
-        lower_threshold = 0.999
-        
-    if "higher_threshold" in param.param["alignImages"].keys():
-        higher_threshold = param.param["alignImages"]["higher_threshold"]
-    else:
-        higher_threshold = 0.9999999
-
-    if "alignByBlock" in param.param["alignImages"].keys():
-        alignByBlock = param.param["alignImages"]["alignByBlock"]
-    else:
-        alignByBlock = False
 
-    if "tolerance" in param.param["alignImages"].keys():
-        tolerance = param.param["alignImages"]["tolerance"]
-    else:
-        tolerance = 0.1
+    alignmentParameters = getsAlignmentParameters(param)
+    lower_threshold = alignmentParameters["lower_threshold"]
+    higher_threshold = alignmentParameters["higher_threshold"]
+    alignByBlock = alignmentParameters["alignByBlock"]
+    tolerance = alignmentParameters["toleranceRMS"]
 
     if not alignByBlock:
         # [calculates unique translation for the entire image using cross-correlation]
@@ -195,7 +450,13 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
             image2_adjusted) = align2ImagesCrossCorrelation(image1_uncorrected, 
                                          image2_uncorrected,
                                          lower_threshold=lower_threshold, 
-                                         higher_threshold=higher_threshold)
+                                         higher_threshold=higher_threshold,
+                                         reference=reference.crossCorrelation,
+                                         pyramidLevels=alignmentParameters["pyramidLevels"],
+                                         pyramidCrop=alignmentParameters["pyramidCrop"],
+                                         guess=guess,
+                                         guessCrop=alignmentParameters["driftCrop"],
+                                         guessTolerance=alignmentParameters["driftTolerance"])
     
         # displays intensity histograms
         displaysEqualizationHistograms(I_histogram, lower_threshold, outputFileName, log1, verbose)
@@ -204,14 +465,14 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
         # [calculates block translations by cross-correlation and gets overall shift by polling]
         
         # normalizes images
-        image1_uncorrected, image2_uncorrected=np.float32(image1_uncorrected), np.float32(image2_uncorrected)
+        image2_uncorrected=np.float32(image2_uncorrected)
 
         # matches histograms
-        image2_uncorrected=np.float32(match_histograms(image2_uncorrected,image1_uncorrected))
+        image2_uncorrected=matchesHistogram(image2_uncorrected,reference.histogram)
         
         # calculates block shifts and polls for most favourable shift
-        upsample_factor=100
-        blockSize=(256,256)
+        upsample_factor=alignmentParameters["upsample_factor"]
+        blockSize=alignmentParameters["blockSize"]
 
         (   shift, 
             error, 
@@ -224,18 +485,26 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
                                     log1,
                                     upsample_factor=upsample_factor,
                                     minNumberPollsters=4,
-                                    tolerance=tolerance)
+                                    tolerance=tolerance,
+                                    reference=reference.blocks,
+                                    guess=guess,
+                                    guessCrop=alignmentParameters["driftCrop"])
         diffphase=0
         
-        plottingBlockALignmentResults(relativeShifts, rmsImage, contour, fileName=outputFileName + "_block_alignments.png")
-
-        writeString2File(log1.fileNameMD, "{}\n ![]({})\n".format(os.path.basename(outputFileName), 
-                                                              outputFileName + "_block_alignments.png"), "a")
+        if queuesFigure(
+            param,
+            plottingBlockALignmentResults,
+            (relativeShifts, rmsImage, contour),
+            kwargs={"fileName": outputFileName + "_block_alignments.png"},
+            level="summary",
+        ):
+            log1.addMarkdown("{}\n ![]({})\n".format(os.path.basename(outputFileName), 
+                                                     outputFileName + "_block_alignments.png"))
 
        
         # saves mask of valid regions with a correction within the tolerance
-        saveImage2Dcmd(rmsImage, outputFileName + "_rmsBlockMap", log1)
-        saveImage2Dcmd(relativeShifts, outputFileName + "_errorAlignmentBlockMap", log1)
+        saveImage2Dcmd(rmsImage, outputFileName + "_rmsBlockMap", log1, param=param)
+        saveImage2Dcmd(relativeShifts, outputFileName + "_errorAlignmentBlockMap", log1, param=param)
         
     image2_corrected_raw = shiftImage(image2_uncorrected, shift)
 
@@ -251,13 +520,24 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
     image1_uncorrected[image1_uncorrected < 0] = 0
     image2_uncorrected[image2_uncorrected < 0] = 0
 
-    save2imagesRGB(image1_uncorrected, image2_corrected_raw, outputFileName + "_overlay_corrected.png")
+    # figures are rendered at the end of the run, binned down or skipped depending on the render level
+    figures = [outputFileName + "_overlay_corrected.png", outputFileName + "_referenceDifference.png"]
+    queued = [
+        queuesFigure(
+            param, save2imagesRGB, (image1_uncorrected, image2_corrected_raw, figures[0]), images=(0, 1),
+        ),
+        queuesFigure(
+            param,
+            saveImageDifferences,
+            (image1_uncorrected, image2_uncorrected, image1_uncorrected, image2_corrected_raw, figures[1]),
+            images=(0, 1, 2, 3),
+        ),
+    ]
 
-    saveImageDifferences(image1_uncorrected, image2_uncorrected, image1_uncorrected, image2_corrected_raw, outputFileName + "_referenceDifference.png")
-    
     # reports image in MD file
-    writeString2File(log1.fileNameMD, "{}\n ![]({})\n ![]({})\n".format(os.path.basename(outputFileName), 
-                                                              outputFileName + "_overlay_corrected.png",outputFileName + "_referenceDifference.png"), "a")
+    if any(queued):
+        log1.addMarkdown("{}\n".format(os.path.basename(outputFileName)) + 
+                         "".join([" ![]({})\n".format(x) for x, y in zip(figures, queued) if y]))
 
     # outputs results to logfile
     alignmentOutput = dataFolder.outputFiles["alignImages"]
@@ -277,7 +557,18 @@ def align2Files(fileName, imReference, param, log1, session1, dataFolder, verbos
     ]
 
     # saves registered fiducial image
-    saveImage2Dcmd(image2_corrected_raw, outputFileName + "_2d_registered", log1)
+    saveImage2Dcmd(image2_corrected_raw, outputFileName + "_2d_registered", log1, param=param)
+
+    outputs = [outputFileName + "_2d_registered.npy"]
+    if alignByBlock:
+        outputs += [outputFileName + "_rmsBlockMap.npy", outputFileName + "_errorAlignmentBlockMap.npy"]
+    cache.save(
+        "alignImages",
+        fileName2,
+        key,
+        outputs,
+        result=getsAlignmentPayload(shift, tableEntry),
+    )
 
     del Im2
     return shift, tableEntry
@@ -293,7 +584,7 @@ def alignImagesInCurrentFolder(currentFolder,param,dataFolder,log1,session1,file
     )
     
     # initializes variables
-    filesFolder = glob.glob(currentFolder + os.sep + "*.tif")
+    filesFolder = listsImages(currentFolder, param)
     dataFolder.createsFolders(currentFolder, param)
     dictShifts = {}  # defaultdict(dict) # contains dictionary of shifts for each folder
     
@@ -312,72 +603,164 @@ def alignImagesInCurrentFolder(currentFolder,param,dataFolder,log1,session1,file
     # retrieves the list of fiducial image files to be aligned
     fileNameReferenceList, ROIList = RT2fileName(param, referenceBarcode)
     
+    # cycles are registered near the shift predicted by the drift trajectory of their ROI, which needs all of them
+    usesTrajectory = getsAlignmentParameters(param)["driftTrajectory"] and fileName is None
+    trajectories = {}
+
     if len(fileNameReferenceList) > 0:
 
+        if param.param['parallel']:
+            # the alignments of all ROIs are submitted in a single wave
+            client=get_client()
+            futures=dict()
+
+            # sends parameters, log and folders once to each worker instead of with every task
+            remoteParam, remoteLog, remoteFolder = client.scatter([param, log1, dataFolder], broadcast=True)
+
+            # reference and cycles of each ROI waiting for its seed cycles to be aligned
+            pending = dict()
+
         # loops over fiducials images one ROI at a time
         for fileNameReference in fileNameReferenceList:
     
-            # loads reference fiducial image for this ROI
             ROI = ROIList[fileNameReference]
-            imReference = Image(param,log1)
-            imReference.loadImage2D(fileNameReference, log1, dataFolder.outputFolders["zProject"])
-            log1.report("Loading reference Image {}".format(fileNameReference))
-
-            # saves reference 2D image of fiducial
-            if not os.path.exists(imReference.getImageFileName(dataFolder.outputFolders["alignImages"], tag="_2d_registered")):
-                imReference.saveImage2D(
-                    log1, dataFolder.outputFolders["alignImages"], tag="_2d_registered",
-                )
-
             dictShiftROI = {}
+            dictShifts["ROI:" + ROI] = dictShiftROI
+
+            # the reference of the ROI is only prepared if a cycle needs to be aligned
+            reference = None
 
             fileName2ProcessList = [x for x in param.fileList2Process if (x not in fileNameReference) and param.decodesFileParts(os.path.basename(x))['roi']==ROI]
             print("Found {} files in ROI: {}".format(len(fileName2ProcessList),ROI))
             print("[roi:cycle] {}".format("|".join([str(param.decodesFileParts(os.path.basename(x))['roi'])+":"+str(param.decodesFileParts(os.path.basename(x))['cycle'])\
                                                for x in fileName2ProcessList])))
+
+            trajectory = driftTrajectory(fileNameReference, fileName2ProcessList, param) if usesTrajectory else None
+            trajectories[ROI] = trajectory
                 
             if param.param['parallel']:
                 # running in parallel mode
-                client=get_client()
-                futures=list()
-                labels=[]
-                
+                fileNames2Align = []
                 for fileName2Process in fileName2ProcessList:
                     # excludes the reference fiducial and processes files in the same ROI
-                    labels.append(os.path.basename(fileName2Process).split("_")[2])
-                    futures.append(client.submit(align2Files,fileName2Process, imReference, param, log1, session1, dataFolder, verbose))
-
-                log1.info("Waiting for {} results to arrive".format(len(futures)))
-
-                results=client.gather(futures)
-
-                log1.info("Retrieving {} results from cluster".format(len(results)))
-
-                for result, label in zip(results,labels):
-                    shift, tableEntry = result
-                    dictShiftROI[label] = shift.tolist()
-                    alignmentResultsTable.add_row(tableEntry)
-                    session1.add(fileName2Process, sessionName)
-                    # print("Processed: {}".format(label))
+                    label = os.path.basename(fileName2Process).split("_")[2]
+                    record = session1.isCompleted(sessionName, fileName2Process)
+                    if record is not None:
+                        # aligned in the run being resumed
+                        dictShiftROI[label] = record["payload"]["shift"]
+                        alignmentResultsTable.add_row(record["payload"]["tableEntry"])
+                        writeString2File(dataFolder.outputFiles["alignImages"], "{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}".format(*record["payload"]["tableEntry"]), "a")
+                        if trajectory is not None:
+                            trajectory.adds(fileName2Process, record["payload"]["shift"])
+                    else:
+                        fileNames2Align.append(fileName2Process)
+
+                if len(fileNames2Align) > 0:
+                    # prepared in a task, and sent by the scheduler once to each worker aligning cycles of the ROI
+                    reference = client.submit(preparesAlignmentReference, fileNameReference, remoteParam, remoteLog, remoteFolder,
+                                              resources=getsTaskResources("alignImages"))
+
+                    # seed cycles first, the others once their shift can be predicted
+                    seeds = [x for x in fileNames2Align if trajectory is None or x in trajectory.seeds]
+                    for fileName2Process in seeds:
+                        label = os.path.basename(fileName2Process).split("_")[2]
+                        future = client.submit(align2Files,fileName2Process, reference, remoteParam, remoteLog, None, remoteFolder, verbose,
+                                               resources=getsTaskResources("alignImages"))
+                        futures[future] = (fileName2Process, ROI, label)
+                    pending[ROI] = {"reference": reference, "seeds": len(seeds), "cycles": [x for x in fileNames2Align if x not in seeds]}
             else:
                 # running in sequential mode
-                
+
+                fileNames2Align = []
                 for fileName2Process in param.fileList2Process:
                     # excludes the reference fiducial and processes files in the same ROI
                     label = os.path.basename(fileName2Process).split("_")[2]
                     roi = param.decodesFileParts(os.path.basename(fileName2Process))['roi']
                     
                     if (fileName2Process not in fileNameReference) and roi == ROI:
-                        if fileName==None or (fileName!=None and os.path.basename(fileName)==os.path.basename(fileName2Process)):
-                            # aligns files and saves results to database in dict format and to a Table
-                            shift, tableEntry = align2Files(fileName2Process, imReference, param, log1, session1, dataFolder, verbose,)
-                            dictShiftROI[label] = shift.tolist()
-                            alignmentResultsTable.add_row(tableEntry)
-                            session1.add(fileName2Process, sessionName)
-                    
-            # accumulates shifst for this ROI into global dictionary
-            dictShifts["ROI:" + ROI] = dictShiftROI
-            del imReference
+                        record = session1.isCompleted(sessionName, fileName2Process)
+                        if record is not None:
+                            # aligned in the run being resumed
+                            dictShiftROI[label] = record["payload"]["shift"]
+                            alignmentResultsTable.add_row(record["payload"]["tableEntry"])
+                            writeString2File(dataFolder.outputFiles["alignImages"], "{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}".format(*record["payload"]["tableEntry"]), "a")
+                            if trajectory is not None:
+                                trajectory.adds(fileName2Process, record["payload"]["shift"])
+                        elif fileName==None or (fileName!=None and os.path.basename(fileName)==os.path.basename(fileName2Process)):
+                            fileNames2Align.append(fileName2Process)
+
+                # seed cycles first, the others near the shift predicted from the cycles aligned before them
+                if trajectory is not None:
+                    fileNames2Align = [x for x in fileNames2Align if x in trajectory.seeds] + [x for x in fileNames2Align if x not in trajectory.seeds]
+
+                for fileName2Process in fileNames2Align:
+                    label = os.path.basename(fileName2Process).split("_")[2]
+                    if reference is None:
+                        reference = preparesAlignmentReference(fileNameReference, param, log1, dataFolder)
+                    guess = None
+                    if trajectory is not None and fileName2Process not in trajectory.seeds:
+                        guess = trajectory.predicts(fileName2Process, exclude=trajectory.findsOutliers()[0])
+
+                    # aligns files and saves results to database in dict format and to a Table
+                    shift, tableEntry = align2Files(fileName2Process, reference, param, log1, session1, dataFolder, verbose, guess=guess)
+                    dictShiftROI[label] = shift.tolist()
+                    alignmentResultsTable.add_row(tableEntry)
+                    session1.add(fileName2Process, sessionName, outputs=[getsRegisteredFileName(fileName2Process, dataFolder)],
+                                 payload=getsAlignmentPayload(shift, tableEntry))
+                    if trajectory is not None:
+                        trajectory.adds(fileName2Process, shift)
+
+            # the cluster releases the reference once the alignments of the ROI are done
+            del reference
+
+        if param.param['parallel']:
+            log1.info("Waiting for {} results to arrive".format(len(futures)))
+            results = as_completed(futures, with_results=True)
+
+            def submitsCycles(ROI):
+                # submits the cycles of ROI left after its seeds, near the shifts predicted from them
+                for fileName2Process in pending[ROI]["cycles"]:
+                    label = os.path.basename(fileName2Process).split("_")[2]
+                    guess = trajectories[ROI].predicts(fileName2Process, exclude=trajectories[ROI].findsOutliers()[0])
+                    future = client.submit(align2Files,fileName2Process, pending[ROI]["reference"], remoteParam, remoteLog, None, remoteFolder, verbose,
+                                           guess=guess, resources=getsTaskResources("alignImages"))
+                    futures[future] = (fileName2Process, ROI, label)
+                    results.add(future)
+                del pending[ROI]
+
+            for ROI in [x for x in pending.keys() if pending[x]["seeds"] == 0]:
+                submitsCycles(ROI)
+
+            # records results as they arrive, from all ROIs
+            for future, result in results:
+                fileName2Process, ROI, label = futures.pop(future)
+                shift, tableEntry = result
+                dictShifts["ROI:" + ROI][label] = shift.tolist()
+                alignmentResultsTable.add_row(tableEntry)
+                session1.add(fileName2Process, sessionName, outputs=[getsRegisteredFileName(fileName2Process, dataFolder)],
+                             payload=getsAlignmentPayload(shift, tableEntry))
+                if trajectories[ROI] is not None:
+                    trajectories[ROI].adds(fileName2Process, shift)
+
+                if ROI in pending and trajectories[ROI] is not None and fileName2Process in trajectories[ROI].seeds:
+                    pending[ROI]["seeds"] -= 1
+                    if pending[ROI]["seeds"] == 0:
+                        submitsCycles(ROI)
+
+            log1.info("Retrieved results from cluster")
+
+        if usesTrajectory:
+            # flags the cycles that depart from the drift trajectory of their ROI
+            summary = {}
+            for ROI, trajectory in trajectories.items():
+                summary["ROI:" + ROI] = trajectory.summarizes()
+                for cycle, entry in summary["ROI:" + ROI].items():
+                    if entry["outlier"]:
+                        log1.report(
+                            "Shift of {} departs by {:.1f} px from the drift trajectory of ROI {}".format(cycle, entry["deviation"], ROI),
+                            "Warning",
+                        )
+            saveJSON(os.path.splitext(dataFolder.outputFiles["dictShifts"])[0] + "_driftTrajectory.json", summary)
     
         # saves dicShifts dictionary with shift results
         saveJSON(os.path.splitext(dataFolder.outputFiles["dictShifts"])[0] + ".json", dictShifts)
@@ -408,16 +791,14 @@ def alignImages(param, log1, session1, fileName=None):
     """
     sessionName = "registersImages"
 
-    if param.param["alignImages"]["operation"] == "overwrite":
+    if param.param["alignImages"]["operation"] in ["overwrite", "skip"]:
 
         # processes folders and adds information to log files
         dataFolder = folders(param.param["rootFolder"])
         dataFolder.setsFolders()
         log1.addSimpleText("\n===================={}====================\n".format(sessionName))
         log1.report("folders read: {}".format(len(dataFolder.listFolders)))
-        writeString2File(
-            log1.fileNameMD, "## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]), "a",
-        )
+        log1.addMarkdown("## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]))
 
 
         # loops over folders
@@ -431,6 +812,7 @@ def alignImages(param, log1, session1, fileName=None):
         
         del dataFolder
 
+@profilesTask("registersImages")
 def appliesRegistrations2fileName(fileName2Process,param,dataFolder,log1,session1,dictShifts):
     '''
     Applies registration of fileName2Process
@@ -443,12 +825,14 @@ def appliesRegistrations2fileName(fileName2Process,param,dataFolder,log1,session
     dataFolder : dataFolder class
     log1 : log class
     session1 : Session class
+        journals the registered file. None in dask workers, the driver journals it.
     dictShifts : Dictionnary
         contains the shifts to be applied to all ROIs
 
     Returns
     -------
-    None.
+    registered : boolean
+        False if no shift was found for this file, e.g. in streaming mode if its fiducial is not aligned yet.
 
     '''
     # session
@@ -468,7 +852,19 @@ def appliesRegistrations2fileName(fileName2Process,param,dataFolder,log1,session
             "Could not find dictionary with alignment parameters for this ROI: {}, label: {}".format(ROI, label), "ERROR",
         )
 
-    if shiftArray != None:
+    # the shift applied is part of the key, so that new alignments invalidate registered images
+    cache = stageCache(dataFolder.outputFolders["stageCache"])
+    key = cache.getKey(
+        appliesRegistrations2fileName,
+        [dataFolder.outputFolders["zProject"] + os.sep + os.path.basename(fileName2Process).split(".")[0] + "_2d.npy"],
+        {"shift": shiftArray},
+    )
+    outputFile = dataFolder.outputFolders["alignImages"] + os.sep + os.path.basename(fileName2Process).split(".")[0] + "_2d_registered.npy"
+
+    if param.param["alignImages"]["operation"] != "overwrite" and cache.load("registersImages", fileName2Process, key) is not None:
+        log1.report("File already registered: {}".format(os.path.basename(fileName2Process)))
+        registered = True
+    elif shiftArray != None:
 
         shift = np.asarray(shiftArray)
         # loads 2D image and applies registration
@@ -483,23 +879,30 @@ def appliesRegistrations2fileName(fileName2Process,param,dataFolder,log1,session
         Im.saveImage2D(
             log1, dataFolder.outputFolders["alignImages"], tag="_2d_registered",
         )
-
-        # logs output
-        session1.add(fileName2Process, sessionName)
+        cache.save("registersImages", fileName2Process, key, [outputFile])
+        registered = True
     elif shiftArray == None and label == param.param["alignImages"]["referenceFiducial"]:
         Im = Image(param,log1)
         Im.loadImage2D(fileName2Process, log1, dataFolder.outputFolders["zProject"])
         Im.saveImage2D(
             log1, dataFolder.outputFolders["alignImages"], tag="_2d_registered",
         )
+        cache.save("registersImages", fileName2Process, key, [outputFile])
         log1.report(
             "Saving image for referenceRT ROI:{}, label:{}".format(ROI, label), "Warning",
         )
-
+        registered = True
     else:
         log1.report(
             "No shift found in dictionary for ROI:{}, label:{}".format(ROI, label), "Warning",
         )
+        registered = False
+
+    # logs output. Files without a shift yet are not journaled, so that they are registered later
+    if registered and session1 is not None:
+        session1.add(fileName2Process, sessionName, outputs=[outputFile])
+
+    return registered
 
 def appliesRegistrations2currentFolder(currentFolder,param,dataFolder,log1,session1,fileName=None):
     '''
@@ -523,7 +926,7 @@ def appliesRegistrations2currentFolder(currentFolder,param,dataFolder,log1,sessi
     '''   
    
     # currentFolder=dataFolder.listFolders[0] # only one folder processed so far...
-    filesFolder = glob.glob(currentFolder + os.sep + "*.tif")
+    filesFolder = listsImages(currentFolder, param)
     dataFolder.createsFolders(currentFolder, param)
     log1.report("-------> Processing Folder: {}".format(currentFolder))
     
@@ -540,9 +943,24 @@ def appliesRegistrations2currentFolder(currentFolder,param,dataFolder,log1,sessi
     log1.report("About to process {} files\n".format(len(param.fileList2Process)))
     
     if len(param.fileList2Process) > 0:
-        # loops over files in file list
-        for fileName2Process in param.fileList2Process:
-            if fileName==None or (fileName!=None and os.path.basename(fileName)==os.path.basename(fileName2Process)):
+        fileName2ProcessList = [x for x in param.fileList2Process if fileName==None or (fileName!=None and os.path.basename(fileName)==os.path.basename(x))]
+        fileName2ProcessList = [x for x in fileName2ProcessList if session1.isCompleted("registersImages", x) is None]
+
+        if param.param['parallel']:
+            # running in parallel mode: one task per file
+            client=get_client()
+            futures={client.submit(appliesRegistrations2fileName,x,param,dataFolder,log1,None,dictShifts,
+                                   resources=getsTaskResources("registersImages")) : x for x in fileName2ProcessList}
+
+            log1.info("Waiting for {} registrations to complete".format(len(futures)))
+            for future, registered in as_completed(futures, with_results=True):
+                # the journal is only written by the driver. Files without a shift yet are not
+                # journaled, so that they are registered later
+                if registered:
+                    session1.add(futures[future], "registersImages", outputs=[getsRegisteredFileName(futures[future], dataFolder)])
+        else:
+            # loops over files in file list
+            for fileName2Process in fileName2ProcessList:
                 appliesRegistrations2fileName(fileName2Process,param,dataFolder,log1,session1,dictShifts)
 
             
@@ -556,7 +974,7 @@ def appliesRegistrations(param, log1, session1, fileName=None):
     sessionName = "registersImages"
 
     # verbose=False
-    if param.param["alignImages"]["operation"] == "overwrite":
+    if param.param["alignImages"]["operation"] in ["overwrite", "skip"]:
 
         # processes folders and files
         dataFolder = folders(param.param["rootFolder"])
@@ -12,13 +12,13 @@ Classes and functions for common image processing
 # =============================================================================
 
 import os
+import colorsys
+import functools
 import numpy as np
 
-from skimage import io
 import scipy.optimize as spo
 import matplotlib.pyplot as plt
-import cv2
-from numba import jit
+from matplotlib.colors import ListedColormap
 
 from skimage import exposure
 from astropy.visualization.mpl_normalize import ImageNormalize
@@ -33,10 +33,11 @@ from skimage import measure
 from scipy.ndimage import shift as shiftImage
 from skimage.exposure import match_histograms
 from skimage.registration import phase_cross_correlation
+from scipy import fft as scipyFFT
 
+from fileProcessing.fileManagement import getsLocalFileName, savesIntermediate, loadsIntermediate
+from fileProcessing.imageStore import readsImage, readsPlanes, readsShape
 
-from astropy.stats import SigmaClip
-from photutils import Background2D, MedianBackground
 
 # =============================================================================
 # CLASSES
@@ -54,18 +55,28 @@ class Image:
         self.imageSize = -1
         self.focusPlane = -1
         self.extension = ""
+        self.zOffset = 0
 
     # read an image as a numpy array
-    def loadImage(self, fileName):
-        self.data = io.imread(fileName).squeeze()
+    def loadImage(self, fileName, zRange=None, crop=None):
+        """
+        reads the image of fileName, or only the planes in zRange=(zmin, zmax) and the
+        region crop=((ymin, ymax), (xmin, xmax)). imageSize is the size of the full image
+        and zOffset the index of its first plane in data.
+
+        """
+        # reads the copy in the local scratch of this node if there is one
+        self.data, self.imageSize = readsImage(
+            fileName, self.param, zRange=zRange, crop=crop, localFileName=getsLocalFileName(fileName, self.param)
+        )
         self.fileName = fileName
-        self.imageSize = self.data.shape
+        self.zOffset = 0 if zRange is None else max(0, zRange[0])
         self.extension = fileName.split(".")[-1]
 
     # save 2D projection as numpy array
     def saveImage2D(self, log, rootFolder, tag="_2d"):
         fileName=self.getImageFileName(rootFolder,tag)
-        saveImage2Dcmd(self.data_2D, fileName, log)
+        saveImage2Dcmd(self.data_2D, fileName, log, param=self.param)
         
     def getImageFileName(self,rootFolder,tag):
         fileName = rootFolder + os.sep + os.path.basename(self.fileName).split(".")[0] + tag
@@ -76,7 +87,7 @@ class Image:
         self.fileName = fileName
         fileName=self.getImageFileName(masterFolder,tag)+ ".npy"
 
-        self.data_2D = np.load(fileName)
+        self.data_2D = loadsIntermediate(fileName, self.param)
         log.report(
             "\nLoading from disk:{}".format(os.path.basename(fileName)), "info",
         )
@@ -124,18 +135,26 @@ class Image:
         # self.log.report("Stage position={}".format(self.stageCoordinates))
         self.log.report("Focal plane={}".format(self.focusPlane))
 
-    # processes sum image in axial direction given range
-    # @jit(nopython=True) 
-    def zProjectionRange(self):
+    # finds the planes to project
+    def findsZrange(self, stdMatrix=None, focusPlane=None):
+        """
+        returns (focusPlane, zRange) of the projection set in the parameters file. In automatic
+        mode stdMatrix holds the standard deviation of the planes from 0 to zmax-zmin, unless
+        the focal plane is given by focusPlane.
 
+        """
         # find the correct range for the projection
         if self.param.param["zProject"]["zmax"] > self.imageSize[0]:
             self.log.report("Setting z max to the last plane")
             self.param.param["zProject"]["zmax"] = self.imageSize[0]
 
-        if self.param.param["zProject"]["mode"] == "automatic":
+        if self.param.param["zProject"]["mode"] == "automatic" and focusPlane is not None:
+            # reuses the focal plane of another image, e.g. the reference of the ROI
+            numPlanes = self.param.param["zProject"]["zmax"] - self.param.param["zProject"]["zmin"]
+            zRange = (focusPlane, getsZwindow(focusPlane, numPlanes, self.param))
+        elif self.param.param["zProject"]["mode"] == "automatic":
             print("Calculating planes...")
-            zRange = calculate_zrange(self.data, self.param)
+            zRange = findsFocalPlane(stdMatrix, self.param)
         elif self.param.param["zProject"]["mode"] == "full":
             (zmin, zmax) = (0, self.imageSize[0])
             zRange = (round((zmin + zmax) / 2), range(zmin, zmax))
@@ -151,17 +170,67 @@ class Image:
 
         self.log.report("Processing zRange:{}".format(zRange))
 
-        # sums images
-        I_collapsed = np.zeros((self.imageSize[1], self.imageSize[2]))
-        if self.param.param["zProject"]["zProjectOption"] == "MIP":
-            # Max projection of selected planes
-            I_collapsed = np.max(self.data[zRange[1][0] : zRange[1][-1]], axis=0)
-        else:
-            # Sums selected planes
-            for i in zRange[1]:
-                I_collapsed += self.data[i]
+        return zRange
+
+    # processes sum image in axial direction given range
+    def zProjectionRange(self):
+
+        stdMatrix = None
+        if self.param.param["zProject"]["mode"] == "automatic":
+            numPlanes = min(self.param.param["zProject"]["zmax"], self.imageSize[0]) - self.param.param["zProject"]["zmin"]
+            stdMatrix = calculatesPlaneStd(enumerate(self.data[:numPlanes]), numPlanes)
+
+        zRange = self.findsZrange(stdMatrix)
+
+        # projects images. data may only hold the planes from zOffset
+        zmin, zmax = getsProjectedPlanes(zRange[1], self.param.param["zProject"]["zProjectOption"])
+        planes = [(z, self.data[z - self.zOffset]) for z in range(zmin, zmax)]
+        self.data_2D = projectsPlanes(
+            planes, (self.imageSize[1], self.imageSize[2]), self.param.param["zProject"]["zProjectOption"], zmax - zmin
+        )
+        self.zRange = zRange[1]
+        self.focusPlane = zRange[0]
+
+    def findsZrangeStreaming(self, fileName, focusPlane=None):
+        """
+        sets the properties of the image of fileName and returns (focusPlane, zRange) of its
+        projection. In automatic mode, the planes are read one at a time to find the focal
+        plane, unless it is given by focusPlane.
+
+        """
+        self.fileName = fileName
+        self.extension = fileName.split(".")[-1]
+        self.imageSize = readsShape(fileName, self.param)
+        self.zOffset = 0
+
+        stdMatrix = None
+        if self.param.param["zProject"]["mode"] == "automatic" and focusPlane is None:
+            numPlanes = min(self.param.param["zProject"]["zmax"], self.imageSize[0]) - self.param.param["zProject"]["zmin"]
+            planes = readsPlanes(
+                fileName, self.param, zRange=(0, numPlanes), localFileName=getsLocalFileName(fileName, self.param)
+            )
+            stdMatrix = calculatesPlaneStd(planes, numPlanes)
+
+        return self.findsZrange(stdMatrix, focusPlane=focusPlane)
 
-        self.data_2D = I_collapsed
+    def zProjectionStreaming(self, fileName, focusPlane=None):
+        """
+        Same projection as loadImage() followed by zProjectionRange(), reading the planes of
+        fileName one at a time so that only a few planes and the accumulator are in memory.
+
+        In automatic mode, a first pass calculates the standard deviation of each plane to find
+        the focal plane, and a second pass reads the planes of the window around it. focusPlane
+        skips the first pass.
+
+        """
+        zRange = self.findsZrangeStreaming(fileName, focusPlane=focusPlane)
+        localFileName = getsLocalFileName(fileName, self.param)
+
+        zmin, zmax = getsProjectedPlanes(zRange[1], self.param.param["zProject"]["zProjectOption"])
+        planes = readsPlanes(fileName, self.param, zRange=(zmin, zmax), localFileName=localFileName)
+        self.data_2D = projectsPlanes(
+            planes, (self.imageSize[1], self.imageSize[2]), self.param.param["zProject"]["zProjectOption"], zmax - zmin
+        )
         self.zRange = zRange[1]
         self.focusPlane = zRange[0]
 
@@ -201,6 +270,10 @@ class Image:
             plt.close(fig)
 
     def removesBackground2D(self, normalize=False):
+        # photutils is slow to import and only needed here
+        from astropy.stats import SigmaClip
+        from photutils import Background2D, MedianBackground
+
         sigma_clip = SigmaClip(sigma=3.0)
         bkg_estimator = MedianBackground()
         bkg = Background2D(
@@ -220,6 +293,23 @@ class Image:
 # =============================================================================
 
 
+@functools.lru_cache()
+def randomLabelColormap(n=2 ** 16, h=(0, 1), l=(0.4, 1), s=(0.2, 0.8), seed=0):
+    """
+    returns a colormap with random colors to display labeled masks, label 0 in black.
+    Same as stardist.random_label_cmap, which is not imported to avoid loading tensorflow.
+    Colors come from their own generator with a fixed seed, so that a label has the same
+    color in every figure and the global random state is left untouched.
+
+    """
+    rng = np.random.default_rng(seed)
+    h, l, s = rng.uniform(*h, n), rng.uniform(*l, n), rng.uniform(*s, n)
+    cols = np.stack([colorsys.hls_to_rgb(_h, _l, _s) for _h, _l, _s in zip(h, l, s)], axis=0)
+    cols[0] = 0
+    return ListedColormap(cols)
+
+
+
 # Gaussian function
 # @jit(nopython=True) 
 def gaussian(x, a=1, mean=0, std=0.5):
@@ -228,20 +318,35 @@ def gaussian(x, a=1, mean=0, std=0.5):
 
 # Finds best focal plane by determining the max of the std deviation vs z curve
 
-# @jit(nopython=True) 
+def calculatesPlaneStd(planes, numPlanes):
+    """
+    returns the standard deviation of each of the (z, plane) in planes, in a single pass
+
+    """
+    stdMatrix = np.zeros(numPlanes)
+    for z, plane in planes:
+        stdMatrix[z] = np.std(plane)
+
+    return stdMatrix
+
+
 def calculate_zrange(idata, parameters):
     """
     Calculates the focal planes based max standard deviation
     """
-    zwin = parameters.param["zProject"]["zwindows"]
     numPlanes = parameters.param["zProject"]["zmax"] - parameters.param["zProject"]["zmin"]
-    stdMatrix = np.zeros(numPlanes)
-    meanMatrix = np.zeros(numPlanes)
+    stdMatrix = calculatesPlaneStd(enumerate(idata[:numPlanes]), numPlanes)
+
+    return findsFocalPlane(stdMatrix, parameters)
 
-    # calculate STD in each plane
-    for i in range(0, numPlanes):
-        stdMatrix[i] = np.std(idata[i])
-        meanMatrix[i] = np.mean(idata[i])
+
+def findsFocalPlane(stdMatrix, parameters):
+    """
+    Finds the focal plane from the standard deviation of the planes and returns it with the
+    range of planes to project around it
+    """
+    stdMatrix = np.array(stdMatrix, dtype=float)
+    numPlanes = len(stdMatrix)
 
     maxStd = np.max(stdMatrix)
     ifocusPlane = np.where(stdMatrix == maxStd)[0][0]
@@ -279,6 +384,14 @@ def calculate_zrange(idata, parameters):
             print("Warning, too many iterations")
             focusPlane = ifocusPlane
 
+    return focusPlane, getsZwindow(focusPlane, numPlanes, parameters)
+
+
+def getsZwindow(focusPlane, numPlanes, parameters):
+    """
+    returns the range of planes to project around focusPlane
+
+    """
     zmin = max(parameters.param["zProject"]["windowSecurity"], focusPlane - parameters.param["zProject"]["zwindows"],)
     zmax = min(
         numPlanes,
@@ -287,7 +400,80 @@ def calculate_zrange(idata, parameters):
     )
     zrange = range(zmin, zmax + 1)
 
-    return focusPlane, zrange
+    return zrange
+
+
+def getsProjectedPlanes(zRange, zProjectOption):
+    """
+    returns the (zmin, zmax) planes read to project zRange, zmax excluded. MIP leaves out
+    the last plane of zRange.
+
+    """
+    if zProjectOption == "MIP":
+        return zRange[0], zRange[-1]
+    else:
+        return zRange[0], zRange[-1] + 1
+
+
+def getsAccumulatorType(dtype, numPlanes):
+    """
+    returns the type of the accumulator of the sum of numPlanes planes of type dtype: integers
+    are summed exactly in the smallest unsigned or signed integer that cannot overflow, other
+    types in float64
+
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "bu":
+        maximum = numPlanes * int(np.iinfo(dtype).max if dtype.kind == "u" else 1)
+        return np.uint32 if maximum <= np.iinfo(np.uint32).max else np.uint64
+    elif dtype.kind == "i":
+        maximum = numPlanes * max(-int(np.iinfo(dtype).min), int(np.iinfo(dtype).max))
+        return np.int32 if maximum <= np.iinfo(np.int32).max else np.int64
+    else:
+        return np.float64
+
+
+def projectsPlanes(planes, shape, zProjectOption="sum", numPlanes=None):
+    """
+    Projects the (z, plane) in planes keeping a single accumulator in memory
+
+    Parameters
+    ----------
+    planes : iterable
+        (z, plane) of the planes to project, e.g. from readsPlanes.
+    shape : tuple
+        shape of the planes, used if planes is empty.
+    zProjectOption : string, optional
+        "MIP" or "sum". The default is "sum".
+    numPlanes : int, optional
+        number of planes, used to choose the accumulator of the sum. The default is None: 64 bit.
+
+    Returns
+    -------
+    projection : npy array
+        float64 for the sum, the type of the planes for MIP.
+
+    """
+    accumulator = None
+    for _, plane in planes:
+        if accumulator is None:
+            if zProjectOption == "MIP":
+                accumulator = np.array(plane, copy=True)
+                continue
+            accumulatorType = getsAccumulatorType(plane.dtype, numPlanes if numPlanes is not None else 2 ** 32)
+            accumulator = np.zeros(plane.shape, dtype=accumulatorType)
+
+        if zProjectOption == "MIP":
+            np.maximum(accumulator, plane, out=accumulator)
+        else:
+            np.add(accumulator, plane, out=accumulator, casting="unsafe")
+
+    if accumulator is None:
+        return np.zeros(shape)
+    elif zProjectOption == "MIP":
+        return accumulator
+    else:
+        return accumulator.astype(np.float64)
 
 
 def imageAdjust(image, lower_threshold=0.3, higher_threshold=0.9999):
@@ -370,20 +556,153 @@ def saveImageDifferences(I1, I2, I3, I4, outputFileName):
 
 
 
-def saveImage2Dcmd(image, fileName, log):
+def saveImage2Dcmd(image, fileName, log, param=None):
     if image.shape > (1, 1):
-        np.save(fileName, image)
-        # log.report("Saving 2d projection to disk:{}\n".format(os.path.basename(fileName)),'info')
-        log.report("Image saved to disk: {}".format(fileName + ".npy"), "info")
+        # intermediates go to the container of their ROI if set in the parameters file
+        containerName = savesIntermediate(image, fileName + ".npy", param) if param is not None else None
+        if containerName is not None:
+            log.report("Image saved to container: {}:{}".format(containerName, os.path.basename(fileName)), "info")
+        else:
+            np.save(fileName, image)
+            # log.report("Saving 2d projection to disk:{}\n".format(os.path.basename(fileName)),'info')
+            log.report("Image saved to disk: {}".format(fileName + ".npy"), "info")
     else:
         log.report("Warning, image is empty", "Warning")
 
 
+def downsamplesImage(image, factor):
+    # bins image by factor x factor pixels, dropping the last rows and columns that do not fill a bin
+    ny, nx = image.shape[0] // factor, image.shape[1] // factor
+    return image[: ny * factor, : nx * factor].reshape(ny, factor, nx, factor).mean(axis=(1, 3))
+
+
+def findsCropWindow(image1, shift, cropSize):
+    """
+    returns the origin (y0, x0) of the cropSize window of image1 with the most signal whose
+    correspondence in the second image, displaced by shift, is within the image
+
+    """
+    ny, nx = image1.shape
+    ranges = [(max(0, d), min(n, n + d) - cropSize) for n, d in zip((ny, nx), shift)]
+
+    # sums of image1 in the candidate windows, from its integral image
+    integral = np.zeros((ny + 1, nx + 1))
+    integral[1:, 1:] = np.cumsum(np.cumsum(image1, axis=0), axis=1)
+    candidates = [
+        np.unique(np.append(np.arange(lo, hi + 1, max(1, cropSize // 4)), hi)) for lo, hi in ranges
+    ]
+    y0, x0 = np.meshgrid(candidates[0], candidates[1], indexing="ij")
+    sums = integral[y0 + cropSize, x0 + cropSize] - integral[y0, x0 + cropSize] - integral[y0 + cropSize, x0] + integral[y0, x0]
+    best = np.unravel_index(np.argmax(sums), sums.shape)
+
+    return y0[best], x0[best]
+
+
+def registersPyramid(image1, image2, levels=2, cropSize=512, upsample_factor=100):
+    """
+    Coarse-to-fine registration: the shift is estimated on images binned by 2**levels, then
+    refined with subpixel upsampling on a cropSize window of the full resolution images, taken
+    where image1 has most signal and displaced in image2 by the coarse shift.
+
+    For 2048x2048 images, levels=2 and cropSize=512, the FFTs are 16 times smaller than
+    those of a registration at full resolution. Shifts up to half the binned image are found.
+
+    Parameters
+    ----------
+    image1 : npy array
+        reference image.
+    image2 : npy array
+        image to register.
+    levels : int, optional
+        number of halvings of the resolution for the coarse estimate. The default is 2.
+    cropSize : int, optional
+        size of the window of the refinement, in px. The default is 512.
+    upsample_factor : int, optional
+        The default is 100.
+
+    Returns
+    -------
+    shift, error, diffphase : as phase_cross_correlation, for image2 onto image1.
+
+    """
+    factor = 2 ** levels
+    coarseShift, _, _ = phase_cross_correlation(
+        downsamplesImage(image1, factor), downsamplesImage(image2, factor), upsample_factor=1
+    )
+    coarseShift = np.int64(np.round(coarseShift * factor))
+
+    return registersAround(image1, image2, coarseShift, cropSize=cropSize, upsample_factor=upsample_factor)
+
+
+def registersAround(image1, image2, guess, cropSize=512, upsample_factor=100, tolerance=None):
+    """
+    Registers image2 onto image1 near an expected shift: the residual shift is found with
+    subpixel upsampling on a cropSize window of image1, taken where it has most signal, and
+    the window of image2 displaced by guess. Residuals up to half the window are found.
+    The full images are registered if the window does not fit, or if the shift found departs
+    from guess by more than tolerance.
+
+    Parameters
+    ----------
+    image1, image2 : npy arrays
+    guess : list
+        expected shift in y and x of image2 onto image1, rounded to whole px.
+    cropSize : int, optional
+        The default is 512.
+    upsample_factor : int, optional
+        The default is 100.
+    tolerance : float, optional
+        maximum distance in px between the shift and guess. The default is None: no maximum.
+
+    Returns
+    -------
+    shift, error, diffphase : as phase_cross_correlation, for image2 onto image1.
+
+    """
+    guess = np.int64(np.round(guess))
+
+    if any([cropSize > n - abs(d) for n, d in zip(image1.shape, guess)]):
+        # the window does not fit: registers the full images
+        return phase_cross_correlation(image1, image2, upsample_factor=upsample_factor)
+
+    y0, x0 = findsCropWindow(image1, guess, cropSize)
+    y1, x1 = y0 - guess[0], x0 - guess[1]
+    residualShift, error, diffphase = phase_cross_correlation(
+        image1[y0 : y0 + cropSize, x0 : x0 + cropSize],
+        image2[y1 : y1 + cropSize, x1 : x1 + cropSize],
+        upsample_factor=upsample_factor,
+    )
+
+    if tolerance is not None and LA.norm(residualShift) > tolerance:
+        # the guess was off: searches the full images
+        return phase_cross_correlation(image1, image2, upsample_factor=upsample_factor)
+
+    return guess + residualShift, error, diffphase
+
+
+def preparesCrossCorrelationReference(image1_uncorrected, lower_threshold=0.999, higher_threshold=0.9999999, spectrum=True):
+    """
+    returns the contrast adjusted reference image and its FFT, to be reused by
+    align2ImagesCrossCorrelation for all the images aligned against it. The FFT is only
+    needed for registrations at full resolution (spectrum True).
+
+    """
+    adjusted = imageAdjust(image1_uncorrected, lower_threshold=lower_threshold, higher_threshold=higher_threshold)
+
+    return {"adjusted": adjusted, "spectrum": scipyFFT.fftn(adjusted[0]) if spectrum else None}
+
+
 def align2ImagesCrossCorrelation(image1_uncorrected, 
                                  image2_uncorrected,
                                  lower_threshold=0.999, 
                                  higher_threshold=0.9999999,
-                                 upsample_factor=100):
+                                 upsample_factor=100,
+                                 reference=None,
+                                 pyramidLevels=0,
+                                 pyramidCrop=512,
+                                 guess=None,
+                                 guessCrop=256,
+                                 guessTolerance=None):
     """
     Aligns 2 images by contrast adjust and cross correlation
     Parameters
@@ -392,6 +711,21 @@ def align2ImagesCrossCorrelation(image1_uncorrected,
         DESCRIPTION.
     Im2 : TYPE
         DESCRIPTION.
+    reference : dict, optional
+        adjusted image1 and its FFT, from preparesCrossCorrelationReference. The default is None:
+        calculated from image1_uncorrected.
+    pyramidLevels : int, optional
+        registers coarse-to-fine with registersPyramid if > 0. The default is 0: registers the
+        full images.
+    pyramidCrop : int, optional
+        size of the window of the refinement of registersPyramid. The default is 512.
+    guess : list, optional
+        expected shift, e.g. predicted by the drift trajectory of the ROI. If given, the shift
+        is only searched near it, with registersAround. The default is None.
+    guessCrop : int, optional
+        size of the window of registersAround. The default is 256.
+    guessTolerance : float, optional
+        distance to guess beyond which registersAround searches the full images. The default is None.
 
     Returns
     -------
@@ -416,9 +750,11 @@ def align2ImagesCrossCorrelation(image1_uncorrected,
 
     """
 
-    (image1_adjusted, hist1_before, hist1_after, lower_cutoff1, higher_cutoff1,) = imageAdjust(
-        image1_uncorrected, lower_threshold=lower_threshold, higher_threshold=higher_threshold
-    )
+    if reference is None:
+        reference = preparesCrossCorrelationReference(
+            image1_uncorrected, lower_threshold=lower_threshold, higher_threshold=higher_threshold, spectrum=pyramidLevels == 0
+        )
+    (image1_adjusted, hist1_before, hist1_after, lower_cutoff1, higher_cutoff1,) = reference["adjusted"]
     (image2_adjusted, hist2_before, hist2_after, lower_cutoff2, higher_cutoff2,) = imageAdjust(
         image2_uncorrected, lower_threshold=lower_threshold, higher_threshold=higher_threshold
     )
@@ -433,7 +769,20 @@ def align2ImagesCrossCorrelation(image1_uncorrected,
     # calculates shift
     
     # shift, error, diffphase = register_translation(image1_adjusted, image2_adjusted, upsample_factor=upsample_factor)
-    shift, error, diffphase = phase_cross_correlation(image1_adjusted, image2_adjusted, upsample_factor=upsample_factor)
+    if guess is not None:
+        shift, error, diffphase = registersAround(
+            image1_adjusted, image2_adjusted, guess, cropSize=guessCrop, upsample_factor=upsample_factor,
+            tolerance=guessTolerance,
+        )
+    elif pyramidLevels > 0:
+        shift, error, diffphase = registersPyramid(
+            image1_adjusted, image2_adjusted, levels=pyramidLevels, cropSize=pyramidCrop, upsample_factor=upsample_factor
+        )
+    else:
+        spectrum1 = reference["spectrum"] if reference["spectrum"] is not None else scipyFFT.fftn(image1_adjusted)
+        shift, error, diffphase = phase_cross_correlation(
+            spectrum1, scipyFFT.fftn(image2_adjusted), space="fourier", upsample_factor=upsample_factor
+        )
     
     
     # corrects image
@@ -455,6 +804,7 @@ def align2ImagesCrossCorrelation(image1_uncorrected,
     return results
 
 def find_transform(im_src, im_dst):
+    import cv2
     warp = np.eye(3, dtype=np.float32)
     criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 0.001)
     try:
@@ -464,6 +814,7 @@ def find_transform(im_src, im_dst):
     return warp
     
 def alignCV2(im1,im2,warp_mode):
+    import cv2
     
    
     # Define 2x3 or 3x3 matrices and initialize the matrix to identity
@@ -494,6 +845,7 @@ def alignCV2(im1,im2,warp_mode):
     return cc, warp_matrix
 
 def applyCorrection(im2,warp_matrix):
+    import cv2
     
     sz = im2.shape
 
@@ -503,43 +855,292 @@ def applyCorrection(im2,warp_matrix):
     return im2_aligned 
 
    
-def alignImagesByBlocks(I1, I2, blockSize, log1, upsample_factor=100, minNumberPollsters=4, tolerance=0.1, useCV2=False,shiftErrorTolerance = 5):
+def getsSpectrumWeights(nx):
+    # weights of the columns of a real spectrum, so that sums over it equal sums over the full spectrum
+    weights = np.full(nx // 2 + 1, 2.0)
+    weights[0] = 1.0
+    if nx % 2 == 0:
+        weights[-1] = 1.0
+    return weights
+
+
+def crossCorrelatesAt(product, shape, ys, xs):
+    """
+    Evaluates stacked cross-correlations at subpixel positions, by a matrix-multiply DFT of
+    their real spectra
+
+    Parameters
+    ----------
+    product : npy array
+        (B, ny, nx//2+1) stack of cross-power spectra F1*conj(F2), as given by rfft2.
+    shape : tuple
+        (ny, nx) shape of the images.
+    ys : npy array
+        (B, U) y positions in px for each spectrum.
+    xs : npy array
+        (B, V) x positions in px for each spectrum.
+
+    Returns
+    -------
+    crossCorrelation : npy array
+        (B, U, V) cross-correlations, normalized as irfft2.
+
+    """
+    ny, nx = shape
+    kernelX = getsSpectrumWeights(nx) * np.exp(2j * np.pi * xs[:, :, np.newaxis] * scipyFFT.rfftfreq(nx))
+    kernelY = np.exp(2j * np.pi * ys[:, :, np.newaxis] * scipyFFT.fftfreq(ny))
+
+    crossCorrelation = kernelY @ (product @ kernelX.transpose(0, 2, 1))
+
+    return crossCorrelation.real / (ny * nx)
+
+
+def findsShiftsFFT(spectra1, spectra2, shape, upsample_factor=100):
+    """
+    Finds the translations registering stacks of images from their real spectra, as
+    phase_cross_correlation does one image at a time: whole-pixel shift from the peak of the phase
+    correlation, refined by a matrix-multiply DFT in a 1.5 px window upsampled by upsample_factor.
+
+    Parameters
+    ----------
+    spectra1 : npy array
+        (B, ny, nx//2+1) rfft2 of the reference images.
+    spectra2 : npy array
+        (B, ny, nx//2+1) rfft2 of the images to register.
+    shape : tuple
+        (ny, nx) shape of the images.
+    upsample_factor : int, optional
+        The default is 100.
+
+    Returns
+    -------
+    shifts : npy array
+        (B, 2) shifts in y and x to apply to the images to register them onto the references.
+
+    """
+    product = spectra1 * spectra2.conj()
+    eps = np.finfo(product.real.dtype).eps
+    product /= np.maximum(np.abs(product), 100 * eps)
+
+    # whole-pixel shifts from the peaks of the phase correlations, in one stacked inverse FFT
+    crossCorrelation = scipyFFT.irfft2(product, s=shape, axes=(-2, -1))
+    maxima = np.argmax(np.abs(crossCorrelation.reshape(crossCorrelation.shape[0], -1)), axis=1)
+    shifts = np.stack(np.unravel_index(maxima, shape), axis=1).astype(np.float64)
+    midpoints = np.trunc(np.array(shape) / 2)
+    shifts[shifts > midpoints] -= np.broadcast_to(np.array(shape), shifts.shape)[shifts > midpoints]
+
+    if upsample_factor > 1:
+        # refines all shifts at once on an upsampled grid around the whole-pixel ones
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        upsampledRegionSize = int(np.ceil(upsample_factor * 1.5))
+        offsets = (np.arange(upsampledRegionSize) - np.trunc(upsampledRegionSize / 2)) / upsample_factor
+        crossCorrelation = crossCorrelatesAt(
+            product, shape, shifts[:, 0:1] + offsets, shifts[:, 1:2] + offsets
+        )
+        maxima = np.argmax(np.abs(crossCorrelation.reshape(crossCorrelation.shape[0], -1)), axis=1)
+        shifts += offsets[np.stack(np.unravel_index(maxima, crossCorrelation.shape[1:]), axis=1)]
+
+    shifts[:, np.array(shape) == 1] = 0
+
+    return shifts
+
+
+def preparesShiftErrors(image):
+    """
+    returns the terms of image used by calculatesShiftErrors: its real spectrum, zero-padded
+    to 1.5 times its size so that translations of up to half the image do not wrap around,
+    and the summed-area table of its squares.
+
+    """
+    image = np.float64(image)
+    paddedShape = tuple([scipyFFT.next_fast_len(n + n // 2, real=True) for n in image.shape])
+
+    squares = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    squares[1:, 1:] = np.cumsum(np.cumsum(image ** 2, axis=0), axis=1)
+
+    return {"spectrum": scipyFFT.rfft2(image, s=paddedShape), "paddedShape": paddedShape, "squares": squares}
+
+
+def sumsSquares(squares, y0, y1, x0, x1):
+    # sums of squares over the boxes [y0, y1) x [x0, x1), from a summed-area table
+    return squares[y1, x1] - squares[y0, x1] - squares[y1, x0] + squares[y0, x0]
+
+
+def calculatesShiftErrors(terms1, terms2, shape, shifts):
+    """
+    Calculates the RMS differences between an image and the translations of a second one by
+    shifts, over the region where they overlap. The scalar products are evaluated from the
+    zero-padded spectra (Parseval) instead of shifting the second image for each shift, so
+    that no part of the second image wraps around, and the sums of squares over the
+    overlaps, taken at the nearest whole-pixel shift, from summed-area tables.
+
+    Unlike a sum over the full image, the error does not grow with the part of the image
+    that a translation moves out of the field of view.
+
+    Parameters
+    ----------
+    terms1, terms2 : dict
+        terms of the images, from preparesShiftErrors.
+    shape : tuple
+        (ny, nx) shape of the images.
+    shifts : npy array
+        (B, 2) shifts in y and x applied to the second image.
+
+    Returns
+    -------
+    errors : npy array
+        (B,) RMS differences over the overlaps. Infinite for shifts larger than half the image.
+
+    """
+    ny, nx = shape
+    paddedY, paddedX = terms1["paddedShape"]
+    kernelX = getsSpectrumWeights(paddedX) * np.exp(2j * np.pi * shifts[:, 1:2] * scipyFFT.rfftfreq(paddedX))
+    kernelY = np.exp(2j * np.pi * shifts[:, 0:1] * scipyFFT.fftfreq(paddedY))
+
+    # scalar products of image 1 and of the shifted images 2 over their overlaps
+    product = terms1["spectrum"] * terms2["spectrum"].conj()
+    crossCorrelation = np.einsum("bm,mb->b", kernelY, product @ kernelX.T).real / (paddedY * paddedX)
+
+    # overlaps in image 1 and in image 2
+    wholeShifts = np.clip(np.round(shifts).astype(int), [-ny, -nx], [ny, nx])
+    y0, y1 = np.maximum(0, wholeShifts[:, 0]), ny + np.minimum(0, wholeShifts[:, 0])
+    x0, x1 = np.maximum(0, wholeShifts[:, 1]), nx + np.minimum(0, wholeShifts[:, 1])
+    energy1 = sumsSquares(terms1["squares"], y0, y1, x0, x1)
+    energy2 = sumsSquares(terms2["squares"], y0 - wholeShifts[:, 0], y1 - wholeShifts[:, 0], x0 - wholeShifts[:, 1], x1 - wholeShifts[:, 1])
+    area = (y1 - y0) * (x1 - x0)
+
+    errors = np.full(shifts.shape[0], np.inf)
+    valid = (np.abs(shifts[:, 0]) <= paddedY - ny) & (np.abs(shifts[:, 1]) <= paddedX - nx) & (area > 0)
+    errors[valid] = np.sqrt(np.maximum(energy1 + energy2 - 2 * crossCorrelation, 0)[valid] / area[valid])
+
+    return errors
+
+
+def preparesHistogramTemplate(template):
+    """
+    returns the values and normalized quantiles of the intensities of template, for matchesHistogram
+
+    """
+    values, counts = np.unique(template.reshape(-1), return_counts=True)
+    return {"values": values, "quantiles": np.cumsum(counts) / template.size}
+
+
+def matchesHistogram(image, template):
+    """
+    Same as skimage match_histograms(image, reference) for floating point images, with the
+    quantiles of the reference precomputed by preparesHistogramTemplate
+
+    """
+    values, lookup, counts = np.unique(image.reshape(-1), return_inverse=True, return_counts=True)
+    matched = np.interp(np.cumsum(counts) / image.size, template["quantiles"], template["values"])
+
+    return matched[lookup].reshape(image.shape).astype(np.float32 if image.dtype.itemsize <= 4 else image.dtype)
+
+
+def preparesBlockReference(I1, blockSize):
+    """
+    returns the FFTs of I1 used by alignImagesByBlocks: stacked rfft2 of its blocks, rfft2 of
+    the full image and the terms used to rate shifts (see preparesShiftErrors). Computed once,
+    they are reused for all images aligned against I1.
+
+    """
+    return {
+        "blockSpectra": scipyFFT.rfft2(view_as_blocks(I1, blockSize).reshape((-1,) + tuple(blockSize)), axes=(-2, -1)),
+        "spectrum": scipyFFT.rfft2(np.float64(I1)),
+        "shiftErrors": preparesShiftErrors(I1),
+    }
+
+
+def alignImagesByBlocks(I1, I2, blockSize, log1, upsample_factor=100, minNumberPollsters=4, tolerance=0.2, useCV2=False,shiftErrorTolerance = 5, reference=None, guess=None, guessCrop=256):
+    """
+    Registers I2 onto I1 by polling the translations of blocks of blockSize
+
+    The translations of all blocks are found at once from the stacked real FFTs of the blocks.
+    Each block shift is then rated by the RMS difference between I1 and I2 translated by it,
+    over the region where they overlap (see calculatesShiftErrors). Blocks whose error is
+    within tolerance of the lowest one are polled (toleranceRMS in the parameters file). The
+    RMS difference separates blocks more than the sum of absolute differences over the full
+    image used before: a tolerance of 0.2 polls about as many blocks as 0.1 did with it. The
+    mean polled shift is rated the same way as the global one to decide whether to fall back
+    to it. Blocks whose shift cannot be rated are not polled.
+
+    The FFTs of I1 can be given in reference, from preparesBlockReference, when several
+    images are aligned against it.
+
+    If an expected shift is given in guess, e.g. predicted by the drift trajectory of the ROI,
+    blocks whose shift departs from it by more than shiftErrorTolerance are not polled, and the
+    global registration only searches near it, on a guessCrop window (see registersAround).
+
+    Returns
+    -------
+    meanShifts : npy array
+        polled shift in y and x, or global shift if the polling fails.
+    meanError : float
+        RMS difference for meanShifts.
+    relativeShifts : npy array
+        difference between the norm of each block shift and their polled mean.
+    rmsImage : npy array
+        RMS difference over the overlap for the shift of each block.
+    contour : npy array
+        contour of the polled blocks.
+
+    """
+    if reference is None:
+        reference = preparesBlockReference(I1, blockSize)
 
     Block1=view_as_blocks(I1,blockSize)
     Block2=view_as_blocks(I2,blockSize)
-    
-    if useCV2:
-        warp_matrix = np.eye(2, 3, dtype=np.float32)
+    numberBlocks = Block1.shape[:2]
+
+    if not useCV2:
+        # using stacked FFTs of all blocks
+        spectra2 = scipyFFT.rfft2(Block2.reshape((-1,) + tuple(blockSize)), axes=(-2, -1))
+        shifts = findsShiftsFFT(reference["blockSpectra"], spectra2, tuple(blockSize), upsample_factor=upsample_factor)
+        del spectra2
+    else:
+        # uses CV2 cause it is 20 times faster than Scimage
+        import cv2
         warp_mode = cv2.MOTION_TRANSLATION
-    
-    shiftImageNorm= np.zeros((Block1.shape[0],Block1.shape[1]))
-    shiftedImage = np.zeros((Block1.shape[0],Block1.shape[1],2))
-    rmsImage= np.zeros((Block1.shape[0],Block1.shape[1]))
-    
-    for i in trange(Block1.shape[0]):
-        for j in range(Block1.shape[1]):
-            if not useCV2:
-                # using Scimage registration functions
-                shift, error, diffphase = phase_cross_correlation(Block1[i,j], Block2[i,j],upsample_factor=upsample_factor)
-                shiftImageNorm[i,j] = LA.norm(shift)
-                shiftedImage[i,j,0], shiftedImage[i,j,1] = shift[0], shift[1]
-                I2_aligned = shiftImage(I2, shift)
-            else:              
-                # uses CV2 cause it is 20 times faster than Scimage
+        shifts = np.zeros((numberBlocks[0] * numberBlocks[1], 2))
+        for i in trange(numberBlocks[0]):
+            for j in range(numberBlocks[1]):
                 cc, warp_matrix = alignCV2(Block1[i,j], Block2[i,j], warp_mode)
-                shiftImageNorm[i,j] = LA.norm(warp_matrix[:,2])
-                shiftedImage[i,j,0],shiftedImage[i,j,1] = warp_matrix[:,2][0], warp_matrix[:,2][1]
-                I2_aligned = applyCorrection(I2,warp_matrix)
-            
-            rmsImage[i,j] =np.sum(np.sum(np.abs(I1-I2_aligned),axis=1)) 
-            
+                shifts[i * numberBlocks[1] + j] = warp_matrix[:,2][0], warp_matrix[:,2][1]
+
+    shiftedImage = shifts.reshape(numberBlocks + (2,))
+    shiftImageNorm = LA.norm(shiftedImage, axis=2)
+
+    # [rates the shift of each block on the full images]
+    spectrum1 = reference["spectrum"]
+    spectrum2 = scipyFFT.rfft2(np.float64(I2))
+    terms1, terms2 = reference["shiftErrors"], preparesShiftErrors(I2)
+
+    if not useCV2:
+        appliedShifts = shifts
+    else:
+        # applyCorrection takes I2 at (x+tx, y+ty)
+        appliedShifts = -shifts[:, ::-1]
+    rmsImage = calculatesShiftErrors(terms1, terms2, I1.shape, appliedShifts).reshape(numberBlocks)
+
+    # blocks whose shift cannot be rated (larger than half the image) are shown with the largest error
+    rated = np.isfinite(rmsImage)
+    rmsImage[~rated] = np.max(rmsImage[rated]) if np.any(rated) else 0
+
     # [calculates optimal shifts by polling blocks showing the best RMS]
 
+    # only polls the blocks consistent with the expected shift
+    consistent = np.ones(numberBlocks, dtype=bool)
+    if guess is not None and not useCV2:
+        consistent = LA.norm(shiftedImage - np.array(guess), axis=2) <= shiftErrorTolerance
+        if not np.any(consistent & rated):
+            consistent[:] = True
+    consistent &= rated
+
     # threshold = filters.threshold_otsu(rmsImage)
-    threshold = (1+tolerance)*np.min(rmsImage)
-    mask = rmsImage < threshold 
+    threshold = (1+tolerance)*np.min(rmsImage[consistent]) if np.any(consistent) else np.inf
+    mask = (rmsImage < threshold) & consistent
     
-    contours = measure.find_contours(rmsImage, threshold)
+    contours = measure.find_contours(rmsImage, threshold) if np.isfinite(threshold) else []
     
     try:
         contour = sorted(contours, key=lambda x: len(x))[-1]
@@ -550,14 +1151,24 @@ def alignImagesByBlocks(I1, I2, blockSize, log1, upsample_factor=100, minNumberP
     meanShifts = [np.mean(shiftedImage[mask,0]), np.mean(shiftedImage[mask,1])]
     stdShifts =[np.std(shiftedImage[mask,0]), np.std(shiftedImage[mask,1])]
     meanShiftNorm = np.mean(shiftImageNorm[mask])
-    meanError = np.mean(rmsImage[mask])
+    # rates the polled shift as the global one, on the overlap of the full images
+    if not np.any(mask):
+        meanError = np.inf
+    elif not useCV2:
+        meanError = calculatesShiftErrors(terms1, terms2, I1.shape, np.array([meanShifts]))[0]
+    else:
+        meanError = calculatesShiftErrors(terms1, terms2, I1.shape, -np.array([meanShifts])[:, ::-1])[0]
     relativeShifts= np.abs(shiftImageNorm-meanShiftNorm)
 
     # [calculates global shift, if it is better than the polled shift, or
     # if we do not have enough pollsters to fall back to then it does a global cross correlation!]
-    meanShifts_global, _, _= phase_cross_correlation(I1,I2,upsample_factor=100)
-    I2_aligned_global  = shiftImage(I2, shift)
-    meanError_global = np.sum(np.sum(np.abs(I1-I2_aligned_global),axis=1)) 
+    if guess is not None:
+        meanShifts_global = registersAround(
+            I1, I2, guess, cropSize=guessCrop, upsample_factor=100, tolerance=shiftErrorTolerance
+        )[0]
+    else:
+        meanShifts_global = findsShiftsFFT(spectrum1[np.newaxis], spectrum2[np.newaxis], I1.shape, upsample_factor=100)[0]
+    meanError_global = calculatesShiftErrors(terms1, terms2, I1.shape, meanShifts_global[np.newaxis])[0]
 
     log1.info("Block alignment error: {}, global alignment error: {}".format(meanError,meanError_global))
 
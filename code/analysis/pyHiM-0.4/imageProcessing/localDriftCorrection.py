@@ -29,7 +29,7 @@ steps for each ROI:
 # =============================================================================
 
 
-import glob, os
+import os
 import matplotlib.pylab as plt
 import numpy as np
 
@@ -38,19 +38,20 @@ from tqdm import trange
 from skimage.util import montage
 import cv2
 
-from dask.distributed import Client, LocalCluster, get_client, as_completed, wait
+from dask.distributed import Client, LocalCluster, get_client, as_completed
 
 
 from imageProcessing.imageProcessing import Image
-from fileProcessing.fileManagement import folders, writeString2File, ROI2FiducialFileName
-from fileProcessing.fileManagement import daskCluster
+from fileProcessing.fileManagement import folders, writeString2File, ROI2FiducialFileName, listsImages, getsManifest
+from fileProcessing.fileManagement import existsIntermediate, loadsIntermediate
+from fileProcessing.fileManagement import daskCluster, getsTaskResources
+from fileProcessing.profiling import profilesTask
+from fileProcessing.figureQueue import queuesFigure
+from fileProcessing.prefetch import prefetches, getsFileSize
 
-from imageProcessing.alignImages import align2ImagesCrossCorrelation
-
-from stardist import random_label_cmap
+from imageProcessing.alignImages import align2ImagesCrossCorrelation, getsRegisteredFileName
 
 np.random.seed(6)
-lbl_cmap = random_label_cmap()
 
 
 def loadsFiducial(param, fileName, log1, dataFolder):
@@ -132,14 +133,14 @@ def retrieveBarcodeList(param, fileName):
 
     channelFiducial = param.param["acquisition"]["fiducialBarcode_channel"]
 
-    listFiles = glob.glob(rootFolder + os.sep + "*.tif")
+    # files of this ROI
+    listFiles = getsManifest(rootFolder, param).getsFiles(ROI)
 
     # if (ROI in os.path.basename(x).split("_")[positionROIinformation])
     fiducialFileNames = [
         x
         for x in listFiles
-        if (ROI in param.decodesFileParts(os.path.basename(x))["roi"])
-        and ("RT" in os.path.basename(x))
+        if ("RT" in os.path.basename(x))
         and (channelFiducial in os.path.basename(x))
     ]
 
@@ -239,7 +240,7 @@ def plotMontageImage(montage2DReference,montage2DCorrected,outputFileName,fileNa
 
 
 def localDriftCorrection_plotsLocalAlignments(
-    imageListCorrected, imageListunCorrected, imageListReference, log1, dataFolder, ROI, barcode
+    imageListCorrected, imageListunCorrected, imageListReference, param, log1, dataFolder, ROI, barcode
 ):
     """
     converts list of images into mosaic and saves results
@@ -252,6 +253,8 @@ def localDriftCorrection_plotsLocalAlignments(
         DESCRIPTION.
     imageListReference : TYPE
         DESCRIPTION.
+    param : Parameters Class
+        used to get the render level of the mosaics.
     outputFileName : TYPE
         DESCRIPTION.
 
@@ -270,11 +273,20 @@ def localDriftCorrection_plotsLocalAlignments(
     montage2DCorrected = montage(imageListCorrectedPadded)
     montage2DunCorrected = montage(imageListunCorrectedPadded)
 
+    # mosaics are rendered at the end of the run, binned down or skipped depending on the render level
     fileInformation = "**uncorrected** drift for ROI: {} barcode:{}".format(ROI, barcode)
-    plotMontageImage(montage2DReference,montage2DunCorrected,outputFileName,log1.fileNameMD,fileInformation,tag="_uncorrected.png")
+    queuesFigure(param,
+                 plotMontageImage,
+                 (montage2DReference,montage2DunCorrected,outputFileName,log1.fileNameMD,fileInformation),
+                 kwargs={"tag": "_uncorrected.png"},
+                 images=(0, 1))
 
     fileInformation = "**corrected** drift for ROI: {} barcode:{}".format(ROI, barcode)
-    plotMontageImage(montage2DReference,montage2DCorrected,outputFileName,log1.fileNameMD,fileInformation,tag="_corrected.png")
+    queuesFigure(param,
+                 plotMontageImage,
+                 (montage2DReference,montage2DCorrected,outputFileName,log1.fileNameMD,fileInformation),
+                 kwargs={"tag": "_corrected.png"},
+                 images=(0, 1))
 
     del montage2DReference, montage2DCorrected, imageListReferencePadded, imageListCorrectedPadded
     del imageListReference, imageListCorrected
@@ -306,9 +318,7 @@ def localDriftCorrection_savesResults(dictShift, alignmentResultsTable, dataFold
         outputFileName = dataFolder.outputFolders["alignImages"] + os.sep + "LocalShiftsViolinPlot_" + "ROI:" + ROI
         plt.savefig(outputFileName + ".png")
         plt.close()
-        writeString2File(
-            log1.fileNameMD, "Local drift for ROI: {}\n ![]({})\n".format(ROI, outputFileName + ".png"), "a",
-        )
+        log1.addMarkdown("Local drift for ROI: {}\n ![]({})\n".format(ROI, outputFileName + ".png"))
 
     # saves Table with all shifts
     alignmentResultsTable.write(
@@ -317,6 +327,18 @@ def localDriftCorrection_savesResults(dictShift, alignmentResultsTable, dataFold
         overwrite=True,
     )
 
+def loadsRegisteredImage(fileNameFiducial, param, log1, dataFolder):
+    """
+    returns an Image with the registered 2D projection of fileNameFiducial
+
+    """
+    Im = Image(param, log1)
+    Im.loadImage2D(fileNameFiducial, log1, dataFolder.outputFolders["alignImages"], tag="_2d_registered")
+
+    return Im
+
+
+@profilesTask("localDriftCorrection")
 def localDriftforRT(
     barcode,
     fileNameFiducial,
@@ -329,13 +351,14 @@ def localDriftforRT(
     alignmentResultsTable,
     log1,
     dataFolder,
-    parallel=False
+    parallel=False,
+    Im=None,
+    param=None,
     ):
 
-    # loads 2D image and applies registration
-    param={}
-    Im = Image(param,log1)
-    Im.loadImage2D(fileNameFiducial, log1, dataFolder.outputFolders["alignImages"], tag="_2d_registered")
+    # loads 2D image and applies registration, unless it was read ahead
+    if Im is None:
+        Im = loadsRegisteredImage(fileNameFiducial, param, log1, dataFolder)
     imageBarcode = Im.removesBackground2D(normalize=True)
                     
     imageListCorrected, imageListunCorrected, imageListReference,errormessage = [], [], [], []
@@ -488,7 +511,7 @@ def localDriftallBarcodes(param,
 
     if param.param['parallel']:
 
-        futures = list()
+        futures = dict()
         client=get_client()
         
         remote_imReference = client.scatter(imageReferenceBackgroundSubstracted,broadcast=True)
@@ -496,7 +519,7 @@ def localDriftallBarcodes(param,
             
         for barcode, fileNameFiducial in zip(barcodeList, fiducialFileNames):
 
-            futures.append(client.submit(localDriftforRT,barcode,
+            future = client.submit(localDriftforRT,barcode,
                                         fileNameFiducial,
                                         imReferenceFileName,
                                         remote_imReference,
@@ -507,25 +530,33 @@ def localDriftallBarcodes(param,
                                         alignmentResultsTable,
                                         log1,
                                         dataFolder,
-                                        parallel=True))
-                       
-        wait(futures)
-        
-        results = client.gather(futures)
-        
-        del remote_imReference,remote_Masks, futures
-            
-        print("Retrieving {} results from cluster".format(len(results)))
-        for result, barcode in zip(results,barcodeList):
+                                        parallel=True,
+                                        param=param,
+                                        resources=getsTaskResources("localDriftCorrection"))
+            futures[future] = barcode
+
+        # processes barcodes as they are completed
+        print("Retrieving {} results from cluster".format(len(futures)))
+        for future, result in as_completed(futures, with_results=True):
+            barcode = futures[future]
             dictShift[barcode], imageListCorrected, imageListunCorrected, imageListReference, errormessage1 = result
             errormessage+=errormessage1
             # output mosaics with global and local alignments
             localDriftCorrection_plotsLocalAlignments(
-                imageListCorrected, imageListunCorrected, imageListReference, log1, dataFolder, ROI, barcode
+                imageListCorrected, imageListunCorrected, imageListReference, param, log1, dataFolder, ROI, barcode
             )
+
+        del remote_imReference,remote_Masks, futures
+
     else:
-        # - load fiducial for cycle <i>
-        for barcode, fileNameFiducial in zip(barcodeList, fiducialFileNames):
+        # - load fiducial for cycle <i>, reading the next ones while the current one is processed
+        images = prefetches(
+            fiducialFileNames,
+            lambda x: loadsRegisteredImage(x, param, log1, dataFolder),
+            param,
+            sizer=lambda x: getsFileSize(getsRegisteredFileName(x, dataFolder)),
+        )
+        for barcode, (fileNameFiducial, Im) in zip(barcodeList, images):
   
             # calculates local drift for barcode by looping over Masks
             result = localDriftforRT(
@@ -539,14 +570,17 @@ def localDriftallBarcodes(param,
                     ROI,
                     alignmentResultsTable,
                     log1,
-                    dataFolder)
+                    dataFolder,
+                    Im=Im,
+                    param=param)
+            del Im
         
             dictShift[barcode], imageListCorrected, imageListunCorrected, imageListReference, errormessage1 = result
             errormessage+=errormessage1
             
             # output mosaics with global and local alignments
             localDriftCorrection_plotsLocalAlignments(
-                imageListCorrected, imageListunCorrected, imageListReference, log1, dataFolder, ROI, barcode
+                imageListCorrected, imageListunCorrected, imageListReference, param, log1, dataFolder, ROI, barcode
             )
 
     return dictShift, alignmentResultsTable, errormessage 
@@ -561,9 +595,7 @@ def localDriftCorrection(param, log1, session1):
     )
     dataFolder = folders(param.param["rootFolder"])
     log1.report("folders read: {}".format(len(dataFolder.listFolders)))
-    writeString2File(
-        log1.fileNameMD, "## {}: {}\n".format(session1.name, param.param["acquisition"]["label"]), "a",
-    )
+    log1.addMarkdown("## {}: {}\n".format(session1.name, param.param["acquisition"]["label"]))
 
     if "localShiftTolerance" in param.param["alignImages"].keys():
         shiftTolerance = param.param["alignImages"]["localShiftTolerance"]
@@ -595,7 +627,7 @@ def localDriftCorrection(param, log1, session1):
     dictShift = {}
 
     for currentFolder in dataFolder.listFolders:
-        filesFolder = glob.glob(currentFolder + os.sep + "*.tif")
+        filesFolder = listsImages(currentFolder, param)
         dataFolder.createsFolders(currentFolder, param)
 
         # generates lists of files to process
@@ -620,8 +652,8 @@ def localDriftCorrection(param, log1, session1):
                 [os.path.dirname(fileNameDAPI), param.param["segmentedObjects"]["folder"], fileNameROImasks]
             )
 
-            if os.path.exists(fullFileNameROImasks):
-                Masks = np.load(fullFileNameROImasks)
+            if existsIntermediate(fullFileNameROImasks, param):
+                Masks = loadsIntermediate(fullFileNameROImasks, param)
                 # fig = plt.figure(), plt.imshow(Masks, origin="lower", cmap=lbl_cmap,alpha=1)
                 print("Masks read> {}".format(Masks.max()))
 
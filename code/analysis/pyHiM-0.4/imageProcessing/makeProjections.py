@@ -11,34 +11,52 @@ Operation will be defined in the parameters file. Options are:
     - user-defined range
     - all z range
     - optimal range based on detection of focal plane and use of user defined window around it
-    
+
+In automatic mode, "focalPlane" set to "ROI" finds the focal plane once per ROI, in the fiducial
+image of the reference cycle, and reuses it for all the cycles and channels of the ROI. The
+focal planes are kept in the focalPlanes.json table of the zProject folder.
+
 
 """
 # =============================================================================
 # IMPORTS
 # =============================================================================
 
-import glob, os
+import os
+import copy
+import threading
 
-from dask.distributed import get_client, wait
+from dask.distributed import get_client, as_completed
 
 from imageProcessing.imageProcessing import Image
 
 from fileProcessing.fileManagement import (
-    folders,writeString2File)
+    folders, getsTaskResources, getsTaskPlacement, listsImages, getsManifest, saveJSON, loadJSON,
+    fileSignature, getsLocalFileName)
+from fileProcessing.stageCache import stageCache, selectsParameters
+from fileProcessing.profiling import profilesTask
+from fileProcessing.imageStore import getsIOParameters, opensStore
+from fileProcessing.prefetch import prefetches, warmsFile
 
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
 
-def makes2DProjectionsFile(fileName, param, log1, session1, dataFolder):
+def getsProjectionFileName(fileName, dataFolder):
+    return dataFolder.outputFolders["zProject"] + os.sep + os.path.basename(fileName).split(".")[0] + "_2d.npy"
 
-    if fileName in session1.data and param.param["zProject"]["operation"] != "overwrite":
-        # creates image object
-        Im = Image(param,log1)
-        Im.loadImage2D(fileName, log1, dataFolder.outputFolders["zProject"])
-        if param.param["zProject"]["display"]:
-            Im.imageShow()
+@profilesTask("makesProjections")
+def makes2DProjectionsFile(fileName, param, log1, session1, dataFolder, focusPlane=None):
+
+    # the key is built before projecting as findsZrange updates the z-range in param
+    cache = stageCache(dataFolder.outputFolders["stageCache"])
+    outputFile = getsProjectionFileName(fileName, dataFolder)
+    parameters = selectsParameters(param.param["zProject"], exclude=["folder", "operation", "display", "saveImage"])
+    if focusPlane is not None:
+        parameters["focusPlane"] = focusPlane
+    key = cache.getKey(makes2DProjectionsFile, [fileName], parameters)
+
+    if param.param["zProject"]["operation"] != "overwrite" and cache.load("zProject", fileName, key) is not None:
         log1.report("File already projected: {}".format(os.path.basename(fileName)))
     else:
 
@@ -47,11 +65,8 @@ def makes2DProjectionsFile(fileName, param, log1, session1, dataFolder):
         # creates image object
         Im = Image(param,log1)
 
-        # loads image
-        Im.loadImage(fileName)
-
-        # makes actual 2d projection
-        Im.zProjectionRange()
+        # makes actual 2d projection, reading the planes of the image one at a time
+        Im.zProjectionStreaming(fileName, focusPlane=focusPlane)
 
         # outputs information from file
         if Im.fileName:
@@ -61,16 +76,149 @@ def makes2DProjectionsFile(fileName, param, log1, session1, dataFolder):
         if param.param["zProject"]["display"]:
             pngFileName = dataFolder.outputFolders["zProject"] + os.sep + os.path.basename(fileName) + "_2d.png"
             Im.imageShow(save=param.param["zProject"]["saveImage"], outputName=pngFileName)
-            writeString2File(
-                log1.fileNameMD, "{}\n ![]({})\n".format(os.path.basename(fileName), pngFileName), "a",
-            )  # initialises MD file
+            log1.addMarkdown("{}\n ![]({})\n".format(os.path.basename(fileName), pngFileName))  # initialises MD file
 
         # saves output 2d zProjection as matrix
         Im.saveImage2D(log1, dataFolder.outputFolders["zProject"])
+        cache.save("zProject", fileName, key, [outputFile])
 
         del Im
 
 
+def warmsImage(fileName, param):
+    # projections stream the planes of the image, so only the page cache is filled ahead
+    if getsIOParameters(param)["store"] == "zarr" and opensStore(fileName) is not None:
+        return
+    warmsFile(getsLocalFileName(fileName, param))
+
+
+def findsFocalPlaneFile(fileName, param, log1):
+    """
+    returns the focal plane and the z-range of projection of the image of fileName
+
+    """
+    Im = Image(param, log1)
+    focusPlane, zRange = Im.findsZrangeStreaming(fileName)
+
+    return focusPlane, [zRange[0], zRange[-1] + 1]
+
+
+# locks of the focalPlanes.json tables, shared by the labels projected at the same time
+focalPlanesLocks = {}
+focalPlanesLocksLock = threading.Lock()
+
+
+def getsFocalPlanesLock(tableFileName):
+    with focalPlanesLocksLock:
+        return focalPlanesLocks.setdefault(os.path.abspath(tableFileName), threading.Lock())
+
+
+def getsFocalPlaneParameters(param):
+    # parameters the focal plane of a ROI depends on
+    return {key: param.param["zProject"][key] for key in ["zmin", "zmax", "windowSecurity"]}
+
+
+def findsROIfocalPlanes(param, log1, dataFolder, currentFolder, files2Process):
+    """
+    Finds the focal plane of each ROI of files2Process in the fiducial image of the reference
+    cycle. Focal planes found in previous runs, for the same reference image and parameters, are
+    read from the focalPlanes.json table of the zProject folder, others are added to it.
+
+    The labels of a run are projected at the same time in parallel mode: the table is read,
+    completed and written holding a lock, so that the first label finds the focal planes and
+    the others read them. It is written to a temporary file first, so that it is never read
+    half written.
+
+    Parameters
+    ----------
+    param : Parameters Class
+    log1 : log Class
+    dataFolder : folders Class
+    currentFolder : string
+    files2Process : list
+        files to project.
+
+    Returns
+    -------
+    focalPlanes : dict
+        focal plane of each ROI, e.g. {'001': 24}. ROIs without reference image are left out,
+        their files are projected with their own focal plane.
+
+    """
+    tableFileName = dataFolder.outputFolders["zProject"] + os.sep + "focalPlanes.json"
+    with getsFocalPlanesLock(tableFileName):
+        return updatesROIfocalPlanes(param, log1, tableFileName, currentFolder, files2Process)
+
+
+def updatesROIfocalPlanes(param, log1, tableFileName, currentFolder, files2Process):
+    # reads, completes and writes the table of focal planes, see findsROIfocalPlanes
+    table = loadJSON(tableFileName) if os.path.exists(tableFileName) else {}
+
+    folderManifest = getsManifest(currentFolder, param)
+    referenceCycle = param.param["alignImages"]["referenceFiducial"]
+    fiducialChannel = param.setsChannel("fiducialBarcode_channel", "ch00")
+    parameters = getsFocalPlaneParameters(param)
+
+    focalPlanes, references = {}, {}
+    for ROI in sorted(set([param.decodesFileParts(os.path.basename(x))["roi"] for x in files2Process])):
+        referenceFiles = folderManifest.getsFiles(ROI, referenceCycle, fiducialChannel)
+        if len(referenceFiles) == 0:
+            log1.report("No reference image to find the focal plane of ROI:{}".format(ROI), "Warning")
+            continue
+
+        entry = table.get("ROI:" + ROI, {})
+        if (
+            entry.get("signature") == fileSignature(referenceFiles[0])
+            and entry.get("parameters") == parameters
+        ):
+            focalPlanes[ROI] = entry["focusPlane"]
+        else:
+            references[ROI] = referenceFiles[0]
+
+    if len(references) > 0:
+        log1.report("Finding the focal plane of {} ROIs".format(len(references)))
+        if param.param["parallel"]:
+            client = get_client()
+            futures = {
+                ROI: client.submit(
+                    findsFocalPlaneFile,
+                    fileName,
+                    param,
+                    log1,
+                    resources=getsTaskResources("makesProjections"),
+                    **getsTaskPlacement([fileName])
+                )
+                for ROI, fileName in references.items()
+            }
+            results = {ROI: future.result() for ROI, future in futures.items()}
+        else:
+            results = {
+                ROI: findsFocalPlaneFile(fileName, copy.deepcopy(param), log1) for ROI, fileName in references.items()
+            }
+
+        for ROI, (focusPlane, zRange) in results.items():
+            focalPlanes[ROI] = focusPlane
+            table["ROI:" + ROI] = {
+                "signature": fileSignature(references[ROI]),
+                "parameters": parameters,
+                "focusPlane": int(focusPlane),
+                "zRange": [int(x) for x in zRange],
+            }
+            log1.report("ROI:{} focal plane: {}, zRange: {}".format(ROI, focusPlane, zRange))
+
+        saveJSON(tableFileName + ".tmp", table)
+        os.replace(tableFileName + ".tmp", tableFileName)
+
+    return focalPlanes
+
+
+def getsFocalPlane(fileName, param, focalPlanes):
+    # focal plane of the ROI of fileName, None to find the focal plane of the file
+    if focalPlanes is None:
+        return None
+    return focalPlanes.get(param.decodesFileParts(os.path.basename(fileName))["roi"])
+
+
 def makeProjections(param, log1, session1,fileName=None):
     sessionName = "makesProjections"
 
@@ -78,13 +226,11 @@ def makeProjections(param, log1, session1,fileName=None):
     log1.addSimpleText("\n===================={}====================\n".format(sessionName))
     dataFolder = folders(param.param["rootFolder"])
     log1.report("folders read: {}".format(len(dataFolder.listFolders)))
-    writeString2File(
-        log1.fileNameMD, "## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]), "a",
-    )  # initialises MD file
+    log1.addMarkdown("## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]))  # initialises MD file
 
         
     for currentFolder in dataFolder.listFolders:
-        filesFolder = glob.glob(currentFolder + os.sep + "*.tif")
+        filesFolder = listsImages(currentFolder, param)
         dataFolder.createsFolders(currentFolder, param)
 
         # generates lists of files to process
@@ -92,29 +238,51 @@ def makeProjections(param, log1, session1,fileName=None):
         log1.report("-------> Processing Folder: {}".format(currentFolder))
         log1.info("About to read {} files\n".format(len(param.fileList2Process)))
 
+        # focal planes of the ROIs, to be reused by all their files
+        focalPlanes = None
+        if (
+            param.param["zProject"]["mode"] == "automatic"
+            and "focalPlane" in param.param["zProject"].keys()
+            and param.param["zProject"]["focalPlane"] == "ROI"
+            and len(param.fileList2Process) > 0
+        ):
+            focalPlanes = findsROIfocalPlanes(param, log1, dataFolder, currentFolder, param.fileList2Process)
+
         if param.param['parallel']:
-            threads=list()
             files2ProcessFiltered = [x for x in param.fileList2Process if \
-                                     (fileName==None) \
+                                     ((fileName==None) \
                                      or (fileName!=None \
-                                     and (os.path.basename(x) in [os.path.basename(x1) for x1 in fileName]))]
+                                     and (os.path.basename(x) in [os.path.basename(x1) for x1 in fileName]))) \
+                                     and session1.isCompleted(sessionName, x) is None]
 
             if len(files2ProcessFiltered)>0:
                 # dask
                 client=get_client()
-                threads=[client.submit(makes2DProjectionsFile,x, param, log1, session1, dataFolder) for x in files2ProcessFiltered]            
-                    
-                print("Waiting for {} threads to complete ".format(len(threads)))
-                for index, thread in enumerate(threads):
-                    wait(threads)        
-                        
+                futures={client.submit(makes2DProjectionsFile,x, param, log1, session1, dataFolder,
+                                       focusPlane=getsFocalPlane(x, param, focalPlanes),
+                                       resources=getsTaskResources("makesProjections"),
+                                       **getsTaskPlacement([x])) : x for x in files2ProcessFiltered}
+
+                log1.info("Waiting for {} projections to complete".format(len(futures)))
+                for future, _ in as_completed(futures, with_results=True):
+                    session1.add(futures[future], sessionName, outputs=[getsProjectionFileName(futures[future], dataFolder)])
+
         else:
             
+            files2Project = []
             for index, fileName2Process in enumerate(param.fileList2Process):
     
-                if (fileName==None) or (fileName!=None and (os.path.basename(fileName2Process) in [os.path.basename(x) for x in fileName])):
-                    makes2DProjectionsFile(fileName2Process, param, log1, session1, dataFolder)                    
-                    session1.add(fileName2Process, sessionName)
+                if session1.isCompleted(sessionName, fileName2Process) is not None:
+                    log1.report("File projected in resumed run: {}".format(os.path.basename(fileName2Process)))
+                elif (fileName==None) or (fileName!=None and (os.path.basename(fileName2Process) in [os.path.basename(x) for x in fileName])):
+                    files2Project.append(fileName2Process)
                 else:
                     pass
 
+            # the next files are read into the page cache while the current one is projected
+            for fileName2Process, _ in prefetches(files2Project, lambda x: warmsImage(x, param), param):
+                # works on a copy, as in parallel mode, so that the z-range of a file does not change the cache key of the next
+                makes2DProjectionsFile(fileName2Process, copy.deepcopy(param), log1, session1, dataFolder,
+                                       focusPlane=getsFocalPlane(fileName2Process, param, focalPlanes))
+                session1.add(fileName2Process, sessionName, outputs=[getsProjectionFileName(fileName2Process, dataFolder)])
+
@@ -13,11 +13,14 @@ or cluster. This could be used alternatively or in complement to DAPI segmentati
 # =============================================================================
 # IMPORTS
 # =============================================================================
-import glob, os
+import os
 import argparse
+from dask.distributed import get_client, as_completed
 
 from imageProcessing.imageProcessing import Image, saveImage2Dcmd, imageAdjust
-from fileProcessing.fileManagement import (folders, session, log, Parameters,writeString2File, FileHandling)
+from fileProcessing.fileManagement import (folders, session, log, Parameters, FileHandling, getsTaskResources, listsImages,
+    existsIntermediate)
+from fileProcessing.profiling import profilesTask
 
 # =============================================================================
 # FUNCTIONS
@@ -51,7 +54,7 @@ def gets2DcorrectedImage(fileName, param, log1, session1, dataFolder):
     rootFileName = os.path.basename(fileName).split(".")[0]
     fileName_2d_aligned = dataFolder.outputFolders["alignImages"] + os.sep + rootFileName + "_2d_registered.npy"
 
-    if os.path.exists(fileName_2d_aligned):  # file exists
+    if existsIntermediate(fileName_2d_aligned, param):  # file exists
         # loading registered 2D projection
         Im = Image(param,log1)
         Im.loadImage2D(
@@ -65,6 +68,69 @@ def gets2DcorrectedImage(fileName, param, log1, session1, dataFolder):
         return [], -1
 
 
+@profilesTask("projectsBarcodes")
+def projectsBarcodesROI(ROI, fileList, param, log1, session1, dataFolder):
+    """
+    Accumulates the 2D corrected images of all the barcodes of an ROI and saves the result
+
+    Parameters
+    ----------
+    ROI : string
+        ROI to process.
+    fileList : list
+        barcode files in this ROI.
+    param : Parameters Class
+    log1 : log Class
+    session1 : session Class
+    dataFolder : folders Class
+
+    Returns
+    -------
+    None.
+
+    """
+    imageStack = None
+
+    for fileName in fileList:
+        newImage, errorCode = gets2DcorrectedImage(fileName, param, log1, session1, dataFolder)
+
+        if errorCode == 0:
+            # adjusts image levels before stacking
+            (newImage, hist1_before, hist1, lower_cutoff, higher_cutoff,) = imageAdjust(
+                newImage, lower_threshold=0.3, higher_threshold=0.9999
+            )
+
+            # convolve with a gaussian kernel to homogeneize region occupied by barcodes
+
+            # accumulates new image to stack by summing
+            if imageStack is not None:
+                imageStack += newImage  # accumulates images
+            else:
+                imageStack = newImage  # starts stack
+            log1.report(
+                "File {} accumulated to stack of ROI {}.".format(fileName, ROI), "info",
+            )
+
+        else:
+            log1.report(
+                "No 2d corrected image for file {} could be found --> not accumulated".format(fileName),
+                "warning",
+            )
+
+    # [saves imageStack to file]
+    if imageStack is not None:
+        imageFileNameOutput = dataFolder.outputFiles["projectsBarcodes"] + "_" + ROI + ".npy"
+        saveImage2Dcmd(imageStack, imageFileNameOutput, log1)
+
+        ImtoSave = Image(param,log1)
+        ImtoSave.data_2D = imageStack
+        outputName = dataFolder.outputFiles["projectsBarcodes"] + "_" + ROI + ".png"
+        ImtoSave.imageShow(outputName=outputName, normalization="simple")
+
+        log1.report("Output image File {}".format(outputName), "info")
+        del ImtoSave
+
+
 def projectsBarcodes(param, log1, session1):
 
     if param.param["projectsBarcodes"]["operation"] == "overwrite":
@@ -76,14 +142,10 @@ def projectsBarcodes(param, log1, session1):
             "\n===================={}:{}====================\n".format(sessionName, param.param["acquisition"]["label"])
         )
         log1.report("folders read: {}".format(len(dataFolder.listFolders)))
-        writeString2File(
-            log1.fileNameMD, "## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]), "a",
-        )
-        # barcodesCoordinates=Table()
+        log1.addMarkdown("## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]))
 
         for currentFolder in dataFolder.listFolders:
-            # currentFolder=dataFolder.listFolders[0]
-            filesFolder = glob.glob(currentFolder + os.sep + "*.tif")
+            filesFolder = listsImages(currentFolder, param)
             dataFolder.createsFolders(currentFolder, param)
             log1.report("-------> Processing Folder: {}".format(currentFolder))
 
@@ -91,52 +153,33 @@ def projectsBarcodes(param, log1, session1):
             param.files2Process(filesFolder)
             log1.report("About to read {} files\n".format(len(param.fileList2Process)))
 
-            # should find out how many ROIs are there
-            imageStack = {}
-
+            # groups files by ROI
+            filesROI = {}
             for fileName in param.fileList2Process:
-                # gets ROI
-                newFile = FileHandling(fileName)
-                ROI = newFile.getROI()
-
-                newImage, errorCode = gets2DcorrectedImage(fileName, param, log1, session1, dataFolder)
-
-                if errorCode == 0:
-                    # adjusts image levels before stacking
-                    (newImage, hist1_before, hist1, lower_cutoff, higher_cutoff,) = imageAdjust(
-                        newImage, lower_threshold=0.3, higher_threshold=0.9999
-                    )
-
-                    # convolve with a gaussian kernel to homogeneize region occupied by barcodes
-
-                    # accumulates new image to stack by summing
-                    if ROI in imageStack:
-                        imageStack[ROI] += newImage  # accumulates images
-                    else:
-                        imageStack[ROI] = newImage  # starts dict entry
-                    log1.report(
-                        "File {} accumulated to stack of ROI {}.".format(fileName, ROI), "info",
-                    )
-
+                ROI = FileHandling(fileName).getROI()
+                if ROI in filesROI:
+                    filesROI[ROI].append(fileName)
                 else:
-                    log1.report(
-                        "No 2d corrected image for file {} could be found --> not accumulated".format(fileName),
-                        "warning",
-                    )
+                    filesROI[ROI] = [fileName]
+
+            # ROIs are journaled by their output file
+            outputFilesROI = {ROI: dataFolder.outputFiles["projectsBarcodes"] + "_" + ROI + ".npy" for ROI in filesROI}
+            ROIs2Process = [ROI for ROI in filesROI if session1.isCompleted(sessionName, outputFilesROI[ROI]) is None]
+
+            if param.param['parallel']:
+                # running in parallel mode: one task per ROI
+                client=get_client()
+                futures={client.submit(projectsBarcodesROI, ROI, filesROI[ROI], param, log1, session1, dataFolder,
+                                       resources=getsTaskResources("projectsBarcodes")) : ROI for ROI in ROIs2Process}
+
+                log1.info("Waiting for {} ROIs to be projected".format(len(futures)))
+                for future, _ in as_completed(futures, with_results=True):
+                    ROI = futures[future]
+                    session1.add(outputFilesROI[ROI], sessionName, outputs=[outputFilesROI[ROI]])
+            else:
+                for ROI in ROIs2Process:
+                    projectsBarcodesROI(ROI, filesROI[ROI], param, log1, session1, dataFolder)
+                    session1.add(outputFilesROI[ROI], sessionName, outputs=[outputFilesROI[ROI]])
 
-                # saves projected image into file
+            for fileName in param.fileList2Process:
                 session1.add(fileName, sessionName)
-
-            # [saves imageStack to file before starting a new currentFolder ]
-            for ROI in imageStack:
-                imageFileNameOutput = dataFolder.outputFiles["projectsBarcodes"] + "_" + ROI + ".npy"
-                saveImage2Dcmd(imageStack[ROI], imageFileNameOutput, log1)
-
-                ImtoSave = Image(param,log1)
-                ImtoSave.data_2D = imageStack[ROI]
-                outputName = dataFolder.outputFiles["projectsBarcodes"] + "_" + ROI + ".png"
-                ImtoSave.imageShow(outputName=outputName, normalization="simple")
-
-                log1.report("Output image File {}".format(outputName), "info")
-                del ImtoSave
-
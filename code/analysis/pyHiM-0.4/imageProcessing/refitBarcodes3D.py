@@ -24,13 +24,12 @@ steps:
 # IMPORTS
 # =============================================================================
 
-import glob, os
+import os
 import matplotlib.pylab as plt
 import numpy as np
 from datetime import datetime
 from scipy.ndimage import shift as shiftImage
 from scipy.optimize import curve_fit
-from shutil import copyfile
 
 from tqdm import trange, tqdm
 from astropy.visualization import simple_norm
@@ -41,8 +40,12 @@ from dask.distributed import Client, LocalCluster, get_client, as_completed
 from numba import jit
 
 from imageProcessing.imageProcessing import Image
-from fileProcessing.fileManagement import folders, writeString2File, loadJSON
-from fileProcessing.fileManagement import daskCluster
+from fileProcessing.fileManagement import folders, loadJSON, getsManifest
+from fileProcessing.fileManagement import daskCluster, getsTaskResources, getsTaskPlacement
+from fileProcessing.profiling import profilesTask
+from fileProcessing.imageStore import getsIOParameters, opensStore, readsShape
+from fileProcessing.prefetch import prefetches, getsFileSize
+from fileProcessing.spotTable import existsSpotTable, loadsSpotTable, savesSpotTable, copiesSpotTable
 
 # =============================================================================
 # FUNCTIONS
@@ -61,8 +64,8 @@ class refitBarcodesClass:
     def loadsBarcodeMap(self):
         fileNameBarcodeCoordinates = self.dataFolder.outputFiles["segmentedObjects"] + "_barcode.dat"
 
-        if os.path.exists(fileNameBarcodeCoordinates):
-            barcodeMap = Table.read(fileNameBarcodeCoordinates, format="ascii.ecsv")
+        if existsSpotTable(fileNameBarcodeCoordinates):
+            barcodeMap = loadsSpotTable(fileNameBarcodeCoordinates)
         else:
             print("\n\n *** ERROR: could not found coordinates file: {}".format(fileNameBarcodeCoordinates))
             return Table(), -1
@@ -89,44 +92,79 @@ class refitBarcodesClass:
 
     def findsFile2Process(self, nBarcode, nROI):
         Barcode = "RT" + str(nBarcode)
-        ROI = str(nROI) + "_ROI"
         channelbarcode = self.param.setsChannel("barcode_channel", "ch01")
 
-        filesFolder = glob.glob(self.dataFolder.masterFolder + os.sep + "*.tif")
-        imageFile = [x for x in filesFolder if ROI in x and Barcode in x and channelbarcode in x]
+        imageFile = getsManifest(self.dataFolder.masterFolder, self.param).getsFiles(int(nROI), Barcode, channelbarcode)
 
         return imageFile
 
-    def loadsShifts3Dimage(self, barcodeMapSinglebarcode):
+    def getsShift(self, imageFile):
+        """
+        returns the shift found by alignImages for the cycle of imageFile, None if not found
+
+        """
+        dictShifts = loadJSON(self.dataFolder.outputFiles["dictShifts"] + ".json")
+
+        ROI = self.param.decodesFileParts(os.path.basename(imageFile))["roi"]
+        label = os.path.basename(imageFile).split("_")[2]
+        try:
+            shiftArray = dictShifts["ROI:" + ROI][label]
+        except KeyError:
+            shiftArray = None
+            self.log1.report(
+                "Could not find dictionary with alignment parameters for this ROI: {}, label: {}".format(ROI, label), "ERROR",
+            )
+
+        return shiftArray
+
+    def getsImageFile(self, barcodeMapSinglebarcode):
+        return self.findsFile2Process(
+            np.unique(barcodeMapSinglebarcode["Barcode #"].data)[0], np.unique(barcodeMapSinglebarcode["ROI #"].data)[0]
+        )
+
+    def refitsByTiles(self, imageFile):
+        # tiles are read from the store, if up to date
+        return len(imageFile) > 0 and getsIOParameters(self.param)["store"] == "zarr" and opensStore(imageFile[0]) is not None
+
+    def loads3Dimage(self, barcodeMapSinglebarcode):
+        """
+        reads the 3D image of a barcode, None if there is none or if it is refitted by tiles
+
+        """
+        imageFile = self.getsImageFile(barcodeMapSinglebarcode)
+        if len(imageFile) == 0 or self.refitsByTiles(imageFile):
+            return None
+
+        Im3D = Image(self.param, self.log1)
+        Im3D.loadImage(imageFile[0])
+
+        return Im3D
+
+    def getsImageSize(self, barcodeMapSinglebarcode):
+        # memory of the 3D image of a barcode, none if refitted by tiles
+        imageFile = self.getsImageFile(barcodeMapSinglebarcode)
+        if len(imageFile) == 0 or self.refitsByTiles(imageFile):
+            return 0
+        return getsFileSize(imageFile[0])
+
+    def loadsShifts3Dimage(self, barcodeMapSinglebarcode, Im3D=None):
         nBarcode = np.unique(barcodeMapSinglebarcode["Barcode #"].data)[0]
         nROI = np.unique(barcodeMapSinglebarcode["ROI #"].data)[0]
 
         imageFile = self.findsFile2Process(nBarcode, nROI)
 
         if len(imageFile) > 0:
-            self.log1.report("Loading 3D image for ROI # {}, barcode # {}".format(nROI, nBarcode))
-
-            Im3D = Image(self.param,self.log1)
-            Im3D.loadImage(imageFile[0])
+            # the image may have been read ahead
+            if Im3D is None:
+                self.log1.report("Loading 3D image for ROI # {}, barcode # {}".format(nROI, nBarcode))
+                Im3D = self.loads3Dimage(barcodeMapSinglebarcode)
 
             # corrects drift for all barcodes, except the fiducial
             if "RT" + str(nBarcode) not in self.param.param["alignImages"]["referenceFiducial"]:
 
                 # apply drift correction to 3D image
-                dictShifts = loadJSON(self.dataFolder.outputFiles["dictShifts"] + ".json")
-
-                ROI = self.param.decodesFileParts(os.path.basename(imageFile[0]))["roi"]
-                label = os.path.basename(imageFile[0]).split("_")[2]
-                try:
-                    shiftArray = dictShifts["ROI:" + ROI][label]
-                except KeyError:
-                    shiftArray = None
-                    self.log1.report(
-                        "Could not find dictionary with alignment parameters for this ROI: {}, label: {}".format(ROI, label), "ERROR",
-                    )
-
                 Im3DShifted = Image(self.param,self.log1)
-                shift = np.asarray(shiftArray)
+                shift = np.asarray(self.getsShift(imageFile[0]))
                 imageShape = Im3D.data.shape
                 numberZplanes = imageShape[0]
                 Im3DShifted.data = np.zeros(imageShape)  # creates array that will hold new shifted 3D data
@@ -169,11 +207,12 @@ class refitBarcodesClass:
 
     def getFOV(self, x, y, imageShape):
 
+        # x runs along the last axis of the image, y along the second
         fov = {
             "xleft": int(np.max([1, x - self.window])),
-            "xright": int(np.min([imageShape[1], x + self.window])),
+            "xright": int(np.min([imageShape[2], x + self.window])),
             "yleft": int(np.max([1, y - self.window])),
-            "yright": int(np.min([imageShape[2], y + self.window])),
+            "yright": int(np.min([imageShape[1], y + self.window])),
         }
         return fov
 
@@ -355,6 +394,74 @@ class refitBarcodesClass:
 
         return barcodeMapSinglebarcode
 
+    def fitsZpositionsByTiles(self, imageFile, barcodeMapSinglebarcode):
+        """
+        Fits the z positions of the spots reading from the image store only the xy tiles with
+        spots, with a margin for the fitting window and the shift. Tiles are shifted one at a
+        time instead of the whole 3D image.
+
+        Parameters
+        ----------
+        imageFile : string
+            3D image of the barcode, with an up to date store.
+        barcodeMapSinglebarcode : ASTROPY table
+
+        Returns
+        -------
+        barcodeMapSinglebarcode : ASTROPY table
+            with the fitted z centroids.
+        numberZplanes : int
+
+        """
+        nBarcode = np.unique(barcodeMapSinglebarcode["Barcode #"].data)[0]
+        shift = None
+        if "RT" + str(nBarcode) not in self.param.param["alignImages"]["referenceFiducial"]:
+            shift = np.asarray(self.getsShift(imageFile))
+
+        imageShape = readsShape(imageFile, self.param)
+        tileSize = getsIOParameters(self.param)["chunkXY"]
+        margin = self.window + 4 + (0 if shift is None else int(np.ceil(np.max(np.abs(shift)))))
+
+        xcentroids2D = barcodeMapSinglebarcode["xcentroid"].data
+        ycentroids2D = barcodeMapSinglebarcode["ycentroid"].data
+        numberSpots = len(xcentroids2D)
+
+        # spots of each tile
+        tiles = {}
+        for iSpot in range(numberSpots):
+            tile = (int(ycentroids2D[iSpot]) // tileSize, int(xcentroids2D[iSpot]) // tileSize)
+            tiles.setdefault(tile, []).append(iSpot)
+
+        self.log1.report("Looping over {} spots in {} tiles...".format(numberSpots, len(tiles)))
+
+        results = [None] * numberSpots
+        for (ytile, xtile), spots in tiles.items():
+            ymin, ymax = max(0, ytile * tileSize - margin), min(imageShape[1], (ytile + 1) * tileSize + margin)
+            xmin, xmax = max(0, xtile * tileSize - margin), min(imageShape[2], (xtile + 1) * tileSize + margin)
+
+            ImTile = Image(self.param, self.log1)
+            ImTile.loadImage(imageFile, crop=((ymin, ymax), (xmin, xmax)))
+
+            if shift is not None:
+                tileShifted = np.zeros(ImTile.data.shape)
+                for z in range(ImTile.data.shape[0]):
+                    tileShifted[z, :, :] = shiftImage(ImTile.data[z, :, :], shift)
+                ImTile.data = tileShifted
+
+            for iSpot in spots:
+                results[iSpot] = self.getzPosition(
+                    ImTile, xcentroids2D[iSpot] - xmin, ycentroids2D[iSpot] - ymin, ImTile.data.shape
+                )
+
+        self.log1.report("Unfailed fittings: {} out of {} ".format(sum([x[5] for x in results]), numberSpots))
+        barcodeMapSinglebarcode["zcentroidGauss"] = [x[1] for x in results]
+        barcodeMapSinglebarcode["zcentroidMoment"] = [x[0] for x in results]
+        barcodeMapSinglebarcode["sigmaGaussFit"] = [x[2] for x in results]
+        barcodeMapSinglebarcode["residualGaussFit"] = [x[3] for x in results]
+        barcodeMapSinglebarcode["3DfitKeep"] = [x[4] for x in results]
+
+        return barcodeMapSinglebarcode, imageShape[0]
+
     def shows3DfittingResults(self, barcodeMapSinglebarcode, numberZplanes=60, show=False):
         nBarcode = np.unique(barcodeMapSinglebarcode["Barcode #"].data)[0]
         ROI = np.unique(barcodeMapSinglebarcode["ROI #"].data)[0]
@@ -432,11 +539,10 @@ class refitBarcodesClass:
             plt.close()
 
         # write line in MD file pointing to plot
-        writeString2File(
-            self.log1.fileNameMD, "{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName), "a",
-        )
+        self.log1.addMarkdown("{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName))
 
-    def refitsBarcode(self, barcodeMapSinglebarcode):
+    @profilesTask("refitBarcodes3D")
+    def refitsBarcode(self, barcodeMapSinglebarcode, Im3D=None):
         '''
         Refits a barcode encoded in barcodeMapSinglebarcode
         
@@ -444,6 +550,8 @@ class refitBarcodesClass:
         ----------
         barcodeMapSinglebarcode : ASTROPY table
             List of coordinates detected in an ROI for a specific barcode.
+        Im3D : Image Class, optional
+            3D image of the barcode, if already read. The default is None.
 
         Returns
         -------
@@ -451,15 +559,21 @@ class refitBarcodesClass:
             ASTROPY table with the fitted z centroids.
 
         '''
-        # load 3D image
-        Im3DShifted = self.loadsShifts3Dimage(barcodeMapSinglebarcode)
-        numberZplanes = Im3DShifted.data.shape[0]
+        imageFile = self.getsImageFile(barcodeMapSinglebarcode)
 
-        # shows 2D images and detected sources
-        # self.showsImageNsources(Im3DShifted.data_2D, xcentroids2D, ycentroids2D)
-          
-        # loop over spots
-        barcodeMapSinglebarcode = self.fitsZpositions(Im3DShifted, barcodeMapSinglebarcode)
+        if self.refitsByTiles(imageFile):
+            # reads and shifts only the tiles with spots
+            barcodeMapSinglebarcode, numberZplanes = self.fitsZpositionsByTiles(imageFile[0], barcodeMapSinglebarcode)
+        else:
+            # load 3D image
+            Im3DShifted = self.loadsShifts3Dimage(barcodeMapSinglebarcode, Im3D=Im3D)
+            numberZplanes = Im3DShifted.data.shape[0]
+
+            # shows 2D images and detected sources
+            # self.showsImageNsources(Im3DShifted.data_2D, xcentroids2D, ycentroids2D)
+
+            # loop over spots
+            barcodeMapSinglebarcode = self.fitsZpositions(Im3DShifted, barcodeMapSinglebarcode)
 
         # displays results
         self.shows3DfittingResults(barcodeMapSinglebarcode, numberZplanes=numberZplanes)
@@ -474,9 +588,9 @@ class refitBarcodesClass:
         fileNameBarcodeCoordinates = self.dataFolder.outputFiles["segmentedObjects"] + "_barcode.dat"
         fileNameBarcodeCoordinatesOld = self.dataFolder.outputFiles["segmentedObjects"] + "_barcode2D.dat"
 
-        copyfile(fileNameBarcodeCoordinates, fileNameBarcodeCoordinatesOld)
+        copiesSpotTable(fileNameBarcodeCoordinates, fileNameBarcodeCoordinatesOld)
                 
-        barcodeMap.write(fileNameBarcodeCoordinates, format="ascii.ecsv", overwrite=True)
+        savesSpotTable(barcodeMap, fileNameBarcodeCoordinates, self.param)
     
     def refitFilesinFolder(self):
         '''
@@ -528,19 +642,23 @@ class refitBarcodesClass:
                 for iBarcode in range(numberBarcodes):
                     # find coordinates for this ROI and barcode
                     barcodeMapSinglebarcode = barcodeMapROI_barcodeID.group_by("Barcode #").groups[iBarcode]
-                    result = client.submit(self.refitsBarcode, barcodeMapSinglebarcode)
+                    # runs on a node with a local copy of the 3D image, if any
+                    imageFile = self.getsImageFile(barcodeMapSinglebarcode)
+                    result = client.submit(self.refitsBarcode, barcodeMapSinglebarcode, resources=getsTaskResources("refitBarcodes3D"),
+                                           **getsTaskPlacement(imageFile))
                     futures.append(result)    
             
             self.log1.info("Waiting for {} results to arrive".format(len(futures)))
 
-            results = client.gather(futures)       
+            # collects refits as they are completed
+            results = [result for _, result in as_completed(futures, with_results=True)]
 
             self.log1.info("{} results retrieved from cluster".format(len(results)))
 
             del futures
                  
         else:
-            results = []
+            barcodeMaps = []
             for iROI in range(numberROIs):
                 nROI = barcodeMapROI.groups.keys[iROI][0]  # need to iterate over the first index
                 self.log1.report("Working on ROI# {}".format(nROI))
@@ -554,8 +672,15 @@ class refitBarcodesClass:
                 for iBarcode in range(numberBarcodes):
                     # find coordinates for this ROI and barcode
                     barcodeMapSinglebarcode = barcodeMapROI_barcodeID.group_by("Barcode #").groups[iBarcode]
-                    result = self.refitsBarcode(barcodeMapSinglebarcode)
-                    results.append(result)
+                    barcodeMaps.append(barcodeMapSinglebarcode)
+
+            # the images of the next barcodes are read while the current one is refitted
+            results = []
+            images = prefetches(barcodeMaps, self.loads3Dimage, self.param, sizer=self.getsImageSize)
+            for barcodeMapSinglebarcode, Im3D in images:
+                result = self.refitsBarcode(barcodeMapSinglebarcode, Im3D=Im3D)
+                results.append(result)
+                del Im3D
 
         # record results by appending the ASTROPY table *** use index first then match BUIDs in barcodeMapSinglebarcode to
         # those in barcodeMapROI and replace values of the row in barcodeMapROI by those in barcodeMapSinglebarcode
@@ -587,7 +712,7 @@ class refitBarcodesClass:
         self.log1.addSimpleText("\n===================={}====================\n".format(sessionName))
         self.dataFolder = folders(self.param.param["rootFolder"])
         self.log1.report("folders read: {}".format(len(self.dataFolder.listFolders)))
-        writeString2File(self.log1.fileNameMD, "## {}\n".format(sessionName), "a")
+        self.log1.addMarkdown("## {}\n".format(sessionName))
 
         # creates output folders and filenames
         currentFolder = self.dataFolder.listFolders[0]
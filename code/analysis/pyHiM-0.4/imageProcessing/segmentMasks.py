@@ -21,7 +21,7 @@ after image segmentation.
 # ---- stardist
 from __future__ import print_function, unicode_literals, absolute_import, division
 
-import glob, os, time
+import os, time
 import matplotlib.pylab as plt
 from matplotlib.path import Path
 from scipy.ndimage import gaussian_filter
@@ -30,7 +30,7 @@ from skimage.measure import regionprops
 
 import numpy as np
 import uuid
-from dask.distributed import Client, get_client
+from dask.distributed import Client, get_client, as_completed
 
 from astropy.stats import sigma_clipped_stats, SigmaClip, gaussian_fwhm_to_sigma
 from astropy.convolution import Gaussian2DKernel
@@ -42,20 +42,17 @@ from photutils import detect_threshold, deblend_sources
 from photutils import Background2D, MedianBackground
 from photutils.segmentation.core import SegmentationImage
 
-from imageProcessing.imageProcessing import Image, saveImage2Dcmd
+from imageProcessing.imageProcessing import Image, saveImage2Dcmd, randomLabelColormap
 from fileProcessing.fileManagement import (
-    folders, writeString2File)
+    folders, getsTaskResources, listsImages, existsIntermediate, loadsIntermediate)
+from fileProcessing.stageCache import stageCache, selectsParameters
+from fileProcessing.profiling import profilesTask
+from fileProcessing.spotTable import spotTable, getsSpotTableParameters, savesSpotTable
 
-# ---- stardist
 import matplotlib
 matplotlib.rcParams["image.interpolation"] = None
-from csbdeep.utils import normalize
-
-from stardist import random_label_cmap
-from stardist.models import StarDist2D
 
 np.random.seed(6)
-lbl_cmap = random_label_cmap()
 
 # to remove in a future version
 import warnings
@@ -94,16 +91,12 @@ def showsImageSources(im, im1_bkg_substracted, log1, sources, outputFileName):
     fig.savefig(outputFileName + "_segmentedSources.png")
     plt.close(fig)
     
-    writeString2File(
-        log1.fileNameMD,
-        "{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName + "_segmentedSources.png"),
-        "a",
-    )
+    log1.addMarkdown("{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName + "_segmentedSources.png"))
     
 def showsImageMasks(im, log1, segm_deblend, outputFileName):
     
     norm = ImageNormalize(stretch=SqrtStretch())
-    cmap = lbl_cmap
+    cmap = randomLabelColormap()
 
     fig = plt.figure()
     fig.set_size_inches((30, 30))
@@ -111,11 +104,7 @@ def showsImageMasks(im, log1, segm_deblend, outputFileName):
     plt.imshow(segm_deblend, origin="lower", cmap=cmap, alpha=0.5)
     plt.savefig(outputFileName + "_segmentedMasks.png")
     plt.close()
-    writeString2File(
-        log1.fileNameMD,
-        "{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName + "_segmentedMasks.png"),
-        "a",
-    )
+    log1.addMarkdown("{}\n ![]({})\n".format(os.path.basename(outputFileName), outputFileName + "_segmentedMasks.png"))
 
 
 def segmentSourceInhomogBackground(im, param):
@@ -470,6 +459,10 @@ def segmentMaskStardist(im, param):
     #     param.param["segmentedObjects"]["threshold_over_std"] * bkg.background_rms
     # )  # background-only error image, typically 1.0
 
+    # stardist and csbdeep import tensorflow: they are only imported when this method is used
+    from csbdeep.utils import normalize
+    from stardist.models import StarDist2D
+
     sigma = param.param["segmentedObjects"]["fwhm"] * gaussian_fwhm_to_sigma  # FWHM = 3.
     kernel = Gaussian2DKernel(sigma, x_size=3, y_size=3)
     kernel.normalize()
@@ -494,7 +487,7 @@ def segmentMaskStardist(im, param):
     # if True:
     #     plt.figure(figsize=(8, 8))
     #     plt.imshow(img, clim=(0, 1), cmap="gray")
-    #     plt.imshow(labeled, cmap=lbl_cmap, alpha=0.5)
+    #     plt.imshow(labeled, cmap=randomLabelColormap(), alpha=0.5)
     #     plt.axis("off")
 
     # estimates masks and deblends
@@ -517,17 +510,51 @@ def segmentMaskStardist(im, param):
     return segm_deblend, labeled
 
 
+@profilesTask("segmentMasks")
 def makesSegmentations(fileName, param, log1, session1, dataFolder):
 
     rootFileName = os.path.basename(fileName).split(".")[0]
     outputFileName = dataFolder.outputFolders["segmentedObjects"] + os.sep + rootFileName
     fileName_2d_aligned = dataFolder.outputFolders["alignImages"] + os.sep + rootFileName + "_2d_registered.npy"
 
+    # parameters only used by the later refitting and PWD stages are left out of the key
+    cache = stageCache(dataFolder.outputFolders["stageCache"])
+    key = cache.getKey(
+        makesSegmentations,
+        [fileName_2d_aligned],
+        {
+            "label": param.param["acquisition"]["label"],
+            "segmentedObjects": selectsParameters(
+                param.param["segmentedObjects"],
+                exclude=[
+                    "folder",
+                    "operation",
+                    "outputFile",
+                    "flux_min",
+                    "residual_max",
+                    "sigma_max",
+                    "centroidDifference_max",
+                    "3DGaussianfitWindow",
+                    "toleranceDrift",
+                ],
+            ),
+        },
+    )
+    entry = cache.load("segmentedObjects", fileName, key)
+
     log1.report("searching for {}".format(fileName_2d_aligned))
-    if (
-        # (fileName in session1.data)
-        param.param["segmentedObjects"]["operation"] == "overwrite"
-        and os.path.exists(fileName_2d_aligned)
+    if param.param["segmentedObjects"]["operation"] != "overwrite" and entry is not None:
+        log1.report("File already segmented: {}".format(os.path.basename(fileName)))
+        if len(entry["outputs"]) == 0:
+            return []
+        elif entry["outputs"][0].endswith(".ecsv"):
+            return Table.read(entry["outputs"][0], format="ascii.ecsv")
+        else:
+            return loadsIntermediate(entry["outputs"][0], param)
+
+    elif (
+        param.param["segmentedObjects"]["operation"] in ["overwrite", "skip"]
+        and existsIntermediate(fileName_2d_aligned, param)
     ):  # file exists
 
         ROI = os.path.basename(fileName).split("_")[param.param["acquisition"]["positionROIinformation"]]
@@ -583,6 +610,10 @@ def makesSegmentations(fileName, param, log1, session1, dataFolder):
             # for col in output.colnames:
             #    output[col].info.format = '%.8g'  # for consistent table output
 
+            # saves the table of this file so that it can be reused in the next runs
+            output.write(outputFileName + "_segmentedObjects.ecsv", format="ascii.ecsv", overwrite=True)
+            cache.save("segmentedObjects", fileName, key, [outputFileName + "_segmentedObjects.ecsv"])
+
         #######################################
         #           Segments DAPI Masks
         #######################################
@@ -613,11 +644,11 @@ def makesSegmentations(fileName, param, log1, session1, dataFolder):
 
             showsImageMasks(im, log1, output, outputFileName)
 
-            # saves output 2d zProjection as matrix
-            Im.saveImage2D(log1, dataFolder.outputFolders["zProject"])
-            saveImage2Dcmd(output, outputFileName + "_Masks", log1)
+            saveImage2Dcmd(output, outputFileName + "_Masks", log1, param=param)
+            cache.save("segmentedObjects", fileName, key, [outputFileName + "_Masks.npy"])
         else:
             output = []
+            cache.save("segmentedObjects", fileName, key, [])
         del Im
 
         return output
@@ -626,14 +657,35 @@ def makesSegmentations(fileName, param, log1, session1, dataFolder):
             "2D aligned file does not exist:{}\n{}\n{}\n{}".format(
                 fileName_2d_aligned,
                 fileName in session1.data.keys(),
-                param.param["segmentedObjects"]["operation"] == "overwrite",
-                os.path.exists(fileName_2d_aligned),
+                param.param["segmentedObjects"]["operation"],
+                existsIntermediate(fileName_2d_aligned, param),
             ),
             "Error",
         )
         return []
 
 
+def getsSegmentationOutputs(fileName, label, dataFolder):
+    outputFileName = dataFolder.outputFolders["segmentedObjects"] + os.sep + os.path.basename(fileName).split(".")[0]
+    if label == "barcode":
+        return [outputFileName + "_segmentedObjects.ecsv"]
+    elif label == "DAPI":
+        return [outputFileName + "_Masks.npy"]
+    else:
+        return []
+
+
+def loadsSegmentation(record, label):
+    """
+    returns the output of makesSegmentations for a file recorded in the journal
+
+    """
+    if label == "barcode" and len(record["outputs"]) > 0:
+        return Table.read(record["outputs"][0], format="ascii.ecsv")
+    else:
+        return []
+
+
 def segmentMasks(param, log1, session1,fileName=None):
     sessionName = "segmentMasks"
 
@@ -643,14 +695,12 @@ def segmentMasks(param, log1, session1,fileName=None):
     )
     dataFolder = folders(param.param["rootFolder"])
     log1.report("folders read: {}".format(len(dataFolder.listFolders)))
-    writeString2File(
-        log1.fileNameMD, "## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]), "a",
-    )
+    log1.addMarkdown("## {}: {}\n".format(sessionName, param.param["acquisition"]["label"]))
     barcodesCoordinates = Table()
 
     for currentFolder in dataFolder.listFolders:
         # currentFolder=dataFolder.listFolders[0]
-        filesFolder = glob.glob(currentFolder + os.sep + "*.tif")
+        filesFolder = listsImages(currentFolder, param)
         dataFolder.createsFolders(currentFolder, param)
 
         # generates lists of files to process
@@ -666,48 +716,76 @@ def segmentMasks(param, log1, session1,fileName=None):
         if param.param['parallel']:
             # running in parallel mode
             client=get_client()
-            futures=list()           
+            futures=dict()
           
+            results = {}
             for fileName2Process in param.fileList2Process:
                 if fileName==None or (fileName!=None and os.path.basename(fileName)==os.path.basename(fileName2Process)):
                     if label != "fiducial":
-                        # print("x={}".format(fileName2Process))
-                        futures.append(client.submit(makesSegmentations,fileName2Process, param, log1, session1, dataFolder))
-                        session1.add(fileName2Process, sessionName)
+                        record = session1.isCompleted(sessionName, fileName2Process)
+                        if record is not None:
+                            # segmented in the run being resumed
+                            results[fileName2Process] = loadsSegmentation(record, label)
+                        else:
+                            futures[client.submit(makesSegmentations,fileName2Process, param, log1, session1, dataFolder,
+                                                   resources=getsTaskResources("segmentMasks"))] = fileName2Process
             
             log1.info("Waiting for {} results to arrive".format(len(futures)))
-            
-            results=client.gather(futures)
+
+            # gathers results from different barcodes and ROIs as they arrive
+            for future, result in as_completed(futures, with_results=True):
+                session1.add(futures[future], sessionName, outputs=getsSegmentationOutputs(futures[future], label, dataFolder))
+                if label == "barcode":
+                    results[futures[future]] = result
 
             if label == "barcode":
-                # gathers results from different barcodes and ROIs
-                log1.info("Retrieving {} results from cluster".format(len(results)))
-                detectedSpots = []
-                for result in results:
-                    detectedSpots.append(len(result)) 
-                    barcodesCoordinates = vstack([barcodesCoordinates, result])
-
-                    # saves results together into a single Table
-                    barcodesCoordinates.write(outputFile, format="ascii.ecsv", overwrite=True)
+                # keeps the order of the file list so that the Table is the same from run to run
+                outputs = [results[x] for x in param.fileList2Process if x in results]
+                detectedSpots = [len(x) for x in outputs]
+                # saves results together into a single Table
+                log1.info("Retrieved {} results from cluster".format(len(outputs)))
+                barcodesCoordinates = vstack([barcodesCoordinates] + outputs)
+                savesSpotTable(barcodesCoordinates, outputFile, param)
                 print("File {} written to file.".format(outputFile))
                 print("Detected spots: {}".format(",".join([str(x) for x in detectedSpots])))
 
         else:
 
+            # in binary format the spots of each file are appended, instead of rewriting the table
+            spotTableFormat, exportsECSV = getsSpotTableParameters(param)
+            if label == "barcode" and spotTableFormat == "binary":
+                spotTable(outputFile).removes()
 
             for fileName2Process in param.fileList2Process:
                 if fileName==None or (fileName!=None and os.path.basename(fileName)==os.path.basename(fileName2Process)):
                     if label != "fiducial":
                         
                         # running in sequential mode
-                        output = makesSegmentations(fileName2Process, param, log1, session1, dataFolder)
+                        record = session1.isCompleted(sessionName, fileName2Process)
+                        if record is not None:
+                            # segmented in the run being resumed
+                            output = loadsSegmentation(record, label)
+                        else:
+                            output = makesSegmentations(fileName2Process, param, log1, session1, dataFolder)
 
                         # gathers results from different barcodes and ROIs
-                        if label == "barcode":
+                        if label == "barcode" and spotTableFormat == "binary":
+                            if len(output) > 0:
+                                spotTable(outputFile).appends(output)
+                                log1.report("{} spots appended to {}".format(len(output), outputFile), "info")
+                        elif label == "barcode":
                             barcodesCoordinates = vstack([barcodesCoordinates, output])
                             barcodesCoordinates.write(outputFile, format="ascii.ecsv", overwrite=True)
                             log1.report("File {} written to file.".format(outputFile), "info")
                             
-                        session1.add(fileName2Process, sessionName)
-                        
+                        if record is None:
+                            session1.add(fileName2Process, sessionName, outputs=getsSegmentationOutputs(fileName2Process, label, dataFolder))
+
+            if label == "barcode" and spotTableFormat == "binary" and spotTable(outputFile).exists():
+                if exportsECSV:
+                    spotTable(outputFile).reads().write(outputFile, format="ascii.ecsv", overwrite=True)
+                    log1.report("File {} written to file.".format(outputFile), "info")
+                elif os.path.exists(outputFile):
+                    os.remove(outputFile)
+
     return 0
\ No newline at end of file
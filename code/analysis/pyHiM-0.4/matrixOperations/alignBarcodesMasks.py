@@ -18,7 +18,7 @@ This file contains as well some tools for representation of matrices.
 # IMPORTS
 # =============================================================================
 
-import glob, os, sys
+import os, sys
 import uuid
 import re
 import numpy as np
@@ -35,7 +35,16 @@ from photutils.segmentation import SegmentationImage
 from fileProcessing.fileManagement import (
     folders,
     writeString2File,
+    getsManifest,
+    existsIntermediate,
+    loadsIntermediate,
+    loadsIntermediates,
+    listsIntermediates,
     )
+from fileProcessing.stageCache import stageCache
+from fileProcessing.spotTable import existsSpotTable, loadsSpotTable, listsSpotTableFiles
+from fileProcessing.profiling import profilesTask
+from fileProcessing.figureQueue import queuesFigure
 
 from matrixOperations.HIMmatrixOperations import plotMatrix, plotDistanceHistograms, calculateContactProbabilityMatrix
 
@@ -599,8 +608,8 @@ def loadsBarcodeMap(fileNameBarcodeCoordinates, ndims):
         either 2 or 3.
 
     '''
-    if os.path.exists(fileNameBarcodeCoordinates):
-        barcodeMap = Table.read(fileNameBarcodeCoordinates, format="ascii.ecsv")
+    if existsSpotTable(fileNameBarcodeCoordinates):
+        barcodeMap = loadsSpotTable(fileNameBarcodeCoordinates)
         if ndims==3 and "zcentroidGauss" in barcodeMap.keys():
             localizationDimension = 3
         else:
@@ -627,7 +636,10 @@ def buildsDictionaryErrorAlignmentMasks(param,dataFolder):
 
     """
     folder = dataFolder.outputFolders["alignImages"] 
-    fileList = glob.glob(folder + os.sep + "*_errorAlignmentBlockMap.npy")
+    fileList = listsIntermediates(folder, "_errorAlignmentBlockMap")
+
+    # block maps in ROI containers are read with a single open per ROI
+    blockMaps = loadsIntermediates(fileList)
 
     # decodes files and builds dictionnary
     fileNameRegExp = param.param["acquisition"]["fileNameRegExp"]
@@ -640,7 +652,7 @@ def buildsDictionaryErrorAlignmentMasks(param,dataFolder):
         if 'ROI:'+str(int(regExp['roi'])) not in dictErrorBlockMasks.keys():
             dictErrorBlockMasks['ROI:'+str(int(regExp['roi']))]= {}
         if 'barcode:'+regExp['cycle'].split('RT')[-1] not in dictErrorBlockMasks.keys():
-            newMask = np.load(file)
+            newMask = blockMaps[file]
             dictErrorBlockMasks['ROI:'+str(int(regExp['roi']))]['barcode:'+regExp['cycle'].split('RT')[-1]]= newMask
 
     return dictErrorBlockMasks
@@ -655,7 +667,7 @@ def plotsAllmatrices(SCmatrixCollated,
                     logNameMD,
                     localizationDimension):
     """
-    Plots all matrices after analysis
+    Plots all matrices after analysis. The histograms of PWD distances are plotted separately by plotDistanceHistograms
 
     Parameters
     ----------
@@ -751,15 +763,8 @@ def plotsAllmatrices(SCmatrixCollated,
         clim=np.max(Nmatrix), 
         cm='Blues',
         fileNameEnding="_Nmatrix.png")
-
-    plotDistanceHistograms(SCmatrixCollated, 
-                           pixelSize,
-                           outputFileName, 
-                           logNameMD,
-                           mode="KDE",
-                           kernelWidth=0.25,
-                           optimizeKernelWidth=False)
     
+@profilesTask("buildsPWDmatrix")
 def buildsPWDmatrix(param,
     currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize=0.1, logNameMD="log.md", ndims=2
 ):
@@ -805,7 +810,7 @@ def buildsPWDmatrix(param,
     print("\nROIs detected: {}".format(numberROIs))
     
     # loops over ROIs
-    filesinFolder = glob.glob(currentFolder + os.sep + "*.tif")
+    folderManifest = getsManifest(currentFolder, param)
     SCmatrixCollated, uniqueBarcodes, processingOrder = [], [], 0
 
     for ROI in range(numberROIs):
@@ -816,21 +821,15 @@ def buildsPWDmatrix(param,
         barcodeMapSingleROI = barcodeMap.group_by("ROI #").groups[ROI]
 
         # finds file with cell masks
-        fileList2Process = [
-            file
-            for file in filesinFolder
-            if file.split("_")[-1].split(".")[0] == "ch00"
-            and "DAPI" in os.path.basename(file).split("_")
-            and int(os.path.basename(file).split("_")[3]) == nROI
-        ]
+        fileList2Process = folderManifest.getsFiles(int(nROI), "DAPI", "ch00")
 
         if len(fileList2Process) > 0:
             
             # loads file with cell masks
             fileNameROImasks = os.path.basename(fileList2Process[0]).split(".")[0] + "_Masks.npy"
             fullFileNameROImasks = os.path.dirname(fileNameBarcodeCoordinates) + os.sep + fileNameROImasks
-            if os.path.exists(fullFileNameROImasks):
-                Masks = np.load(fullFileNameROImasks)
+            if existsIntermediate(fullFileNameROImasks, param):
+                Masks = loadsIntermediate(fullFileNameROImasks, param)
 
                 # Assigns barcodes to Masks for a given ROI
                 cellROI = cellID(param,dataFolder,barcodeMapSingleROI, Masks, ROI,ndims=localizationDimension)
@@ -878,21 +877,6 @@ def buildsPWDmatrix(param,
                     )
                 )
                 print("File I was searching for: {}".format(fullFileNameROImasks))
-                print("Debug: ")
-                for file in filesinFolder:
-                    if (
-                        file.split("_")[-1].split(".")[0] == "ch00"
-                        and "DAPI" in file.split("_")
-                        and int(os.path.basename(file).split("_")[3]) == nROI
-                    ):
-                        print("Hit found!")
-                    print(
-                        "fileSplit:{}, DAPI in filename: {}, ROI: {}".format(
-                            file.split("_")[-1].split(".")[0],
-                            "DAPI" in os.path.basename(file).split("_"),
-                            int(os.path.basename(file).split("_")[3]),
-                        )
-                    )
 
     if processingOrder>0:
         # calculates N-matrix: number of PWD distances for each barcode combination
@@ -906,16 +890,80 @@ def buildsPWDmatrix(param,
         #################################
         # makes and saves outputs plots #
         #################################
-        plotsAllmatrices(SCmatrixCollated, 
-                        Nmatrix,
-                        uniqueBarcodes, 
-                        pixelSize, 
-                        numberROIs, 
-                        outputFileName, 
-                        logNameMD,
-                        localizationDimension)
+        # figures are rendered at the end of the run. The NxN grid of PWD histograms is only
+        # rendered at the full render level
+        queuesFigure(param,
+                     plotsAllmatrices,
+                     (SCmatrixCollated, 
+                      Nmatrix,
+                      uniqueBarcodes, 
+                      pixelSize, 
+                      numberROIs, 
+                      outputFileName, 
+                      logNameMD,
+                      localizationDimension),
+                     level="summary")
+
+        queuesFigure(param,
+                     plotDistanceHistograms,
+                     (SCmatrixCollated, 
+                      pixelSize,
+                      outputFileName, 
+                      logNameMD),
+                     kwargs={"mode": "KDE", "kernelWidth": 0.25, "optimizeKernelWidth": False},
+                     level="full")
     
-               
+
+def buildsPWDmatrixCached(param,
+    currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize=0.1, log1=None, ndims=2
+):
+    """
+    Runs buildsPWDmatrix unless its outputs were already produced from the same
+    barcode localizations, masks, alignments and parameters.
+    The cache is used if the segmentedObjects operation is set to "skip".
+
+    Parameters
+    ----------
+    see buildsPWDmatrix
+
+    Returns
+    -------
+    None.
+
+    """
+    inputFiles = (
+        listsSpotTableFiles(fileNameBarcodeCoordinates)
+        + [dataFolder.outputFiles["alignImages"].split(".")[0] + "_localAlignment.dat"]
+        + listsIntermediates(dataFolder.outputFolders["segmentedObjects"], "_Masks")
+        + listsIntermediates(dataFolder.outputFolders["alignImages"], "_errorAlignmentBlockMap")
+    )
+    parameters = {
+        "flux_min": param.param["segmentedObjects"].get("flux_min"),
+        "toleranceDrift": param.param["segmentedObjects"].get("toleranceDrift"),
+        "referenceFiducial": param.param["alignImages"]["referenceFiducial"],
+        "pixelSize": pixelSize,
+        "ndims": ndims,
+        # select the files read
+        "acquisition": {
+            x: param.param["acquisition"].get(x)
+            for x in ["fileNameRegExp", "DAPI_channel", "barcode_channel", "fiducialBarcode_channel", "fiducialDAPI_channel"]
+        },
+    }
+
+    # barcode and alignment tables are rewritten at every run, so their contents are compared
+    cache = stageCache(dataFolder.outputFolders["stageCache"])
+    key = cache.getKey(buildsPWDmatrix, inputFiles, parameters, checksum=True)
+
+    if param.param["segmentedObjects"]["operation"] != "overwrite" and cache.load("buildsPWDmatrix", outputFileName, key) is not None:
+        log1.report("PWD matrix already built: {}".format(os.path.basename(outputFileName)))
+    else:
+        buildsPWDmatrix(
+            param, currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize, log1.fileNameMD, ndims=ndims,
+        )
+        outputs = [outputFileName + x for x in ["_HiMscMatrix.npy", "_uniqueBarcodes.ecsv", "_Nmatrix.npy"]]
+        if all([os.path.exists(x) for x in outputs]):
+            cache.save("buildsPWDmatrix", outputFileName, key, outputs)
+
 def processesPWDmatrices(param, log1, session1):
     """
     Function that assigns barcode localizations to DAPI masks and constructs single cell cummulative PWD matrix.
@@ -940,7 +988,7 @@ def processesPWDmatrices(param, log1, session1):
     dataFolder = folders(param.param["rootFolder"])
     log1.addSimpleText("\n===================={}====================\n".format(sessionName))
     log1.report("folders read: {}".format(len(dataFolder.listFolders)))
-    writeString2File(log1.fileNameMD, "## {}\n".format(sessionName), "a")
+    log1.addMarkdown("## {}\n".format(sessionName))
 
     for currentFolder in dataFolder.listFolders:
         # filesFolder=glob.glob(currentFolder+os.sep+'*.tif')
@@ -959,8 +1007,8 @@ def processesPWDmatrices(param, log1, session1):
         else:
             pixelSize = 0.1
             
-        buildsPWDmatrix(
-            param,currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize, log1.fileNameMD,
+        buildsPWDmatrixCached(
+            param,currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize, log1,
         )
 
         # 3D
@@ -977,8 +1025,8 @@ def processesPWDmatrices(param, log1, session1):
         else:
             pixelSize = 0.1            
             
-        buildsPWDmatrix(
-            param,currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize, log1.fileNameMD, ndims=3
+        buildsPWDmatrixCached(
+            param,currentFolder, fileNameBarcodeCoordinates, outputFileName, dataFolder, pixelSize, log1, ndims=3
         )
 
         # loose ends
@@ -987,3 +1035,6 @@ def processesPWDmatrices(param, log1, session1):
         log1.report("HiM matrix in {} processed".format(currentFolder), "info")
 
 
+
+    # in parallel mode this function runs in a worker: its log lines are sent back as a shard
+    log1.flush()
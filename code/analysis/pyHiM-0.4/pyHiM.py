@@ -18,8 +18,9 @@ The main() will search for parameter files within the folder provided. All ope-e
 
 from datetime import datetime
 
-from fileProcessing.fileManagement import Parameters
 from fileProcessing.functionCaller import HiMfunctionCaller, HiM_parseArguments
+from fileProcessing.profiling import mergesProfiles
+from fileProcessing.figureQueue import rendersFigures
 
 # to remove in a future version
 import warnings
@@ -40,47 +41,30 @@ if __name__ == "__main__":
     
     HiM.lauchDaskScheduler()
 
-    for ilabel in range(len(HiM.labels2Process)):
-        HiM.log1.addSimpleText("**Analyzing label: {}**".format(HiM.labels2Process[ilabel]["label"]))
+    # [runs all stages for all labels following their dependencies]
+    if runParameters["stream"]:
+        # processes images as they are acquired, then runs the stages left
+        HiM.runsStreaming()
+    else:
+        HiM.runsTaskGraph()
+    print("\n")
 
-        # sets parameters
-        param = Parameters(runParameters["rootFolder"], HiM.labels2Process[ilabel]["parameterFile"])
-        param.param['parallel']=HiM.parallel
+    # renders the figures queued by the stages
+    rendersFigures(HiM.rootFolder, HiM.log1)
 
-        # [projects 3D images in 2d]
-        HiM.makeProjections(param)
-
-        # [registers fiducials using a barcode as reference]
-        HiM.alignImages(param, ilabel)
-        
-        # [applies registration to DAPI and barcodes]
-        HiM.appliesRegistrations(param, ilabel)
-        
-        # [segments DAPI and spot masks]
-        HiM.segmentMasks(param, ilabel)
-
-        # [2D projects all barcodes in an ROI]
-        HiM.projectsBarcodes(param, ilabel)
-            
-        # [refits spots in 3D]
-        HiM.refitBarcodes(param, ilabel)
-           
-        # [local drift correction]
-        HiM.localDriftCorrection(param, ilabel)
-
-        # [builds PWD matrix for all folders with images]
-        HiM.processesPWDmatrices(param, ilabel)
-
-        print("\n")
-        del param
+    # aggregates the time and memory used by each stage
+    mergesProfiles(HiM.rootFolder, HiM.log1)
 
     # exits
     HiM.session1.save(HiM.log1)
     HiM.log1.addSimpleText("\n===================={}====================\n".format("Normal termination"))
+    HiM.log1.flush()
 
     if runParameters["parallel"]:
-        HiM.cluster.close()   
         HiM.client.close()
+        # an external scheduler is left running
+        if HiM.cluster is not None:
+            HiM.cluster.close()   
 
     del HiM
     